@@ -1,4 +1,8 @@
+from .alerts import AlertsApi
 from .api import Api
+from .groups import GroupsApi, ParameterGroup
+from .health import HealthApi
+from .history import HistoryApi
 from .highlevel import HighlevelApi
 from .metrics import MetricsApi
 from .parameters import ParameterApi
@@ -0,0 +1,43 @@
+from vcontrol_new import ConnectionCache
+from vcontrol_new.alerts import describe_event
+
+from .auth import BaseAuthenticationProvider
+from .base_api import BaseApiPart, api_route
+
+
+class AlertsApi(BaseApiPart):
+    def __init__(
+        self, conn: ConnectionCache, auth_provider: BaseAuthenticationProvider
+    ):
+        super().__init__("alerts_api", "/alerts", conn, auth_provider)
+
+    @api_route("/")
+    async def alerts(self, request):
+        """Describes the state of every alert rule and the latest state transitions."""
+        status = await self.conn.get_alerts()
+        webhook = status["webhook"]
+        return {
+            "rules": {
+                name: {
+                    "param": rule["param_id"],
+                    "condition": rule["condition"],
+                    "threshold": rule["threshold"],
+                    "state": rule["state"],
+                    "since": rule["since"].isoformat() if rule["since"] else None,
+                    "value": rule["value"],
+                }
+                for name, rule in status["rules"].items()
+            },
+            "events": [describe_event(event) for event in status["events"]],
+            "webhook": (
+                {
+                    "queued": webhook["queued"],
+                    "sent": webhook["sent"],
+                    "dropped": webhook["dropped"],
+                    "failures": webhook["failures"],
+                    "lastError": webhook["last_error"],
+                }
+                if webhook
+                else None
+            ),
+        }
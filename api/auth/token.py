@@ -1,12 +1,15 @@
+import hashlib
+import hmac
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime, timedelta
 from secrets import token_hex
 from typing import Union
 
 
 class AuthenticationToken:
-    def __init__(self, valid_until: datetime):
+    def __init__(self, valid_until: datetime, data: str = None):
         self.valid_until = valid_until
-        self.data = token_hex(16)
+        self.data = data or token_hex(16)
     
     def __eq__(self, other):
         return other == self.data \
@@ -37,6 +40,11 @@ class TokenStore:
         self.cleanup_tokencount = cleanup_tokencount
         self.cleanup_expired_longer_than = cleanup_expired_longer_than
     
+    def create_token(self, user: str, valid_until: datetime) -> AuthenticationToken:
+        token = AuthenticationToken(valid_until)
+        self.insert(user, token)
+        return token
+
     def insert(self, user: str, token: AuthenticationToken):
         self.tokens[token.data] = token, user
         if len(self.tokens) > self.cleanup_tokencount:
@@ -61,3 +69,37 @@ class TokenStore:
         ]
         for key in keys_to_delete:
             del self.tokens[key]
+
+
+class SignedTokenStore(TokenStore):
+    """
+    Token store which does not remember the issued tokens, instead the user and the
+    expiration time are part of the token and signed with a secret. Thus tokens issued by
+    one API worker process are accepted by all others sharing the same secret.
+    """
+    def __init__(self, secret: bytes):
+        super().__init__()
+        self.secret = secret
+
+    def create_token(self, user: str, valid_until: datetime) -> AuthenticationToken:
+        payload = urlsafe_b64encode(
+            f"{int(valid_until.timestamp())}:{user}".encode()
+        ).decode()
+        return AuthenticationToken(valid_until, f"{payload}.{self._sign(payload)}")
+
+    def is_valid(self, token: Union[str, AuthenticationToken]) -> TokenState:
+        token_data = token if isinstance(token, str) else token.data
+        payload, _, signature = token_data.partition(".")
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return TokenInvalid()
+        try:
+            timestamp, _, user = urlsafe_b64decode(payload).decode().partition(":")
+            valid_until = datetime.fromtimestamp(int(timestamp))
+        except ValueError:
+            return TokenInvalid()
+        if valid_until < datetime.now():
+            return TokenExpired()
+        return TokenValid(valid_until, user)
+
+    def _sign(self, payload: str) -> str:
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()
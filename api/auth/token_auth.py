@@ -17,8 +17,9 @@ class TokenAuthenticationProvider(BaseAuthenticationProvider):
         try:
             if not await self.backend.check_password(user, password):
                 raise AuthenticationException
-            token = AuthenticationToken(datetime.now() + self.token_validity)
-            self.token_store.insert(user, token)
+            token = self.token_store.create_token(
+                user, datetime.now() + self.token_validity
+            )
             return {
                 "token": token.data,
                 "valid_until": token.valid_until.isoformat()
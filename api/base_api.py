@@ -1,8 +1,10 @@
 import functools
+import math
 
 from sanic import Blueprint
-from sanic.response import json, text
+from sanic.response import HTTPResponse, json, text
 from vcontrol_new import ConnectionCache
+from vcontrol_new.command_queue import QueueOverloadedException
 
 from .auth import AuthenticationException, BaseAuthenticationProvider
 
@@ -44,7 +46,8 @@ class api_route:
         Whether this route is only accessible after successful authentication.
     raw_mode: `bool`
         Whether the handler function is responsible for creating the Sanic response object
-        (no JSON response will be created per default from the returned object)
+        (no JSON response will be created per default from the returned object). Even
+        without it, a handler may return a Sanic response object, e.g. to set headers.
 
     """
 
@@ -89,7 +92,17 @@ class api_route:
                             )
                 try:
                     result = await self.fn(inner_self, request, *args, **kwargs)
-                    return json(result) if not self.raw_mode else result
+                    if self.raw_mode or isinstance(result, HTTPResponse):
+                        return result
+                    return json(result)
+                except QueueOverloadedException as e:
+                    # tell clients when it is worth trying again
+                    headers = {"Retry-After": str(math.ceil(e.retry_after))}
+                    return (
+                        json({"error": str(e)}, status=503, headers=headers)
+                        if not self.raw_mode
+                        else text("Error: " + str(e), status=503, headers=headers)
+                    )
                 except Exception as e:
                     return (
                         json({"error": str(e)})
@@ -0,0 +1,114 @@
+import asyncio
+from collections import namedtuple
+from typing import Dict, List, Tuple
+
+from sanic.response import json, raw
+from util import get_flag_from_request
+from vcontrol_new import ConnectionCache
+from vcontrol_new.command_queue import QueueOverloadedException
+
+from .auth import BaseAuthenticationProvider
+from .base_api import BaseApiPart, api_route
+from .parameters import describe_reading
+
+ParameterGroup = namedtuple("ParameterGroup", ["name", "parameters"])
+
+
+class GroupsApi(BaseApiPart):
+    """Serves named groups of parameters, read as close together in time as possible.
+
+    Concurrent requests for the same group share the reading and rendering, and the
+    rendered response is reused as long as none of the readings changed.
+    """
+
+    def __init__(
+        self,
+        conn: ConnectionCache,
+        auth_provider: BaseAuthenticationProvider,
+        groups: List[ParameterGroup],
+    ):
+        super().__init__("groups_api", "/groups", conn, auth_provider)
+        self.groups = {group.name: group for group in groups}
+        for group in groups:
+            for param_id in group.parameters:
+                # fail early on unknown parameters
+                conn.param_storage.get_parameter(param_id)
+        # last response body of every group, with the readings it was rendered from
+        self._rendered: Dict[str, Tuple[tuple, bytes]] = dict()
+        self._pending: Dict[tuple, asyncio.Task] = dict()
+
+    @api_route("/")
+    async def get_groups(self, request):
+        return [
+            {"name": group.name, "parameters": list(group.parameters)}
+            for group in self.groups.values()
+        ]
+
+    @api_route("/<name>")
+    async def get_group(self, request, name):
+        return await self._respond(request, name, force=False)
+
+    @api_route("/<name>/reload")
+    async def reload_group(self, request, name):
+        return await self._respond(request, name, force=True)
+
+    async def _respond(self, request, name: str, force: bool):
+        if name not in self.groups:
+            return {"error": "Group not found!"}
+        allow_stale = get_flag_from_request(request, "allow_stale")
+        key = (name, force, allow_stale)
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.get_event_loop().create_task(
+                self._render(self.groups[name], force, allow_stale)
+            )
+            self._pending[key] = task
+
+            def done(task):
+                del self._pending[key]
+                if not task.cancelled():
+                    # mark a possible exception as retrieved
+                    task.exception()
+
+            task.add_done_callback(done)
+        body, cache_status = await asyncio.shield(task)
+        return raw(
+            body, content_type="application/json", headers={"X-Cache": cache_status}
+        )
+
+    async def _render(
+        self, group: ParameterGroup, force: bool, allow_stale: bool
+    ) -> Tuple[bytes, str]:
+        results = await self.conn.read_params_with_status(
+            group.parameters, force, allow_stale
+        )
+        for result in results:
+            if isinstance(result, QueueOverloadedException):
+                raise result
+        readings = [result[0] for result in results if not isinstance(result, Exception)]
+        key = tuple(
+            str(result)
+            if isinstance(result, Exception)
+            else (result[0].time, result[0].value)
+            for result in results
+        )
+        rendered = self._rendered.get(group.name)
+        if rendered is not None and rendered[0] == key:
+            return rendered[1], "HIT"
+        body = json(
+            {
+                "name": group.name,
+                # time of the oldest reading
+                "snapshotTime": min(reading.time for reading in readings).isoformat()
+                if readings
+                else None,
+                "parameters": [
+                    {"id": param_id, "error": str(result)}
+                    if isinstance(result, Exception)
+                    else describe_reading(result[0])
+                    for param_id, result in zip(group.parameters, results)
+                ],
+            }
+        ).body
+        self._rendered[group.name] = key, body
+        return body, "MISS"
@@ -0,0 +1,103 @@
+from sanic.response import json
+from vcontrol_new import CacheStatus, ConnectionCache
+
+from .auth import BaseAuthenticationProvider
+from .base_api import BaseApiPart, api_route
+
+
+class HealthApi(BaseApiPart):
+    def __init__(
+        self, conn: ConnectionCache, auth_provider: BaseAuthenticationProvider
+    ):
+        super().__init__("health_api", "/health", conn, auth_provider)
+
+    @api_route("/", raw_mode=True, require_auth=False)
+    async def health(self, request):
+        """Reports the load of the command queue.
+
+        Responds with status 503 while new commands would be rejected, so load balancers
+        and clients can back off.
+        """
+        status = await self.conn.get_queue_status()
+        return json(
+            {
+                "status": "overloaded" if status["overloaded"] else "ok",
+                "queue": {
+                    "depth": status["depth"],
+                    "maxDepth": status["max_depth"],
+                    "queuedBytes": status["queued_bytes"],
+                    "estimatedWait": status["estimated_wait"],
+                    "waitBudget": status["wait_budget"],
+                },
+                "bus": {
+                    "utilization": status["utilization"],
+                    "secondsPerByte": status["seconds_per_byte"],
+                    "syncInterval": status["sync_interval"],
+                    "commands": status["commands"],
+                },
+            },
+            status=503 if status["overloaded"] else 200,
+        )
+
+    @api_route("/failures", require_auth=False)
+    async def failures(self, request):
+        """Lists the parameters which currently cannot be read."""
+        return {
+            param_id: {
+                "error": str(failure.error),
+                "failures": failure.count,
+                "since": failure.since.isoformat(),
+                "retryAt": failure.retry_at.isoformat(),
+            }
+            for param_id, failure in (await self.conn.get_failures()).items()
+        }
+
+    @api_route("/prefetch", require_auth=False)
+    async def prefetch(self, request):
+        """Reports how read requests have been answered and how prefetching contributed."""
+        status = await self.conn.get_prefetch_status()
+        requests = status["requests"]
+        hits = sum(
+            status["statuses"].get(it.value, 0)
+            for it in (CacheStatus.HIT, CacheStatus.STALE)
+        )
+        return {
+            "requests": requests,
+            "statuses": status["statuses"],
+            "hitRate": hits / requests if requests else None,
+            "prefetch": {
+                "issued": status["issued"],
+                "issuedBytes": status["issued_bytes"],
+                "used": status["used"],
+                "wasted": status["wasted"],
+                "pending": status["pending"],
+                # share of the requests answered by prefetched values
+                "hitRateGain": status["used"] / requests if requests else None,
+            },
+        }
+
+    @api_route("/refresh", require_auth=False)
+    async def refresh(self, request):
+        """Compares the planned with the achieved freshness of the refreshed parameters."""
+        report = await self.conn.get_refresh_report()
+        return {
+            "feasible": report["feasible"],
+            "load": report["load"],
+            "busShare": report["bus_share"],
+            "parameters": {
+                param_id: {
+                    "target": it["target"],
+                    "planned": it["planned"],
+                    "priority": it["priority"],
+                    "adaptive": it["adaptive"],
+                    "changeRate": it["change_rate"],
+                    "adjustments": it["adjustments"],
+                    "achieved": it["achieved"],
+                    "age": it["age"],
+                    "refreshes": it["refreshes"],
+                    "misses": it["misses"],
+                    "errors": it["errors"],
+                }
+                for param_id, it in report["parameters"].items()
+            },
+        }
@@ -1,5 +1,4 @@
-import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from vcontrol_new import ConnectionCache
 from vcontrol_new.parameter import AggregatedParameter
@@ -7,6 +6,11 @@ from vcontrol_new.parameter import AggregatedParameter
 from .auth import BaseAuthenticationProvider
 from .base_api import BaseApiPart, api_route
 
+# key of the scheduled write restoring the hotwater program
+_HEATUP_KEY = "hotwater_heatup"
+# the heat-up is reported as active until a while after the program was restored
+_HEATUP_TAIL = timedelta(minutes=15)
+
 
 class HighlevelApi(BaseApiPart):
     def __init__(
@@ -16,10 +20,7 @@ class HighlevelApi(BaseApiPart):
         hotwater_program_param: AggregatedParameter,
     ):
         super().__init__("highlevel_api", "/special", conn, auth_provider)
-        self.hotwater_heatup_active = False
-        self.current_program = None
         self.hotwater_program_param = hotwater_program_param
-        self.day_param = None
 
     @api_route("/hotwater_fast_heatup", {"GET", "POST"})
     async def hotwater_heatup(self, request):
@@ -29,25 +30,28 @@ class HighlevelApi(BaseApiPart):
         and after a few seconds turning it back to the original value.
         """
         assert isinstance(self.hotwater_program_param, AggregatedParameter)
-        if request.method == "POST" and not self.hotwater_heatup_active:
+        active = await self.is_heatup_active()
+        if request.method == "POST" and not active:
             now = datetime.now()
-            self.hotwater_heatup_active = True
-            self.day_param = self.hotwater_program_param.get_child_param(now.weekday())
+            day_param = self.hotwater_program_param.get_child_param(now.weekday())
             temporary_program = [((0, 0), (24, 00))]
-            self.current_program = (
-                await self.conn.read_param(self.day_param, force=True)
-            ).value
-            await self.conn.set_param(self.day_param, temporary_program)
-            asyncio.get_event_loop().create_task(self.rollback())
-        return {"heatup_status": self.hotwater_heatup_active}
-
-    async def rollback(self):
-        await asyncio.sleep(90)
-        await self.conn.set_param(self.day_param, self.current_program)
-        asyncio.get_event_loop().call_later(15 * 60, self.disable)
-
-    def disable(self):
-        print("Disabling hotwater heatup")
-        self.hotwater_heatup_active = False
-        self.current_program = None
-        self.day_param = None
+            current_program = (await self.conn.read_param(day_param, force=True)).value
+            rollback = now + timedelta(seconds=90)
+            # scheduled first, so the original program is restored even after a crash
+            await self.conn.schedule_write(
+                _HEATUP_KEY, day_param.id, current_program, rollback, replace=False
+            )
+            try:
+                await self.conn.set_param(day_param, temporary_program)
+            except Exception:
+                await self.conn.cancel_scheduled_write(_HEATUP_KEY)
+                raise
+            active = True
+        return {"heatup_status": active}
+
+    async def is_heatup_active(self) -> bool:
+        # kept by the scheduler, so all workers agree on it
+        if await self.conn.get_scheduled_write(_HEATUP_KEY) is not None:
+            return True
+        restored = await self.conn.get_scheduled_write_completion(_HEATUP_KEY)
+        return restored is not None and datetime.now() < restored + _HEATUP_TAIL
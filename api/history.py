@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+from util import get_param_from_request
+from vcontrol_new import ConnectionCache
+from vcontrol_new.history import HistoryBucket
+
+from .auth import BaseAuthenticationProvider
+from .base_api import BaseApiPart, api_route
+
+
+def describe_bucket(bucket: HistoryBucket) -> dict:
+    ret = {
+        "time": bucket.time.isoformat(),
+        "min": bucket.minimum,
+        "max": bucket.maximum,
+        "avg": bucket.average,
+        "count": bucket.count,
+    }
+    if bucket.time_in_state:
+        ret["timeInState"] = {
+            str(state): seconds for state, seconds in bucket.time_in_state.items()
+        }
+    return ret
+
+
+class HistoryApi(BaseApiPart):
+    def __init__(
+        self, conn: ConnectionCache, auth_provider: BaseAuthenticationProvider
+    ):
+        super().__init__("history_api", "/history", conn, auth_provider)
+
+    @api_route("/")
+    async def status(self, request):
+        """Describes the recorded history of every parameter."""
+        return {
+            param_id: {
+                "samples": status["samples"],
+                "blocks": status["blocks"],
+                "bytes": status["bytes"],
+                "from": status["start"].isoformat() if status["start"] else None,
+                "to": status["end"].isoformat() if status["end"] else None,
+            }
+            for param_id, status in (await self.conn.get_history_status()).items()
+        }
+
+    @api_route("/<param_id>")
+    async def history(self, request, param_id):
+        """Returns the recorded values of a parameter between `from` and `to`.
+
+        Both are ISO 8601 timestamps, defaulting to the last hour. If `step` is given, the
+        values are aggregated into buckets of `step` seconds.
+        """
+        end = get_param_from_request(request, "to")
+        end = datetime.fromisoformat(end) if end else datetime.now()
+        start = get_param_from_request(request, "from")
+        start = datetime.fromisoformat(start) if start else end - timedelta(hours=1)
+        step = get_param_from_request(request, "step")
+        if step is not None:
+            step = float(step)
+            assert step > 0, "step must be positive"
+            resolution, buckets = await self.conn.get_history_buckets(
+                param_id, start, end, step
+            )
+            return {
+                "id": param_id,
+                "from": start.isoformat(),
+                "to": end.isoformat(),
+                "step": step,
+                "resolution": resolution,
+                "values": [describe_bucket(bucket) for bucket in buckets],
+            }
+        values = await self.conn.get_history(param_id, start, end)
+        return {
+            "id": param_id,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "values": [
+                {"time": time.isoformat(), "value": value} for time, value in values
+            ],
+        }
@@ -31,4 +31,43 @@ class MetricsApi(BaseApiPart):
 """
             except Exception as e:
                 ret += f"## Error reading value of {m.param.name}: {e}\n"
-        return response.text(ret)
\ No newline at end of file
+        ret += "# HELP vcontrol_commands_total Commands taken from the command queue\n"
+        ret += "# TYPE vcontrol_commands_total counter\n"
+        for outcome, count in (await self.conn.get_queue_status())["commands"].items():
+            ret += f'vcontrol_commands_total{{outcome="{outcome}"}} {count}\n'
+        ret += self._refresh_metrics(
+            (await self.conn.get_refresh_report())["parameters"]
+        )
+        prefetch = await self.conn.get_prefetch_status()
+        ret += "# HELP vcontrol_read_requests_total Read requests by cache status\n"
+        ret += "# TYPE vcontrol_read_requests_total counter\n"
+        for status, count in prefetch["statuses"].items():
+            ret += f'vcontrol_read_requests_total{{status="{status}"}} {count}\n'
+        ret += "# HELP vcontrol_prefetch_total Prefetched parameters\n"
+        ret += "# TYPE vcontrol_prefetch_total counter\n"
+        for outcome in ["issued", "used", "wasted"]:
+            count = prefetch[outcome]
+            ret += f'vcontrol_prefetch_total{{outcome="{outcome}"}} {count}\n'
+        return response.text(ret)
+
+    @staticmethod
+    def _refresh_metrics(refreshed: dict) -> str:
+        """Describe the background refresh intervals and their adaptive adjustments."""
+        ret = "# HELP vcontrol_refresh_interval_seconds Planned refresh interval\n"
+        ret += "# TYPE vcontrol_refresh_interval_seconds gauge\n"
+        for param_id, it in refreshed.items():
+            labels = f'param="{param_id}"'
+            ret += f"vcontrol_refresh_interval_seconds{{{labels}}} {it['planned']}\n"
+        ret += "# HELP vcontrol_refresh_change_rate Value changes per second\n"
+        ret += "# TYPE vcontrol_refresh_change_rate gauge\n"
+        for param_id, it in refreshed.items():
+            if it["change_rate"] is not None:
+                labels = f'param="{param_id}"'
+                ret += f"vcontrol_refresh_change_rate{{{labels}}} {it['change_rate']}\n"
+        ret += "# HELP vcontrol_refresh_adjustments_total Interval adjustments\n"
+        ret += "# TYPE vcontrol_refresh_adjustments_total counter\n"
+        for param_id, it in refreshed.items():
+            for direction, count in it["adjustments"].items():
+                labels = f'param="{param_id}",direction="{direction}"'
+                ret += f"vcontrol_refresh_adjustments_total{{{labels}}} {count}\n"
+        return ret
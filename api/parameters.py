@@ -1,9 +1,42 @@
+from datetime import datetime
+from json import dumps
+
+from sanic.response import json, text
+from util import get_flag_from_request, get_param_from_request
 from vcontrol_new import ConnectionCache
+from vcontrol_new.parameter import ParameterReading
 
 from .auth import BaseAuthenticationProvider
 from .base_api import BaseApiPart, api_route
 from .serializer import Serializer, DeserializationException
 
+# number of values fetched from the history at once while exporting
+_EXPORT_PAGE_SIZE = 1000
+_EXPORT_FORMATS = {
+    "csv": (
+        "text/csv",
+        "time,value\n",
+        lambda time, value: f"{time.isoformat()},{value}\n",
+    ),
+    "ndjson": (
+        "application/x-ndjson",
+        "",
+        lambda time, value: dumps({"time": time.isoformat(), "value": value}) + "\n",
+    ),
+}
+
+
+def describe_reading(reading: ParameterReading) -> dict:
+    return {
+        "id": reading.parameter.id,
+        "name": reading.parameter.name,
+        "lastReload": reading.time.isoformat(),
+        "value": Serializer.serialize(reading.value, reading.parameter.unit),
+        "display_string": reading.parameter.unit.get_display_string(reading.value),
+        "readonly": reading.parameter.readonly,
+        "unit": Serializer.describe_unit(reading.parameter.unit),
+    }
+
 
 class ParameterApi(BaseApiPart):
     def __init__(
@@ -51,16 +84,58 @@ class ParameterApi(BaseApiPart):
         return await self.get_parameter(request, param_id)
 
     async def get_parameter(self, request, parameter_id, force_load: bool = False):
-        reading = await self.conn.read_param(parameter_id, force=force_load)
-        return {
-            "id": reading.parameter.id,
-            "name": reading.parameter.name,
-            "lastReload": reading.time.isoformat(),
-            "value": Serializer.serialize(reading.value, reading.parameter.unit),
-            "display_string": reading.parameter.unit.get_display_string(reading.value),
-            "readonly": reading.parameter.readonly,
-            "unit": Serializer.describe_unit(reading.parameter.unit),
-        }
+        reading, status = await self.conn.read_param_with_status(
+            parameter_id,
+            force=force_load,
+            allow_stale=get_flag_from_request(request, "allow_stale"),
+        )
+        return json(describe_reading(reading), headers={"X-Cache": status.value})
+
+    @api_route("/<param_id>/history/export", raw_mode=True)
+    async def export_history(self, request, param_id):
+        """Streams the recorded values of a parameter as CSV or newline-delimited JSON.
+
+        The values are fetched from the history page by page, so the memory used does not
+        depend on the size of the exported time range.
+        """
+        export_format = get_param_from_request(request, "format") or "csv"
+        if export_format not in _EXPORT_FORMATS:
+            return text(f"Error: Unknown format '{export_format}'", status=400)
+        content_type, header, format_value = _EXPORT_FORMATS[export_format]
+        end = get_param_from_request(request, "to")
+        end = datetime.fromisoformat(end) if end else datetime.now()
+        start = get_param_from_request(request, "from")
+        start = datetime.fromisoformat(start) if start else datetime.fromtimestamp(0)
+        # fails before the response is started, e.g. for unknown parameters
+        values = await self.conn.get_history(param_id, start, end, _EXPORT_PAGE_SIZE)
+        response = await request.respond(
+            content_type=content_type,
+            headers={
+                "Content-Disposition": (
+                    f'attachment; filename="{param_id}.{export_format}"'
+                )
+            },
+        )
+        # number of values at `start` which have already been sent
+        skip = 0
+        try:
+            await response.send(header)
+            while True:
+                chunk = "".join(format_value(time, value) for time, value in values)
+                await response.send(chunk)
+                if len(values) < _EXPORT_PAGE_SIZE:
+                    break
+                # several values may have the same timestamp, continue after the last one
+                last_time = values[-1][0]
+                if last_time != start:
+                    start, skip = last_time, 0
+                skip += sum(1 for time, _ in values if time == last_time)
+                values = await self.conn.get_history(
+                    param_id, start, end, skip + _EXPORT_PAGE_SIZE
+                )
+                values = values[skip:]
+        finally:
+            await response.eof()
 
     def get_param_value(self, request):
         try:
@@ -1,9 +1,16 @@
-import asyncio
 from datetime import datetime
+from typing import Optional
 
 from sanic import Blueprint
-from util import get_param_from_request, Weekday, ExtendedLock, LockedException
+from util import (
+    get_param_from_request,
+    get_flag_from_request,
+    Weekday,
+    ExtendedLock,
+    LockedException,
+)
 from vcontrol_new import ConnectionCache
+from vcontrol_new.command_queue import QueueOverloadedException
 from vcontrol_new.parameter import AggregatedParameter, ParameterReading
 from vcontrol_new.unit import CycleTimeUnit
 
@@ -12,6 +19,15 @@ from .base_api import BaseApiPart, api_route
 from .serializer import Serializer
 
 
+def describe_day(day: Weekday, cycle_times: list, time: datetime) -> dict:
+    return {
+        "dayID": day.value,
+        "dayName": day.name,
+        "lastReload": time.isoformat(),
+        "cycleTimes": Serializer.serialize(cycle_times, CycleTimeUnit()),
+    }
+
+
 class PartyModeManager:
     class PartyModeState:
         pass
@@ -28,52 +44,60 @@ class PartyModeManager:
     ):
         self.program_param = program_param
         self.conn = conn
-        self.cancel_task = None
-        self.cached_reading = None
-        self.until = None
+        # restoring the original program of the day is scheduled under this key, so the
+        # party mode survives restarts and is shared by all workers
+        self.key = f"party_mode:{program_param.id}"
         self.working_lock = ExtendedLock()
-    
+
     async def get_status(self) -> PartyModeState:
-        async with self.working_lock:
-            if self.until is None:
-                return self.Disabled()
-            else:
-                return self.Enabled(self.until)
+        job = await self.conn.get_scheduled_write(self.key)
+        if job is None:
+            return self.Disabled()
+        else:
+            return self.Enabled(job.due)
+
+    async def get_original_reading(self) -> Optional[ParameterReading]:
+        """Returns the program of the day restored when the party mode ends, if enabled."""
+        job = await self.conn.get_scheduled_write(self.key)
+        if job is None:
+            return None
+        return ParameterReading(
+            self.conn.param_storage.get_parameter(job.param_id), job.value, job.created
+        )
+
+    async def set_original_value(self, value):
+        """Changes the program restored when the party mode ends."""
+        job = await self.conn.get_scheduled_write(self.key)
+        if job is None:
+            raise Exception("Party mode is not enabled!")
+        await self.conn.schedule_write(self.key, job.param_id, value, job.due)
 
     async def enable(self, until):
         # expect 'until' to be a valid datetime somewhen later this day
-        def _disable():
-            self.cancel_task = None
-            asyncio.get_event_loop().create_task(self._disable())
         async with self.working_lock.nowait():
-            if self.until is not None:
+            if await self.conn.get_scheduled_write(self.key) is not None:
                 raise Exception("Party mode is already enabled!")
             day_param = self.program_param.get_child_param(datetime.now().weekday())
             cached_reading = await self.conn.read_param(day_param)
+            # scheduled first, so the original program is restored even after a crash
+            await self.conn.schedule_write(
+                self.key, day_param.id, cached_reading.value, until, replace=False
+            )
             temporary_program = [((0, 0), (24, 00))]
-            await self.conn.set_param(day_param, temporary_program)
+            try:
+                await self.conn.set_param(day_param, temporary_program)
+            except Exception:
+                await self.conn.cancel_scheduled_write(self.key)
+                raise
             seconds = (until - datetime.now()).total_seconds()
             print(f"Scheduling disabling party mode of {self.program_param.name} at {until} which is in {seconds} seconds!")
-            self.cancel_task = asyncio.get_event_loop().call_later(seconds, _disable)
-            self.until = until
-            self.cached_reading = cached_reading
-        
-    async def _disable(self):
-        async with self.working_lock.nowait():
-            if self.until is None:
-                raise Exception("Party mode is already disabled!")
-            try:
-                await self.conn.set_param(self.cached_reading.parameter, self.cached_reading.value)
-            finally:
-                self.cached_reading = None
-                self.until = None
 
     async def disable(self):
-        # disable the cancel task and run _disable() manually
-        if self.cancel_task is not None:
-            self.cancel_task.cancel()
-            self.cancel_task = None
-        await self._disable()
+        async with self.working_lock.nowait():
+            if await self.conn.get_scheduled_write(self.key) is None:
+                raise Exception("Party mode is already disabled!")
+            # restore the original program now instead of when due
+            await self.conn.run_scheduled_write(self.key)
 
 class ProgramApi(BaseApiPart):
     def __init__(
@@ -92,16 +116,40 @@ class ProgramApi(BaseApiPart):
         self.party_mode_manager = PartyModeManager(program_param, conn)
 
     async def get(self, request, force: bool = False):
-        reading = await self.conn.read_param(self.program_param, force=force)
+        reading = await self.conn.read_param(
+            self.program_param,
+            force=force,
+            allow_stale=get_flag_from_request(request, "allow_stale"),
+        )
+        return self.describe(
+            reading, await self.party_mode_manager.get_original_reading()
+        )
+
+    def describe(
+        self, reading: ParameterReading, party_reading: Optional[ParameterReading]
+    ) -> dict:
+        """Describes the program with the days taken straight from the container's reading.
+
+        While the party mode is enabled, `party_reading` is the original program of the day.
+        """
+        days = []
+        for day in Weekday:
+            value, time = reading.value[day.value], reading.time
+            day_id = f"{self.program_param.id}.{day.value}"
+            if party_reading is not None and party_reading.parameter.id == day_id:
+                value, time = party_reading.value, party_reading.time
+            days.append(describe_day(day, value, time))
         return {
             "id": self.program_param.id,
             "name": self.program_param.name,
             "lastReload": reading.time.isoformat(),
-            "cycleTimes": [await self.get_day(request, day.id) for day in Weekday],
+            "cycleTimes": days,
         }
 
-    @api_route("/")
+    @api_route("/", methods={"GET", "PUT"})
     async def get_normal(self, request):
+        if request.method == "PUT":
+            return await self.set_week(request)
         return await self.get(request, force=False)
 
     @api_route("/reload")
@@ -149,32 +197,52 @@ class ProgramApi(BaseApiPart):
     async def get_day(self, request, day_id, force: bool = False):
         day = Weekday(day_id)
         day_param_id = f"{self.program_param.id}.{day_id}"
-        cached_reading = self.party_mode_manager.cached_reading
+        cached_reading = await self.party_mode_manager.get_original_reading()
         reading = None
         if cached_reading is not None and cached_reading.parameter.id == day_param_id:
             reading = cached_reading
         else:
-            reading = await self.conn.read_param(day_param_id, force=force)
-        return {
-            "dayID": day.value,
-            "dayName": day.name,
-            "lastReload": reading.time.isoformat(),
-            "cycleTimes": Serializer.serialize(reading.value, CycleTimeUnit()),
-        }
+            reading = await self.conn.read_param(
+                day_param_id,
+                force=force,
+                allow_stale=get_flag_from_request(request, "allow_stale"),
+            )
+        return describe_day(day, reading.value, reading.time)
 
     async def set_day(self, request, day_id):
-        day_param = self.program_param.get_child_param(day_id)
         times = Serializer.deserialize(request.json, CycleTimeUnit())
-        cached_reading = self.party_mode_manager.cached_reading
-        if cached_reading is not None and cached_reading.parameter.id == day_param.id:
-            self.party_mode_manager.cached_reading = ParameterReading(
-                day_param,
-                times,
-                datetime.now()
-            )
-        else:
-            await self.conn.set_param(f"{self.program_param.id}.{day_id}", times)
-        return {"success": True}
+        changed = await self.write_days({Weekday(day_id).value: times})
+        return {"success": True, "changed": bool(changed)}
+
+    async def set_week(self, request):
+        """Sets the cycle times of all days, given as a list of seven days (like for a
+        single day) or as returned by GET. Only the changed days are written."""
+        body = request.json
+        if isinstance(body, dict):
+            body = body.get("cycleTimes")
+        if not isinstance(body, list) or len(body) != len(Weekday):
+            raise Exception(f"Cycle times of all {len(Weekday)} days have to be given!")
+        days = dict()
+        for day_id, times in enumerate(body):
+            if isinstance(times, dict):
+                day_id, times = times["dayID"], times["cycleTimes"]
+            days[Weekday(day_id).value] = Serializer.deserialize(times, CycleTimeUnit())
+        if len(days) != len(Weekday):
+            raise Exception("Cycle times of a day have been given twice!")
+        changed = await self.write_days(days)
+        return {"success": True, "changedDays": changed}
+
+    async def write_days(self, days: dict) -> list:
+        """Writes the changed days, returns their ids."""
+        cached_reading = await self.party_mode_manager.get_original_reading()
+        for day_id in list(days):
+            day_param = self.program_param.get_child_param(day_id)
+            if cached_reading is not None and cached_reading.parameter.id == day_param.id:
+                # restored when the party mode is disabled
+                await self.party_mode_manager.set_original_value(days.pop(day_id))
+        if not days:
+            return []
+        return await self.conn.set_children(self.program_param.id, days)
 
 
 class ProgramsApi(BaseApiPart):
@@ -203,5 +271,36 @@ class ProgramsApi(BaseApiPart):
     async def get_programs(self, request):
         return [{"id": program.id, "name": program.name} for program in self.programs]
 
+    @api_route("/all")
+    async def get_all_programs(self, request):
+        return await self.get_all(request, force=False)
+
+    @api_route("/all/reload")
+    async def reload_all_programs(self, request):
+        return await self.get_all(request, force=True)
+
+    async def get_all(self, request, force: bool):
+        """Returns every control program, all of them read in a single bus session."""
+        results = await self.conn.read_params_with_status(
+            [program.id for program in self.programs],
+            force,
+            get_flag_from_request(request, "allow_stale"),
+        )
+        for result in results:
+            if isinstance(result, QueueOverloadedException):
+                raise result
+        party_readings = [
+            await api.party_mode_manager.get_original_reading()
+            for api in self.program_apis
+        ]
+        return [
+            {"id": api.program_param.id, "error": str(result)}
+            if isinstance(result, Exception)
+            else api.describe(result[0], party_reading)
+            for api, result, party_reading in zip(
+                self.program_apis, results, party_readings
+            )
+        ]
+
     def get_blueprint(self):
         return self.blueprint_group
@@ -1,3 +1,4 @@
+from util import get_param_from_request
 from vcontrol_new import ConnectionCache
 
 from .auth import BaseAuthenticationProvider
@@ -14,8 +15,9 @@ class RawApi(BaseApiPart):
     async def read_address(self, request, address, size):
         assert 0 < size < 32
         address = bytes.fromhex(address)
-        return {
-            "address": address.hex(),
-            "size": size,
-            "value": "0x" + (await self.conn.conn.read_address(address, size)).hex(),
-        }
+        # bytes transferred at most `max_age` seconds ago may be taken from the shadow
+        max_age = get_param_from_request(request, "max_age")
+        value = await self.conn.read_address(
+            address, size, float(max_age) if max_age is not None else None
+        )
+        return {"address": address.hex(), "size": size, "value": "0x" + value.hex()}
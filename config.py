@@ -8,9 +8,11 @@ from api.auth import (
     NoAuthenticationProvider,
     TokenAuthenticationProvider,
 )
+from api.groups import ParameterGroup
 from api.metrics import MetricMapping
 from util.config import *
 from vcontrol_new import (
+    CachePolicy,
     ConnectionCache,
     HeatingControl,
     OptolinkConnection,
@@ -18,15 +20,21 @@ from vcontrol_new import (
     AddressWithOffset,
     ViessmannConnection,
 )
+from vcontrol_new.alerts import AlertEngine, AlertRule, WebhookNotifier
+from vcontrol_new.broker import BrokerClient, default_socket_path
+from vcontrol_new.derived import DerivedParameter, Expression
 from vcontrol_new.dummy import HeatingDummy
 from vcontrol_new.encoding import (
     ArrayEncoding,
+    BitFieldEncoding,
     FloatEncoding,
     IntEncoding,
     UIntEncoding,
     SystemTimeEncoding,
     TimerEncoding,
 )
+from vcontrol_new.history import HistoryStore
+from vcontrol_new.influx import InfluxExporter
 from vcontrol_new.parameter import AggregatedParameter, Parameter
 from vcontrol_new.unit import (
     CycleTimeUnit,
@@ -90,6 +98,29 @@ param_config = Section(
 )
 
 
+cache_config = Section(
+    {
+        "max_age": Value(default=-1),
+        "stale_while_revalidate": Value(default=0),
+        "debounce": Value(default=0),
+        "refresh": Value(default=None),
+        "priority": Value(default=0),
+        "min_refresh": Value(default=None),
+        "max_refresh": Value(default=None),
+    },
+    default={},
+    mapper=lambda x: CachePolicy(
+        x.max_age,
+        x.stale_while_revalidate,
+        x.debounce,
+        x.refresh,
+        x.priority,
+        x.min_refresh,
+        x.max_refresh,
+    ),
+)
+
+
 def create_kerberos_auth(section):
     from api.auth.kerberos import KerberosAuthenticationBackend
 
@@ -98,26 +129,169 @@ def create_kerberos_auth(section):
     )
 
 
-def get_config(loop, file: str = "config.yaml"):
+def create_device(x, broker_socket: str = None):
+    mappings = [*x.parameters] + [mapping for flags in x.flags for mapping in flags]
+    heating_control = HeatingControl(mappings, x.protocol, [*x.derived])
+    policies = {m.param.id: m.cache_policy for m in mappings}
+    param_storage = heating_control.get_param_storage()
+    if broker_socket is not None:
+        # the device connection is owned by the broker process
+        return BrokerClient(param_storage, broker_socket, policies)
+    history = None
+    if x.history.enabled:
+        history = HistoryStore(param_storage, x.history.retention, x.history.block_size)
+    alerts = None
+    if x.alerts.rules:
+        # fail early on rules for unknown parameters or with the same name
+        names = set()
+        for rule in x.alerts.rules:
+            param_storage.get_parameter(rule.param_id)
+            if rule.name in names:
+                raise Exception(f"Alert rule {rule.name} is configured twice")
+            names.add(rule.name)
+        webhook = x.alerts.webhook
+        alerts = AlertEngine(
+            [*x.alerts.rules],
+            (
+                WebhookNotifier(
+                    webhook.url,
+                    webhook.min_interval,
+                    webhook.max_batch,
+                    webhook.max_queue,
+                    webhook.timeout,
+                )
+                if webhook.url
+                else None
+            ),
+        )
+    return ConnectionCache(
+        ViessmannConnection(
+            heating_control,
+            x.type(),
+            x.command_timeout,
+            x.command_retries,
+            x.retry_backoff,
+            x.max_queue_size,
+            x.max_queue_wait,
+        ),
+        policies,
+        x.failure_backoff,
+        x.max_failure_backoff,
+        x.refresh_bus_share,
+        x.refresh_max_stretch,
+        x.prefetch_budget,
+        x.prefetch_window,
+        history,
+        alerts,
+        x.write_journal,
+    )
+
+
+server_config = Section(
+    {
+        "ip": Value(default="127.0.0.1"),
+        "port": Value(default=8000),
+        "workers": Value(default=1),
+        "broker_socket": Value(default=default_socket_path()),
+    }
+)
+
+
+def get_server_config(file: str = "config.yaml"):
+    config = Config({"server": server_config})
+    with open(file, "r") as stream:
+        parsed_cfg = config.apply_config(
+            {"server": yaml.safe_load(stream)["config"].get("server", {})}
+        )
+
+    return parsed_cfg.server
+
+
+def get_config(loop, file: str = "config.yaml", broker_socket: str = None):
+    """
+    Parses the configuration file. If `broker_socket` is given, the device is not
+    connected directly, but through the broker process listening on that socket.
+    """
     config = Config(
         {
-            "server": Section(
-                {"ip": Value(default="127.0.0.1"), "port": Value(default=8000)}
-            ),
+            "server": server_config,
             "device": Section(
                 {
                     "name": Value(default="Dummy"),
                     "type": Alternative(
-                        Option("dummy", mapper=lambda x: HeatingDummy(loop)),
+                        Option(
+                            "dummy",
+                            {"protocol": Value(default="KW")},
+                            mapper=lambda x: lambda: HeatingDummy(loop, x.protocol),
+                        ),
                         Option(
                             "serial",
                             {"serial_device": Value(default="/dev/ttyUSB0")},
-                            mapper=lambda x: OptolinkConnection(loop, x.serial_device),
+                            mapper=lambda x: lambda: OptolinkConnection(
+                                loop, x.serial_device
+                            ),
                             default_option=True,
                         ),
                         hide_discriminant=True,
                     ),
                     "protocol": Value(default="KW"),
+                    "command_timeout": Value(default=10),
+                    "command_retries": Value(default=2),
+                    "retry_backoff": Value(default=0.5),
+                    "max_queue_size": Value(default=100),
+                    "max_queue_wait": Value(default=None),
+                    "failure_backoff": Value(default=10),
+                    "max_failure_backoff": Value(default=3600),
+                    "refresh_bus_share": Value(default=0.5),
+                    "refresh_max_stretch": Value(default=10),
+                    "prefetch_budget": Value(default=0),
+                    "prefetch_window": Value(default=10),
+                    # compressed in-memory history of the numeric values read
+                    "history": Section(
+                        {
+                            "enabled": Value(default=False),
+                            "retention": Value(default=7 * 24 * 3600),
+                            "block_size": Value(default=1024),
+                        },
+                        default={},
+                    ),
+                    # deferred writes (e.g. ending the party mode) are kept in this file
+                    "write_journal": Value(default="write_journal.jsonl"),
+                    # rules evaluated whenever a value is stored in the cache
+                    "alerts": Section(
+                        {
+                            "rules": List(
+                                {
+                                    "name": Value(),
+                                    "param": Value(),
+                                    "condition": Value(),
+                                    "threshold": Value(),
+                                    "hysteresis": Value(default=0),
+                                    "hold": Value(default=0),
+                                },
+                                default=[],
+                                child_mapper=lambda x: AlertRule(
+                                    x.name,
+                                    x.param,
+                                    x.condition,
+                                    x.threshold,
+                                    x.hysteresis,
+                                    x.hold,
+                                ),
+                            ),
+                            "webhook": Section(
+                                {
+                                    "url": Value(default=None),
+                                    "min_interval": Value(default=10),
+                                    "max_batch": Value(default=100),
+                                    "max_queue": Value(default=1000),
+                                    "timeout": Value(default=10),
+                                },
+                                default={},
+                            ),
+                        },
+                        default={},
+                    ),
                     "parameters": List(
                         {
                             "param": param_config,
@@ -145,6 +319,17 @@ def get_config(loop, file: str = "config.yaml"):
                                             "system_time",
                                             mapper=lambda x: SystemTimeEncoding(),
                                         ),
+                                        Option(
+                                            "bits",
+                                            {
+                                                "size": Value(default=1),
+                                                "bit": Value(),
+                                                "count": Value(default=1),
+                                            },
+                                            mapper=lambda x: BitFieldEncoding(
+                                                x.size, x.bit, x.count
+                                            ),
+                                        ),
                                         Option(
                                             "array",
                                             {
@@ -171,17 +356,47 @@ def get_config(loop, file: str = "config.yaml"):
                             "address": Value(
                                 mapper=aligned_address
                             ),
+                            "cache": cache_config,
                         },
                         child_mapper=lambda x: ParamMapping(
-                            x.param, x.encoding, x.address
+                            x.param, x.encoding, x.address, x.cache
+                        ),
+                    ),
+                    # parameters computed from the values of others
+                    "derived": List(
+                        {"param": param_config, "expression": Value(mapper=Expression)},
+                        default=[],
+                        child_mapper=lambda x: DerivedParameter(
+                            x.param.name, x.param.id, x.param.unit, x.expression
                         ),
                     ),
+                    # flags packed into the bits of a value, read all at once
+                    "flags": List(
+                        {
+                            "address": Value(mapper=aligned_address),
+                            "size": Value(default=1),
+                            "bits": List(
+                                {
+                                    "param": param_config,
+                                    "bit": Value(),
+                                    "count": Value(default=1),
+                                    "cache": cache_config,
+                                }
+                            ),
+                        },
+                        default=[],
+                        child_mapper=lambda x: [
+                            ParamMapping(
+                                it.param,
+                                BitFieldEncoding(x.size, it.bit, it.count),
+                                x.address,
+                                it.cache,
+                            )
+                            for it in x.bits
+                        ],
+                    ),
                 },
-                mapper=lambda x: ConnectionCache(
-                    ViessmannConnection(
-                        HeatingControl(x.parameters, x.protocol), x.type
-                    )
-                ),
+                mapper=lambda x: create_device(x, broker_socket),
             ),
             "api": Section(
                 {
@@ -264,8 +479,43 @@ def get_config(loop, file: str = "config.yaml"):
                         }
                     ),
                     "highlevel": Section({"hotwater_program_param": param_config}),
+                    "groups": List(
+                        {"name": Value(), "parameters": List(Value())},
+                        default=[],
+                        child_mapper=lambda x: ParameterGroup(x.name, x.parameters.get()),
+                        mapper=lambda x: x.get(),
+                    ),
                 }
             ),
+            # pushes the values read to InfluxDB
+            "influxdb": Section(
+                {
+                    "enabled": Value(default=False),
+                    "url": Value(default="http://localhost:8086/write?db=vcontrol"),
+                    "token": Value(default=None),
+                    "measurement": Value(default="vcontrol"),
+                    "tags": Value(default={}),
+                    "batch_size": Value(default=500),
+                    "flush_interval": Value(default=10),
+                    "max_buffer": Value(default=10000),
+                    "timeout": Value(default=10),
+                },
+                default={},
+                mapper=lambda x: (
+                    InfluxExporter(
+                        x.url,
+                        x.token,
+                        x.measurement,
+                        x.tags,
+                        x.batch_size,
+                        x.flush_interval,
+                        x.max_buffer,
+                        x.timeout,
+                    )
+                    if x.enabled
+                    else None
+                ),
+            ),
         }
     )
     with open(file, "r") as stream:
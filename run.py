@@ -1,11 +1,31 @@
 import asyncio
+import mmap
+import multiprocessing
+import secrets
+import socket
+
 import uvloop
 
 from sanic import Sanic
 
-from api import Api, HighlevelApi, MetricsApi, ParameterApi, ProgramsApi, RawApi
-from config import get_config
+from api import (
+    AlertsApi,
+    Api,
+    GroupsApi,
+    HealthApi,
+    HighlevelApi,
+    HistoryApi,
+    MetricsApi,
+    ParameterApi,
+    ProgramsApi,
+    RawApi,
+)
+from api.auth import TokenAuthenticationProvider
+from api.auth.token import SignedTokenStore
+from config import get_config, get_server_config
 from vcontrol_new import ConnectionCache
+from vcontrol_new.broker import BrokerServer
+from vcontrol_new.shared_cache import SharedReadingCache
 
 app = Sanic(__name__)
 
@@ -17,6 +37,10 @@ def create_api(conn: ConnectionCache, api_cfg):
         ParameterApi(conn, auth_provider),
         RawApi(conn, auth_provider),
         HighlevelApi(conn, auth_provider, api_cfg.highlevel.hotwater_program_param),
+        HealthApi(conn, auth_provider),
+        GroupsApi(conn, auth_provider, api_cfg.groups),
+        HistoryApi(conn, auth_provider),
+        AlertsApi(conn, auth_provider),
     ]
     if api_cfg.prometheus_metrics.enabled:
         api_parts.append(
@@ -25,10 +49,22 @@ def create_api(conn: ConnectionCache, api_cfg):
     return Api(conn, auth_provider, api_parts)
 
 
+def start_exporters(cfg):
+    """Must only be called in the process owning the device connection."""
+    if cfg.influxdb is not None:
+        cfg.device.add_listener(cfg.influxdb)
+        cfg.influxdb.start()
+    if cfg.device.alerts is not None:
+        cfg.device.alerts.start()
+
+
 async def main():
     loop = asyncio.get_event_loop()
     cfg = get_config(loop)
     cfg.device.conn.start_communication()
+    cfg.device.start_refreshing()
+    cfg.device.start_scheduler()
+    start_exporters(cfg)
     api = create_api(cfg.device, cfg.api)
     app.blueprint(api.get_blueprint())
     server = await app.create_server(
@@ -38,6 +74,73 @@ async def main():
     await server.serve_forever()
 
 
+async def run_broker(broker_socket: str, shared_memory: mmap.mmap):
+    cfg = get_config(asyncio.get_event_loop())
+    cfg.device.add_listener(SharedReadingCache(cfg.device.param_storage, shared_memory))
+    cfg.device.conn.start_communication()
+    cfg.device.start_refreshing()
+    cfg.device.start_scheduler()
+    start_exporters(cfg)
+    await BrokerServer(cfg.device, broker_socket).serve_forever()
+
+
+async def run_worker(
+    sock: socket.socket, broker_socket: str, shared_memory: mmap.mmap, secret: bytes
+):
+    cfg = get_config(asyncio.get_event_loop(), broker_socket=broker_socket)
+    cfg.device.shared_cache = SharedReadingCache(
+        cfg.device.param_storage, shared_memory
+    )
+    auth_provider = cfg.api.auth.provider
+    if isinstance(auth_provider, TokenAuthenticationProvider):
+        # tokens have to be accepted by every worker, not only the one issuing them
+        auth_provider.token_store = SignedTokenStore(secret)
+    api = create_api(cfg.device, cfg.api)
+    app.blueprint(api.get_blueprint())
+    server = await app.create_server(sock=sock, return_asyncio_server=True)
+    await server.startup()
+    await server.serve_forever()
+
+
+def worker_main(*args):
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(run_worker(*args))
+
+
+def main_with_workers(server_cfg):
+    """
+    Runs `server_cfg.workers` API worker processes sharing one listening socket. The device
+    connection is owned by this process, which serves the workers' requests as a broker and
+    publishes the cached values in shared memory.
+    """
+    sock = socket.create_server((server_cfg.ip, server_cfg.port), reuse_port=False)
+    sock.set_inheritable(True)
+    token_secret = secrets.token_bytes(32)
+    # anonymous shared memory, inherited by the forked processes
+    param_storage = get_config(
+        None, broker_socket=server_cfg.broker_socket
+    ).device.param_storage
+    shared_memory = mmap.mmap(-1, SharedReadingCache.get_size(param_storage))
+    # fork before any event loop is created in this process
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(
+            target=worker_main,
+            args=(sock, server_cfg.broker_socket, shared_memory, token_secret),
+            daemon=True,
+        )
+        for _ in range(server_cfg.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(run_broker(server_cfg.broker_socket, shared_memory))
+
+
 if __name__ == "__main__":
-    asyncio.set_event_loop(uvloop.new_event_loop())
-    asyncio.run(main())
+    server_cfg = get_server_config()
+    if server_cfg.workers > 1:
+        main_with_workers(server_cfg)
+    else:
+        asyncio.set_event_loop(uvloop.new_event_loop())
+        asyncio.run(main())
@@ -1,2 +1,7 @@
-from .utils import get_param_from_request, LockedException, ExtendedLock
+from .utils import (
+    get_param_from_request,
+    get_flag_from_request,
+    LockedException,
+    ExtendedLock,
+)
 from .weekday import Weekday
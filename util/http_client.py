@@ -0,0 +1,116 @@
+import asyncio
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+
+class HttpException(Exception):
+    pass
+
+
+class HttpClient:
+    """Minimal asynchronous HTTP/1.1 client for a single server.
+
+    Up to `max_connections` connections are opened and kept alive between requests, so
+    that regularly sent requests don't need a new connection (and TLS handshake) each time.
+    """
+
+    def __init__(self, base_url: str, max_connections: int = 2, timeout: float = 10):
+        url = urlsplit(base_url)
+        if url.scheme not in ("http", "https"):
+            raise HttpException(f"Unsupported URL '{base_url}'")
+        self.host = url.hostname
+        self.ssl = url.scheme == "https"
+        self.port = url.port or (443 if self.ssl else 80)
+        self.base_path = url.path.rstrip("/")
+        self.query = url.query
+        self.timeout = timeout
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def request(
+        self,
+        method: str,
+        path: str = "",
+        body: bytes = b"",
+        headers: Dict[str, str] = None,
+    ) -> Tuple[int, bytes]:
+        """Send a request, returns the status code and the body of the response.
+
+        `path` is appended to the path of the base URL, which may also contain a query.
+        """
+        target = self.base_path + path or "/"
+        if self.query:
+            target += ("&" if "?" in target else "?") + self.query
+        head = f"{method} {target} HTTP/1.1\r\nHost: {self.host}\r\n"
+        for name, value in {
+            "Content-Length": str(len(body)),
+            "Connection": "keep-alive",
+            **(headers or {}),
+        }.items():
+            head += f"{name}: {value}\r\n"
+        data = head.encode() + b"\r\n" + body
+        async with self._slots:
+            reused = bool(self._idle)
+            connection = await self._connect()
+            try:
+                return await asyncio.wait_for(
+                    self._send(connection, data), self.timeout
+                )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+            # the server may have closed the idle connection meanwhile, try a new one
+            connection = await self._connect(reuse=False)
+            return await asyncio.wait_for(self._send(connection, data), self.timeout)
+
+    async def _connect(self, reuse: bool = True):
+        while reuse and self._idle:
+            reader, writer = self._idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl or None),
+            self.timeout,
+        )
+
+    async def _send(self, connection, data: bytes) -> Tuple[int, bytes]:
+        reader, writer = connection
+        try:
+            writer.write(data)
+            await writer.drain()
+            status_line = await reader.readuntil(b"\r\n")
+            try:
+                status = int(status_line.split()[1])
+            except (IndexError, ValueError):
+                raise HttpException(f"Invalid status line {status_line!r}")
+            headers = dict()
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                if line == b"\r\n":
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if headers.get("transfer-encoding", "").lower() == "chunked":
+                body = b""
+                while True:
+                    size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                    chunk = await reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+                    body += chunk[:-2]
+            else:
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+        except BaseException:
+            writer.close()
+            raise
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            self._idle.append((reader, writer))
+        return status, body
+
+    def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
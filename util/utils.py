@@ -17,6 +17,12 @@ def get_param_from_request(request: Request, param: str):
     except KeyError:
         return None
 
+
+def get_flag_from_request(request: Request, param: str) -> bool:
+    value = get_param_from_request(request, param)
+    return value is True or str(value).lower() in ("1", "true", "yes")
+
+
 class LockedException(Exception):
     pass
 
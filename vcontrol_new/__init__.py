@@ -1,4 +1,4 @@
 from .connection import ViessmannConnection
-from .connection_cache import ConnectionCache
+from .connection_cache import ConnectionCache, CacheListener, CachePolicy, CacheStatus
 from .heating_control import HeatingControl, ParamMapping, AddressWithOffset
 from .optolink import OptolinkConnection
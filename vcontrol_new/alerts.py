@@ -0,0 +1,269 @@
+import asyncio
+import json
+from collections import deque, namedtuple
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from util.http_client import HttpClient
+
+from .connection_cache import CacheListener
+from .parameter import ParameterReading
+
+CONDITIONS = ["above", "below", "equal", "not_equal", "stale"]
+# number of state transitions kept for the API
+_EVENT_HISTORY = 100
+# failed webhook deliveries are retried with a doubling interval, up to this many seconds
+_MAX_RETRY_INTERVAL = 300
+
+# a rule changing its state to "firing" or "resolved"
+AlertEvent = namedtuple("AlertEvent", ["rule", "param_id", "state", "value", "time"])
+
+
+class AlertRule:
+    """Condition on the values of a parameter, evaluated whenever a value is stored.
+
+    The condition `above` (`below`) holds while the value is greater (less) than
+    `threshold`. Once firing, it only resolves when the value has fallen below
+    `threshold - hysteresis` (risen above `threshold + hysteresis`). `equal` and `not_equal`
+    compare the value with `threshold`. The rule only fires after the condition has held
+    for `hold` seconds.
+
+    The condition `stale` holds if no value has been stored for `threshold` seconds.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        param_id: str,
+        condition: str,
+        threshold: Any,
+        hysteresis: float = 0,
+        hold: float = 0,
+    ):
+        if condition not in CONDITIONS:
+            raise Exception(f"Unknown condition '{condition}' of alert rule {name}")
+        self.name = name
+        self.param_id = param_id
+        self.condition = condition
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.hold = hold
+        # "ok", "pending" (condition holds, but not yet for `hold` seconds) or "firing"
+        self.state = "ok"
+        self.since: Optional[datetime] = None
+        self.value = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def is_active(self, value) -> bool:
+        firing = self.state == "firing"
+        try:
+            if self.condition == "above":
+                return value > self.threshold - (self.hysteresis if firing else 0)
+            if self.condition == "below":
+                return value < self.threshold + (self.hysteresis if firing else 0)
+        except TypeError:
+            return False
+        if self.condition == "equal":
+            return value == self.threshold
+        if self.condition == "not_equal":
+            return value != self.threshold
+        return False
+
+    def cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class AlertEngine(CacheListener):
+    """Evaluates `AlertRule`s incrementally on the values stored in a `ConnectionCache`.
+
+    Only the rules of the parameter stored are evaluated, hold durations and stale
+    conditions are tracked with timers. Transitions to "firing" and "resolved" are kept for
+    the API and sent to the `WebhookNotifier`, if given.
+    """
+
+    def __init__(self, rules: List[AlertRule], notifier: "WebhookNotifier" = None):
+        self.rules = rules
+        self.notifier = notifier
+        self.rules_by_param: Dict[str, List[AlertRule]] = dict()
+        for rule in rules:
+            self.rules_by_param.setdefault(rule.param_id, []).append(rule)
+        self.events = deque(maxlen=_EVENT_HISTORY)
+        self._loop = None
+
+    def start(self):
+        """Start the stale timers and the webhook delivery."""
+        self._loop = asyncio.get_event_loop()
+        for rule in self.rules:
+            if rule.condition == "stale":
+                self._arm_stale(rule)
+        if self.notifier is not None:
+            self.notifier.start()
+
+    def value_stored(self, reading: ParameterReading):
+        rules = self.rules_by_param.get(reading.parameter.id)
+        if not rules or self._loop is None:
+            return
+        for rule in rules:
+            if rule.condition == "stale":
+                if rule.state == "firing":
+                    self._transition(rule, "resolved", reading.value)
+                self._arm_stale(rule)
+            elif rule.is_active(reading.value):
+                if rule.state == "ok":
+                    rule.value = reading.value
+                    if rule.hold > 0:
+                        rule.state = "pending"
+                        rule.since = datetime.now()
+                        rule._timer = self._loop.call_later(
+                            rule.hold, self._hold_elapsed, rule
+                        )
+                    else:
+                        self._transition(rule, "firing", reading.value)
+                else:
+                    rule.value = reading.value
+            elif rule.state == "pending":
+                rule.cancel_timer()
+                rule.state = "ok"
+                rule.since = datetime.now()
+                rule.value = reading.value
+            elif rule.state == "firing":
+                self._transition(rule, "resolved", reading.value)
+            else:
+                rule.value = reading.value
+
+    def _hold_elapsed(self, rule: AlertRule):
+        rule._timer = None
+        if rule.state == "pending":
+            self._transition(rule, "firing", rule.value)
+
+    def _arm_stale(self, rule: AlertRule):
+        rule.cancel_timer()
+        rule._timer = self._loop.call_later(rule.threshold, self._stale, rule)
+
+    def _stale(self, rule: AlertRule):
+        rule._timer = None
+        self._transition(rule, "firing", rule.value)
+
+    def _transition(self, rule: AlertRule, state: str, value):
+        rule.state = "firing" if state == "firing" else "ok"
+        rule.since = datetime.now()
+        rule.value = value
+        event = AlertEvent(rule.name, rule.param_id, state, value, rule.since)
+        self.events.append(event)
+        if self.notifier is not None:
+            self.notifier.notify(event)
+
+    def get_status(self) -> dict:
+        return {
+            "rules": {
+                rule.name: {
+                    "param_id": rule.param_id,
+                    "condition": rule.condition,
+                    "threshold": rule.threshold,
+                    "state": rule.state,
+                    "since": rule.since,
+                    "value": rule.value,
+                }
+                for rule in self.rules
+            },
+            "events": list(self.events),
+            "webhook": self.notifier.get_status() if self.notifier else None,
+        }
+
+
+def describe_event(event: AlertEvent) -> dict:
+    return {
+        "rule": event.rule,
+        "param": event.param_id,
+        "state": event.state,
+        "value": event.value,
+        "time": event.time.isoformat(),
+    }
+
+
+class WebhookNotifier:
+    """Posts alert events to `url` as JSON (`{"events": [...]}`).
+
+    Events are sent in batches of up to `max_batch` events, with at most one request every
+    `min_interval` seconds: the first event is sent immediately, the ones following it are
+    collected meanwhile. Failed deliveries are retried, while more than `max_queue` events
+    are waiting the oldest ones are dropped.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        min_interval: float = 10,
+        max_batch: int = 100,
+        max_queue: int = 1000,
+        timeout: float = 10,
+    ):
+        self.client = HttpClient(url, max_connections=1, timeout=timeout)
+        self.min_interval = min_interval
+        self.max_batch = max_batch
+        self.queue = deque(maxlen=max_queue)
+        # the batch being delivered, kept until it has been accepted
+        self.batch: List[AlertEvent] = []
+        self.sent = 0
+        self.dropped = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self._queued = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    def notify(self, event: AlertEvent):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(event)
+        self._queued.set()
+
+    async def run(self):
+        """Deliver the queued events until cancelled."""
+        retry_interval = self.min_interval
+        while True:
+            if not self.batch:
+                if not self.queue:
+                    self._queued.clear()
+                    await self._queued.wait()
+                count = min(len(self.queue), self.max_batch)
+                self.batch = [self.queue.popleft() for _ in range(count)]
+            try:
+                await self._send(self.batch)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                retry_interval = min(
+                    retry_interval * 2, max(_MAX_RETRY_INTERVAL, self.min_interval)
+                )
+                print(f"Alert webhook failed ({e}), retrying in {retry_interval:.1f}s")
+                await asyncio.sleep(retry_interval)
+                continue
+            retry_interval = self.min_interval
+            self.sent += len(self.batch)
+            self.batch = []
+            await asyncio.sleep(self.min_interval)
+
+    async def _send(self, batch: List[AlertEvent]):
+        body = json.dumps({"events": [describe_event(it) for it in batch]}, default=str)
+        status, response = await self.client.request(
+            "POST",
+            body=body.encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        if status >= 300:
+            raise Exception(f"HTTP {status}: {response.decode(errors='replace')}")
+
+    def get_status(self) -> dict:
+        return {
+            "queued": len(self.queue) + len(self.batch),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,582 @@
+import asyncio
+import json
+import math
+import os
+import socket
+import stat
+import struct
+import tempfile
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from .alerts import AlertEvent
+from .command_queue import QueueOverloadedException
+from .connection_cache import (
+    DEFAULT_CACHE_POLICY,
+    CachePolicy,
+    CacheStatus,
+    ConnectionCache,
+    ReadFailure,
+)
+from .encoding import OperatingStatus
+from .heating_control import ParameterStorage
+from .history import HistoryBucket
+from .parameter import Parameter, ParameterReading
+from .scheduler import ScheduledWrite
+from .shared_cache import SharedReadingCache
+
+# Every message is framed by a header containing the message type, an id used to match
+# responses to requests and the length of the message body.
+_HEADER = struct.Struct("!BII")
+
+READ = 0x01
+WRITE = 0x02
+READ_ADDRESS = 0x03
+CALL = 0x04
+CANCEL = 0x05
+READ_MANY = 0x06
+RESULT = 0x80
+ERROR = 0xFF
+
+# READ request body: flags and maximum age (NaN to use the parameter's cache policy),
+# followed by the parameter id
+_READ_REQUEST = struct.Struct("!Bd")
+FLAG_FORCE = 0x01
+FLAG_ALLOW_STALE = 0x02
+# READ result body: index of the `CacheStatus` and timestamp of the reading, followed by
+# the value encoded using the parameter's `Encoding` (as JSON for derived parameters)
+_READING = struct.Struct("!Bd")
+# READ_ADDRESS request body: maximum age of shadowed bytes (NaN to read from the device),
+# size and address
+_ADDRESS_REQUEST = struct.Struct("!dB")
+# ERROR body: kind of the error and seconds after which to retry, followed by the message
+_ERROR = struct.Struct("!Bd")
+ERROR_GENERIC = 0
+ERROR_OVERLOADED = 1
+
+_CACHE_STATUSES = list(CacheStatus)
+
+# CALL and READ_MANY messages and their results are encoded as JSON, see `_to_json()`.
+# Only these types are decoded besides the JSON types, nothing else is instantiated.
+_ENUMS = {it.__name__: it for it in [CacheStatus, OperatingStatus]}
+_RECORDS = {it.__name__: it for it in [AlertEvent, HistoryBucket, ScheduledWrite]}
+
+# methods of the `ConnectionCache` which may be invoked with CALL messages
+_CALLABLE = {
+    "get_queue_status",
+    "get_failures",
+    "get_refresh_report",
+    "get_prefetch_status",
+    "get_history",
+    "get_history_buckets",
+    "get_history_status",
+    "get_alerts",
+    "set_children",
+    "schedule_write",
+    "cancel_scheduled_write",
+    "run_scheduled_write",
+    "get_scheduled_write",
+    "get_scheduled_writes",
+    "get_scheduled_write_completion",
+}
+
+
+def _frame(msg_type: int, request_id: int, body: bytes = b"") -> bytes:
+    return _HEADER.pack(msg_type, request_id, len(body)) + body
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Tuple[int, int, bytes]:
+    msg_type, request_id, length = _HEADER.unpack(
+        await reader.readexactly(_HEADER.size)
+    )
+    return msg_type, request_id, await reader.readexactly(length)
+
+
+def default_socket_path() -> str:
+    """Return the path of the broker socket within a directory private to the user."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "vpy_rest", "broker.sock")
+    return os.path.join(tempfile.gettempdir(), f"vpy_rest-{os.getuid()}", "broker.sock")
+
+
+def _check_socket_directory(directory: str):
+    """Make sure that no other user can replace the socket within the directory."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory, mode=0o700)
+    info = os.stat(directory)
+    if info.st_uid not in (os.getuid(), 0):
+        raise Exception(f"Directory {directory} of the broker socket is not ours")
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH) and not info.st_mode & stat.S_ISVTX:
+        raise Exception(
+            f"Directory {directory} of the broker socket is writable by others"
+        )
+
+
+def _is_own_process(writer: asyncio.StreamWriter) -> bool:
+    """Whether the peer of the connection runs as the same user (if that can be told)."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    sock = writer.get_extra_info("socket")
+    credentials = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid == os.getuid()
+
+
+def _to_json(value: Any):
+    """Convert a value to JSON types. Types JSON lacks are objects with a single key."""
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, Enum):
+        name = type(value).__name__
+        if _ENUMS.get(name) is not type(value):
+            raise TypeError(f"{name} cannot be transferred to the broker")
+        return {name: value.value}
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, list):
+        return [_to_json(it) for it in value]
+    if isinstance(value, tuple):
+        name = type(value).__name__
+        if _RECORDS.get(name) is type(value):
+            return {name: [_to_json(it) for it in value]}
+        return {"tuple": [_to_json(it) for it in value]}
+    if isinstance(value, dict):
+        return {"dict": [[_to_json(k), _to_json(v)] for k, v in value.items()]}
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, ReadFailure):
+        return {
+            "ReadFailure": [
+                _to_json(value.error),
+                value.count,
+                _to_json(value.since),
+                _to_json(value.retry_at),
+            ]
+        }
+    if isinstance(value, Exception):
+        return {"error": _encode_error(value).hex()}
+    raise TypeError(f"{type(value).__name__} cannot be transferred to the broker")
+
+
+def _from_json(value: Any):
+    if isinstance(value, list):
+        return [_from_json(it) for it in value]
+    if not isinstance(value, dict):
+        return value
+    ((name, content),) = value.items()
+    if name == "tuple":
+        return tuple(_from_json(it) for it in content)
+    if name == "dict":
+        return {_from_json(k): _from_json(v) for k, v in content}
+    if name == "datetime":
+        return datetime.fromisoformat(content)
+    if name == "ReadFailure":
+        return ReadFailure(*(_from_json(it) for it in content))
+    if name == "error":
+        return _decode_error(bytes.fromhex(content))
+    if name in _ENUMS:
+        return _ENUMS[name](content)
+    if name in _RECORDS:
+        return _RECORDS[name](*(_from_json(it) for it in content))
+    raise ValueError(f"Unknown type {name}")
+
+
+def _encode(value: Any) -> bytes:
+    return json.dumps(_to_json(value), separators=(",", ":")).encode()
+
+
+def _decode(data: bytes) -> Any:
+    return _from_json(json.loads(data))
+
+
+def _serialize_value(param_storage: ParameterStorage, param_id: str, value: Any):
+    if param_storage.is_derived(param_id):
+        # computed values don't have a device encoding
+        return _encode(value)
+    _, _, encoding = param_storage.get_storage(param_id)
+    return encoding.serialize(value)
+
+
+def _deserialize_value(param_storage: ParameterStorage, param_id: str, data: bytes):
+    if param_storage.is_derived(param_id):
+        return _decode(data)
+    _, _, encoding = param_storage.get_storage(param_id)
+    return encoding.deserialize(data)
+
+
+def _encode_error(e: Exception) -> bytes:
+    if isinstance(e, QueueOverloadedException):
+        return _ERROR.pack(ERROR_OVERLOADED, e.retry_after) + str(e).encode()
+    return _ERROR.pack(ERROR_GENERIC, 0) + str(e).encode()
+
+
+def _decode_error(body: bytes) -> Exception:
+    kind, retry_after = _ERROR.unpack_from(body)
+    if kind == ERROR_OVERLOADED:
+        return QueueOverloadedException(retry_after)
+    return Exception(body[_ERROR.size :].decode())
+
+
+class BrokerServer:
+    """Serves requests of `BrokerClient`s using the process' `ConnectionCache`.
+
+    This allows multiple (API worker) processes to share the single connection to the heating
+    control device and its cache. The messages are exchanged over a Unix domain socket using
+    a compact binary framing, values are transferred in their device encoding. The socket
+    is only accessible by the user running the broker, connections of processes of other
+    users are rejected.
+    """
+
+    def __init__(self, cache: ConnectionCache, path: str):
+        self.cache = cache
+        self.path = path
+        # identical raw reads requested by different workers share one command
+        self._address_reads: Dict[Tuple[bytes, int], asyncio.Task] = dict()
+
+    async def serve_forever(self):
+        _check_socket_directory(os.path.dirname(os.path.abspath(self.path)))
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._serve_client, path=self.path)
+        os.chmod(self.path, 0o600)
+        async with server:
+            await server.serve_forever()
+
+    async def _serve_client(self, reader, writer):
+        if not _is_own_process(writer):
+            print("Rejected a broker connection of another user")
+            writer.close()
+            return
+        tasks: Dict[int, asyncio.Task] = dict()
+        try:
+            while True:
+                msg_type, request_id, body = await _read_frame(reader)
+                if msg_type == CANCEL:
+                    if request_id in tasks:
+                        tasks[request_id].cancel()
+                    continue
+                task = asyncio.get_event_loop().create_task(
+                    self._answer(writer, msg_type, request_id, body)
+                )
+                tasks[request_id] = task
+                task.add_done_callback(lambda _, id=request_id: tasks.pop(id, None))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # the worker went away, nobody waits for its requests anymore
+            for task in list(tasks.values()):
+                task.cancel()
+        finally:
+            writer.close()
+
+    async def _answer(self, writer, msg_type: int, request_id: int, body: bytes):
+        try:
+            writer.write(_frame(RESULT, request_id, await self._handle(msg_type, body)))
+        except Exception as e:
+            writer.write(_frame(ERROR, request_id, _encode_error(e)))
+
+    async def _handle(self, msg_type: int, body: bytes) -> bytes:
+        if msg_type == READ:
+            flags, max_age = _READ_REQUEST.unpack_from(body)
+            param_id = body[_READ_REQUEST.size :].decode()
+            reading, status = await self.cache.read_param_with_status(
+                param_id,
+                force=bool(flags & FLAG_FORCE),
+                max_age_seconds=None if math.isnan(max_age) else max_age,
+                allow_stale=bool(flags & FLAG_ALLOW_STALE),
+            )
+            return _READING.pack(
+                _CACHE_STATUSES.index(status), reading.time.timestamp()
+            ) + _serialize_value(self.cache.param_storage, param_id, reading.value)
+        elif msg_type == WRITE:
+            param_id = body[1 : 1 + body[0]].decode()
+            _, _, encoding = self.cache.param_storage.get_storage(param_id)
+            value = encoding.deserialize(body[1 + body[0] :])
+            await self.cache.set_param(param_id, value)
+            return b""
+        elif msg_type == READ_ADDRESS:
+            max_age, size = _ADDRESS_REQUEST.unpack_from(body)
+            return await self._read_address(
+                body[_ADDRESS_REQUEST.size :],
+                size,
+                None if math.isnan(max_age) else max_age,
+            )
+        elif msg_type == READ_MANY:
+            param_ids, force, allow_stale = _decode(body)
+            results = await self.cache.read_params_with_status(
+                param_ids, force, allow_stale
+            )
+            return _encode(
+                [
+                    (
+                        result
+                        if isinstance(result, Exception)
+                        else (result[1], result[0].time, result[0].value)
+                    )
+                    for result in results
+                ]
+            )
+        elif msg_type == CALL:
+            method, args = _decode(body)
+            if method not in _CALLABLE:
+                raise Exception(f"{method} cannot be called through the broker")
+            return _encode(await getattr(self.cache, method)(*args))
+        raise Exception(f"Invalid message type {msg_type}")
+
+    async def _read_address(
+        self, address: bytes, size: int, max_age_seconds: Optional[float]
+    ) -> bytes:
+        key = (address, size, max_age_seconds)
+        if key not in self._address_reads:
+            task = asyncio.get_event_loop().create_task(
+                self.cache.read_address(address, size, max_age_seconds)
+            )
+            self._address_reads[key] = task
+            task.add_done_callback(lambda _: self._address_reads.pop(key, None))
+        return await asyncio.shield(self._address_reads[key])
+
+
+class BrokerClient:
+    """Stands in for a `ConnectionCache` in processes not owning the device connection.
+
+    All requests are forwarded to the `BrokerServer` over a single, lazily established
+    connection, on which any number of requests may be pending at the same time. If the
+    broker publishes its cache in a `SharedReadingCache`, fresh values are taken from there
+    without asking the broker.
+    """
+
+    def __init__(
+        self,
+        param_storage: ParameterStorage,
+        path: str,
+        policies: Dict[str, CachePolicy] = None,
+        shared_cache: SharedReadingCache = None,
+    ):
+        self._param_storage = param_storage
+        self.path = path
+        self.policies = policies or dict()
+        self.shared_cache = shared_cache
+        self._reader = None
+        self._writer = None
+        self._connect_lock = asyncio.Lock()
+        self._pending: Dict[int, asyncio.Future] = dict()
+        self._next_request_id = 0
+
+    @property
+    def param_storage(self):
+        return self._param_storage
+
+    async def read_param(
+        self,
+        param: Union[Parameter, str],
+        force: bool = False,
+        max_age_seconds: int = None,
+        allow_stale: bool = False,
+    ) -> ParameterReading:
+        reading, _ = await self.read_param_with_status(
+            param, force, max_age_seconds, allow_stale
+        )
+        return reading
+
+    async def read_param_with_status(
+        self,
+        param: Union[Parameter, str],
+        force: bool = False,
+        max_age_seconds: int = None,
+        allow_stale: bool = False,
+    ) -> Tuple[ParameterReading, CacheStatus]:
+        param_id = param if isinstance(param, str) else param.id
+        if self.shared_cache is not None and not force:
+            reading = self._get_fresh_shared_reading(param_id, max_age_seconds)
+            if reading is not None:
+                return reading, CacheStatus.HIT
+        flags = (FLAG_FORCE if force else 0) | (FLAG_ALLOW_STALE if allow_stale else 0)
+        result = await self._request(
+            READ,
+            _READ_REQUEST.pack(
+                flags, math.nan if max_age_seconds is None else max_age_seconds
+            )
+            + param_id.encode(),
+        )
+        status, timestamp = _READING.unpack_from(result)
+        reading = ParameterReading(
+            self.param_storage.get_parameter(param_id),
+            _deserialize_value(self.param_storage, param_id, result[_READING.size :]),
+            datetime.fromtimestamp(timestamp),
+        )
+        return reading, _CACHE_STATUSES[status]
+
+    def _get_fresh_shared_reading(
+        self, param_id: str, max_age_seconds: Optional[int]
+    ) -> Optional[ParameterReading]:
+        reading = self.shared_cache.get_reading(param_id)
+        if reading is None:
+            return None
+        if max_age_seconds is None:
+            container = param_id.split(".")[0]
+            max_age_seconds = self.policies.get(
+                param_id, self.policies.get(container, DEFAULT_CACHE_POLICY)
+            ).max_age
+        if max_age_seconds < 0:
+            return reading
+        if (datetime.now() - reading.time).total_seconds() <= max_age_seconds:
+            return reading
+        # stale values are handled by the broker
+        return None
+
+    async def set_param(self, param: Union[Parameter, str], value: Any):
+        param_id = (param if isinstance(param, str) else param.id).encode()
+        _, _, encoding = self.param_storage.get_storage(param_id.decode())
+        await self._request(
+            WRITE, bytes([len(param_id)]) + param_id + encoding.serialize(value)
+        )
+
+    async def set_children(
+        self, container: Union[Parameter, str], values: Dict[int, Any]
+    ) -> List[int]:
+        container_id = container if isinstance(container, str) else container.id
+        return await self._call("set_children", container_id, values)
+
+    async def schedule_write(
+        self,
+        key: str,
+        param_id: str,
+        value: Any,
+        due: datetime,
+        interval: float = None,
+        replace: bool = True,
+    ) -> ScheduledWrite:
+        return await self._call(
+            "schedule_write", key, param_id, value, due, interval, replace
+        )
+
+    async def cancel_scheduled_write(self, key: str) -> Optional[ScheduledWrite]:
+        return await self._call("cancel_scheduled_write", key)
+
+    async def run_scheduled_write(self, key: str):
+        return await self._call("run_scheduled_write", key)
+
+    async def get_scheduled_write(self, key: str) -> Optional[ScheduledWrite]:
+        return await self._call("get_scheduled_write", key)
+
+    async def get_scheduled_writes(self) -> Dict[str, ScheduledWrite]:
+        return await self._call("get_scheduled_writes")
+
+    async def get_scheduled_write_completion(self, key: str) -> Optional[datetime]:
+        return await self._call("get_scheduled_write_completion", key)
+
+    async def read_address(
+        self, address: bytes, size: int, max_age_seconds: float = None
+    ) -> bytes:
+        max_age = math.nan if max_age_seconds is None else max_age_seconds
+        return await self._request(
+            READ_ADDRESS, _ADDRESS_REQUEST.pack(max_age, size) + address
+        )
+
+    async def read_params_with_status(
+        self,
+        param_ids: List[str],
+        force: bool = False,
+        allow_stale: bool = False,
+    ) -> List[Union[Tuple[ParameterReading, CacheStatus], Exception]]:
+        results = _decode(
+            await self._request(
+                READ_MANY, _encode([list(param_ids), force, allow_stale])
+            )
+        )
+        return [
+            (
+                result
+                if isinstance(result, Exception)
+                else (
+                    ParameterReading(
+                        self.param_storage.get_parameter(param_id), result[2], result[1]
+                    ),
+                    result[0],
+                )
+            )
+            for param_id, result in zip(param_ids, results)
+        ]
+
+    async def get_queue_status(self) -> dict:
+        return await self._call("get_queue_status")
+
+    async def get_failures(self) -> dict:
+        return await self._call("get_failures")
+
+    async def get_refresh_report(self) -> dict:
+        return await self._call("get_refresh_report")
+
+    async def get_prefetch_status(self) -> dict:
+        return await self._call("get_prefetch_status")
+
+    async def get_history(
+        self, param_id: str, start: datetime, end: datetime, limit: int = None
+    ) -> list:
+        return await self._call("get_history", param_id, start, end, limit)
+
+    async def get_history_buckets(
+        self, param_id: str, start: datetime, end: datetime, step: float
+    ) -> tuple:
+        return await self._call("get_history_buckets", param_id, start, end, step)
+
+    async def get_history_status(self) -> dict:
+        return await self._call("get_history_status")
+
+    async def get_alerts(self) -> dict:
+        return await self._call("get_alerts")
+
+    async def _call(self, method: str, *args):
+        return _decode(await self._request(CALL, _encode([method, list(args)])))
+
+    async def _request(self, msg_type: int, body: bytes) -> bytes:
+        writer = await self._connect()
+        self._next_request_id = (self._next_request_id + 1) % 2**32
+        request_id = self._next_request_id
+        fut = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = fut
+        writer.write(_frame(msg_type, request_id, body))
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            # let the broker stop working on the request
+            if not writer.is_closing():
+                writer.write(_frame(CANCEL, request_id))
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        async with self._connect_lock:
+            if self._writer is None:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                asyncio.get_event_loop().create_task(
+                    self._receive(reader, self._writer)
+                )
+            return self._writer
+
+    async def _receive(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while True:
+                msg_type, request_id, body = await _read_frame(reader)
+                fut = self._pending.get(request_id)
+                if fut is None or fut.done():
+                    continue
+                if msg_type == RESULT:
+                    fut.set_result(body)
+                else:
+                    fut.set_exception(_decode_error(body))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # the next request will connect again
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("Lost connection to the broker"))
@@ -1,3 +1,6 @@
+from collections import namedtuple
+
+
 class Command:
     def get_command_bytes(self) -> bytes:
         """Return the actual bytes to be sent to the heating control"""
@@ -11,6 +14,33 @@ class Command:
         """Return the number of bytes which the heating control is expected to answer"""
         raise NotImplementedError
 
+    def validate_result(self, data: bytes):
+        """Check the bytes received from the heating control before handling them.
+
+        Raises a `CommandFailedException` if they cannot be a valid answer to this command.
+        """
+        if len(data) != self.get_expected_bytes_count():
+            raise CommandFailedException(
+                f"Expected {self.get_expected_bytes_count()} bytes, received {len(data)}"
+            )
+
+
+class CommandFailedException(Exception):
+    """The heating control did not answer a command properly, it may be retried."""
+
+    pass
+
+
+class CommandTimeoutException(Exception):
+    """A command could not be completed before its deadline."""
+
+    pass
+
+
+# a command waiting in the command queue together with the future receiving its answer
+# and the (event loop) time after which nobody is interested in the answer anymore
+QueuedCommand = namedtuple("QueuedCommand", ["command", "future", "deadline"])
+
 
 class Answer:
     pass
@@ -75,3 +105,94 @@ class KWWriteCommand(Command):
 
     def get_expected_bytes_count(self):
         return 1
+
+
+def p300_checksum(data: bytes) -> int:
+    """Checksum of a P300 telegram, calculated over all bytes following the start byte."""
+    return sum(data) % 256
+
+
+class P300Command(Command):
+    """Base class for commands sent as telegrams over the P300 (VS2) protocol.
+
+    A telegram consists of the start byte 0x41, the length of the payload, the payload
+    (message type, function, 2-byte address, number of bytes and possibly the data) and a
+    checksum. The device acknowledges a request telegram with 0x06 (or 0x15 if it was
+    malformed) and then answers with a response telegram of the same structure.
+    """
+
+    REQUEST = 0x00
+    RESPONSE = 0x01
+    ERROR = 0x03
+    READ = 0x01
+    WRITE = 0x02
+
+    def __init__(self, function: int, address: bytes, size: int, data: bytes = b""):
+        assert len(address) == 2
+        assert 0 < size < 256
+        self.function = function
+        self.address = address
+        self.size = size
+        self.data = data
+
+    def get_command_bytes(self):
+        payload = (
+            bytes([self.REQUEST, self.function]) + self.address + bytes([self.size])
+        )
+        telegram = bytes([len(payload) + len(self.data)]) + payload + self.data
+        return b"\x41" + telegram + bytes([p300_checksum(telegram)])
+
+    def get_answer_data_size(self) -> int:
+        """Return the number of data bytes contained in the response telegram"""
+        raise NotImplementedError
+
+    def get_expected_bytes_count(self):
+        # ACK, start byte, length, type, function, address, size, data and checksum
+        return 1 + 1 + 1 + 5 + self.get_answer_data_size() + 1
+
+    def validate_result(self, data: bytes):
+        if len(data) < 9 or data[0] != 0x06 or data[1] != 0x41:
+            raise CommandFailedException("Invalid P300 response telegram")
+        if len(data) != data[2] + 4 or data[-1] != p300_checksum(data[2:-1]):
+            raise CommandFailedException("Corrupt P300 response telegram")
+        msg_type, function, address = data[3], data[4], data[5:7]
+        if msg_type == self.ERROR:
+            # a valid answer, the device reports an error
+            return
+        if msg_type != self.RESPONSE or function != self.function:
+            raise CommandFailedException("Unexpected P300 response telegram")
+        if address != self.address or data[7] != self.size:
+            raise CommandFailedException("P300 response for another address received")
+        super().validate_result(data)
+
+
+class P300ReadCommand(P300Command):
+    """Command for reading bytes from a given (2-byte) address over the P300 protocol."""
+
+    def __init__(self, address: bytes, size: int):
+        super().__init__(self.READ, address, size)
+
+    def get_answer_data_size(self):
+        return self.size
+
+    def handle_result(self, data: bytes):
+        if data[3] == self.ERROR:
+            return Failure()
+        return Data(bytes(data[8:-1]))
+
+
+class P300WriteCommand(P300Command):
+    """Command for writing bytes to a given (2-byte) address over the P300 protocol."""
+
+    def __init__(self, address: bytes, value: bytes):
+        assert len(value) > 0
+        super().__init__(self.WRITE, address, len(value), value)
+        self.value = value
+
+    def get_answer_data_size(self):
+        return 0
+
+    def handle_result(self, data: bytes):
+        if data[3] == self.ERROR:
+            return Failure()
+        return Success()
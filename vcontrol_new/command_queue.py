@@ -0,0 +1,35 @@
+import asyncio
+
+from .command import Command, QueuedCommand
+
+
+def get_transfer_size(cmd: Command) -> int:
+    """Number of bytes sent over the bus for a command, including the answer."""
+    return len(cmd.get_command_bytes()) + cmd.get_expected_bytes_count()
+
+
+class QueueOverloadedException(Exception):
+    """The command queue cannot take another command within the configured wait budget."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(
+            f"Heating control is busy, estimated wait would be {retry_after:.1f}s"
+        )
+        self.retry_after = retry_after
+
+
+class CommandQueue(asyncio.Queue):
+    """A (bounded) queue of `QueuedCommand`s keeping track of the bytes waiting to be transferred."""
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.queued_bytes = 0
+
+    def _put(self, item: QueuedCommand):
+        self.queued_bytes += get_transfer_size(item.command)
+        super()._put(item)
+
+    def _get(self) -> QueuedCommand:
+        item = super()._get()
+        self.queued_bytes -= get_transfer_size(item.command)
+        return item
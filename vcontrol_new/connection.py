@@ -1,53 +1,139 @@
 import asyncio
 from datetime import datetime
-from typing import Any
+from typing import Any, Dict, Optional, Tuple
 
-from .command import Command, Data, Success
-from .heating_control import BaseHeatingControl
+from .command import (
+    Answer,
+    Command,
+    CommandFailedException,
+    CommandTimeoutException,
+    Data,
+    QueuedCommand,
+    Success,
+)
+from .command_queue import CommandQueue, QueueOverloadedException, get_transfer_size
+from .heating_control import AddressWithOffset, BaseHeatingControl
+from .memory_shadow import MemoryShadow
 from .optolink import OptolinkConnection
 from .parameter import Parameter, ParameterReading, ParameterValue
 
 
+class _PendingRead:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
 class ViessmannConnection:
     """Combines a heating control device object and an Optolink connection.
 
     Instances of this class can then be used to actually read parameters from,
     or write parameters to the heating control device. A command queue is created
     and shared with the underlying protocol and commands can be sent to the device
-    through coroutines like `set_param()` or `get_param()`.
+    through coroutines like `set_param()` or `get_param()`. All data transferred from
+    or to the device is remembered in a `MemoryShadow`.
     """
 
-    def __init__(self, device: BaseHeatingControl, connection: OptolinkConnection):
+    def __init__(
+        self,
+        device: BaseHeatingControl,
+        connection: OptolinkConnection,
+        command_timeout: float = 10,
+        retries: int = 2,
+        retry_backoff: float = 0.5,
+        max_queue_size: int = 100,
+        max_queue_wait: float = None,
+    ):
         self.device = device
         self.connection = connection
-        self.commands = asyncio.Queue()
+        self.commands = CommandQueue(max_queue_size)
         self.protocol = self.device.get_protocol()
+        # commands are rejected early if they would have to wait longer than this
+        self.max_queue_wait = (
+            max_queue_wait if max_queue_wait is not None else command_timeout
+        )
+        # every command has to be answered within `command_timeout` seconds, failed
+        # attempts are repeated up to `retries` times with exponential backoff
+        self.command_timeout = command_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.shadow = MemoryShadow()
+        self._pending_reads: Dict[Tuple[bytes, int], _PendingRead] = dict()
+        self._write_locks: Dict[bytes, asyncio.Lock] = dict()
 
     @property
     def param_storage(self):
         return self.device.get_param_storage()
 
+    @property
+    def statistics(self):
+        return self.protocol.statistics
+
+    def estimate_wait(self, cmd: Command = None) -> float:
+        """Estimate the seconds until the answer to a command queued right now arrives."""
+        queued_bytes = self.commands.queued_bytes
+        if cmd is not None:
+            queued_bytes += get_transfer_size(cmd)
+        return self.statistics.estimate_transfer_time(queued_bytes)
+
+    def is_overloaded(self) -> bool:
+        """Whether new commands are currently rejected by the admission control."""
+        return self.commands.full() or self.estimate_wait() > self.max_queue_wait
+
     def get_param(self, param_id: str):
         return self.device.get_param_storage().get_parameter(param_id)
 
     async def set_param(self, param: Parameter, value: Any):
-        """Set a parameter of the heating control device to a given value"""
-        param, (address, offset), encoding = self.device.get_param_storage().get_storage(param)
+        """Set a parameter of the heating control device to a given value
+
+        Parameters with aligned addresses or only occupying some bits (like flags) are
+        written by reading the whole aligned data, replacing the parameter's bits and
+        writing it back. All writes to an address shared by several parameters are
+        serialized, so that such a read-modify-write cycle doesn't write back stale data.
+        """
+        self.validate_value(param, value)
+        storage = self.device.get_param_storage()
+        param, (address, offset), encoding = storage.get_storage(param)
+        now = datetime.now()
+        if offset != 0 or encoding.is_partial():
+            async with self._get_write_lock(address):
+                size = storage.get_read_size(
+                    AddressWithOffset(address, offset), encoding
+                )
+                word = bytearray(await self.read_address(address, size))
+                end = offset + encoding.get_size()
+                word[offset:end] = encoding.merge(bytes(word[offset:end]), value)
+                await self._write(address, bytes(word))
+        elif len(storage.get_parameters_at(address)) > 1:
+            # the first of the parameters stored at the address
+            async with self._get_write_lock(address):
+                await self._write(address, encoding.serialize(value))
+        else:
+            await self._write(address, encoding.serialize(value))
+        print(
+            f"Setting {param.id} took {(datetime.now() - now).total_seconds() * 1000:.0f}ms"
+        )
+        return True
+
+    def validate_value(self, param: Parameter, value: Any):
+        """Throws if the value cannot be written to the parameter"""
+        param, _, encoding = self.device.get_param_storage().get_storage(param)
         if param.is_read_only():
             raise Exception("Readonly parameter cannot be set!")
-        if offset != 0:
-            raise Exception("Parameter with aligned address cannot be set (for now)!")
         encoding.validate(value)
         param.unit.validate(value)
-        cmd = self.protocol.create_write_command(address, encoding.serialize(value))
-        now = datetime.now()
+
+    async def _write(self, address: bytes, data: bytes):
+        cmd = self.protocol.create_write_command(address, data)
         result = await self._execute_command(cmd)
         if not isinstance(result, Success):
             raise Exception("Failure setting parameter!")
-        print(
-            f"Setting {param.id} took {(datetime.now() - now).total_seconds() * 1000:.0f}ms"
-        )
-        return True
+        self.shadow.update(int.from_bytes(address, "big"), data)
+
+    def _get_write_lock(self, address: bytes) -> asyncio.Lock:
+        if address not in self._write_locks:
+            self._write_locks[address] = asyncio.Lock()
+        return self._write_locks[address]
 
     async def set_value(self, value: ParameterValue):
         """Shorthand for `set_param(param, value)`"""
@@ -55,32 +141,113 @@ class ViessmannConnection:
 
     async def read_param(self, param: Parameter) -> ParameterReading:
         """Read a parameter value from the heating control device"""
-        param, (address, offset), encoding = self.device.get_param_storage().get_storage(param)
-        cmd = self.protocol.create_read_command(address, offset + encoding.get_size())
+        storage = self.device.get_param_storage()
+        param, (address, offset), encoding = storage.get_storage(param)
+        size = storage.get_read_size(AddressWithOffset(address, offset), encoding)
         now = datetime.now()
-        result = await self._execute_command(cmd)
-        if not isinstance(result, Data):
-            raise Exception("Could not read parameter")
+        data = await self._read_shared(address, size)
         print(
             f"Reading {param.id} took {(datetime.now() - now).total_seconds() * 1000:.0f}ms"
         )
-        val = encoding.deserialize(result.value[offset:])
+        val = encoding.deserialize(data[offset : offset + encoding.get_size()])
         param.unit.validate(val)
         return ParameterReading.create_now(param, val)
 
-    async def read_address(self, address: bytes, size: int) -> bytes:
-        """Low-Level method directly reading bytes at a specific address from the heating control device."""
+    async def _read_shared(self, address: bytes, size: int) -> bytes:
+        """Read bytes, sharing a single command with concurrent reads of the same bytes"""
+        key = (address, size)
+        pending = self._pending_reads.get(key)
+        if pending is None:
+            task = asyncio.get_event_loop().create_task(self._read(address, size))
+            pending = self._pending_reads[key] = _PendingRead(task)
+
+            def done(task):
+                if self._pending_reads.get(key) is pending:
+                    del self._pending_reads[key]
+                if not task.cancelled():
+                    # mark a possible exception as retrieved
+                    task.exception()
+
+            task.add_done_callback(done)
+        pending.waiters += 1
+        try:
+            return await asyncio.shield(pending.task)
+        except asyncio.CancelledError:
+            if pending.waiters == 1:
+                pending.task.cancel()
+            raise
+        finally:
+            pending.waiters -= 1
+
+    async def _read(self, address: bytes, size: int) -> bytes:
+        cmd = self.protocol.create_read_command(address, size)
+        result = await self._execute_command(cmd)
+        if not isinstance(result, Data):
+            raise Exception("Could not read parameter")
+        self.shadow.update(int.from_bytes(address, "big"), result.value)
+        return result.value
+
+    def get_shadowed_reading(
+        self, param: Parameter, max_age_seconds: float = -1
+    ) -> Optional[ParameterReading]:
+        """Decode a parameter value from the memory shadow, if all its bytes are fresh"""
+        param, _, encoding = self.device.get_param_storage().get_storage(param)
+        address, size = self.param_storage.get_byte_range(param)
+        shadowed = self.shadow.get(address, size, max_age_seconds)
+        if shadowed is None:
+            return None
+        data, time = shadowed
+        try:
+            val = encoding.deserialize(data)
+            param.unit.validate(val)
+        except Exception:
+            # let reading from the device report the error
+            return None
+        return ParameterReading(param, val, time)
+
+    async def read_address(
+        self, address: bytes, size: int, max_age_seconds: float = None
+    ) -> bytes:
+        """Low-Level method directly reading bytes at a specific address from the heating control device.
+
+        If `max_age_seconds` is given, the bytes are taken from the memory shadow if they
+        are fresh enough.
+        """
+        if max_age_seconds is not None:
+            shadowed = self.shadow.get(
+                int.from_bytes(address, "big"), size, max_age_seconds
+            )
+            if shadowed is not None:
+                return shadowed[0]
         cmd = self.protocol.create_read_command(address, size)
         result = await self._execute_command(cmd)
         if not isinstance(result, Data):
             raise Exception("Could not read data at given address!")
+        self.shadow.update(int.from_bytes(address, "big"), result.value)
         return result.value
 
-    async def _execute_command(self, cmd: Command) -> bytes:
-        # put (cmd, future) tuple in command queue and await the future
-        fut = asyncio.Future()
-        self.commands.put_nowait((cmd, fut))
-        return await fut
+    async def _execute_command(self, cmd: Command) -> Answer:
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.command_timeout
+        for attempt in range(self.retries + 1):
+            estimated_wait = self.estimate_wait(cmd)
+            if estimated_wait > self.max_queue_wait or self.commands.full():
+                raise QueueOverloadedException(estimated_wait)
+            # put the command in the command queue and await the future
+            fut = loop.create_future()
+            self.commands.put_nowait(QueuedCommand(cmd, fut, deadline))
+            try:
+                return await asyncio.wait_for(fut, timeout=deadline - loop.time())
+            except asyncio.TimeoutError:
+                raise CommandTimeoutException(
+                    f"No answer from the heating control within {self.command_timeout}s"
+                )
+            except CommandFailedException as e:
+                backoff = self.retry_backoff * 2 ** attempt
+                if attempt == self.retries or loop.time() + backoff >= deadline:
+                    raise
+                print(f"Command failed ({e}), retrying in {backoff:.1f}s")
+                await asyncio.sleep(backoff)
 
     def start_communication(self):
         """Start the communication with the heating control device.
@@ -1,65 +1,807 @@
+import asyncio
+from collections import namedtuple
 from datetime import datetime, timedelta
-from typing import Any, Union
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+from .command import CommandTimeoutException
+from .command_queue import QueueOverloadedException, get_transfer_size
 from .connection import ViessmannConnection
-from .parameter import AggregatedParameter, Parameter, ParameterReading
+from .derived import DerivedParameter
+from .parameter import Parameter, ParameterReading
+from .prefetch import CoAccessTracker
+from .refresh_planner import RefreshPlanner
+from .scheduler import ScheduledWrite, WriteScheduler
+
+
+class CacheStatus(Enum):
+    """Describes how a read request has been answered by the `ConnectionCache`."""
+
+    # a fresh cached value was returned
+    HIT = "HIT"
+    # there was no usable cached value, the value was read from the device
+    MISS = "MISS"
+    # reading from the device was forced
+    BYPASS = "BYPASS"
+    # a stale cached value was returned, a refresh has been started in the background
+    STALE = "STALE"
+    # a stale cached value was returned because the device was too busy (or reading the
+    # parameter failed recently)
+    STALE_IF_BUSY = "STALE_IF_BUSY"
+
+
+# Caching behaviour of a parameter: cached values older than `max_age` seconds are reloaded
+# (never, if negative). Up to `stale_while_revalidate` seconds past `max_age`, the stale
+# value is still returned immediately while it is reloaded in the background. Writes are
+# delayed by `debounce` seconds, only the last value written meanwhile is sent. If `refresh`
+# is set, the value is read in the background every `refresh` seconds, parameters with a
+# lower `priority` are refreshed less often first if the bus is too busy. With `min_refresh`
+# and `max_refresh`, the interval adapts to how quickly the value changes.
+CachePolicy = namedtuple(
+    "CachePolicy",
+    [
+        "max_age",
+        "stale_while_revalidate",
+        "debounce",
+        "refresh",
+        "priority",
+        "min_refresh",
+        "max_refresh",
+    ],
+    defaults=[0, None, 0, None, None],
+)
+DEFAULT_CACHE_POLICY = CachePolicy(-1, 0)
+
+
+# Parameters read together by `read_params_with_status()` are read with a single command if
+# the gap between them is at most this many bytes, all of them belonging to configured
+# parameters, up to the given number of bytes per read
+_BATCH_MAX_GAP = 8
+_BATCH_MAX_SIZE = 32
+# a write equal to a cached value cached forever is only skipped within this many seconds
+# after reading it, as the value may have been changed on the device meanwhile (containers
+# written by `set_children()` are read again instead)
+_UNCHANGED_WINDOW = 10
+
+
+def _is_covered(ranges: List[Tuple[int, int]], start: int, end: int) -> bool:
+    """Whether the (address, size) ranges, sorted by address, cover start to end."""
+    for address, size in ranges:
+        if start >= end or address > start:
+            break
+        start = max(start, address + size)
+    return start >= end
+
+
+class ReadFailure:
+    """Remembers that reading a parameter failed, to back off from retrying it."""
+
+    def __init__(
+        self, error: Exception, count: int, since: datetime, retry_at: datetime
+    ):
+        self.error = error
+        self.count = count
+        self.since = since
+        self.retry_at = retry_at
+
+
+class ParameterBackoffException(Exception):
+    """Reading a parameter failed recently, it won't be retried before `retry_at`."""
+
+    def __init__(self, param_id: str, failure: ReadFailure):
+        super().__init__(
+            f"Reading {param_id} failed {failure.count} times, last error: "
+            f"{failure.error} (next try at {failure.retry_at.isoformat()})"
+        )
+        self.failure = failure
+
+
+class _PendingWrite:
+    def __init__(self, value: Any, future: asyncio.Future):
+        self.value = value
+        # resolved for all callers once the last value has been written
+        self.future = future
+
+
+class CacheListener:
+    """Gets notified by the `ConnectionCache` about changes of cached values."""
+
+    def value_stored(self, reading: ParameterReading):
+        pass
+
+    def value_invalidated(self, param_id: str):
+        pass
+
+
+class _PendingLoad:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        # a background refresh is kept running even if nobody waits for it
+        self.background = False
 
 
 class ConnectionCache:
-    """Proxy class wrapping a `ViessmannConnection` and caching values."""
+    """Proxy class wrapping a `ViessmannConnection` and caching values.
+
+    Concurrent reads of the same parameter share a single command sent to the device.
+    Failing reads are cached as well: after a failure, a parameter is not read again before
+    `failure_backoff` seconds have passed, doubling with every further failure up to
+    `max_failure_backoff` seconds. Forced reads ignore this backoff.
 
-    def __init__(self, conn: ViessmannConnection):
+    Parameters with a `refresh` interval are kept fresh by a `RefreshPlanner`, using up to
+    `refresh_bus_share` of the bus capacity.
+
+    The cache learns which parameters are usually requested within `prefetch_window`
+    seconds after each other. When a parameter has to be read, the stale ones likely
+    requested next are queued right after it, to be read in the same bus session, up to
+    `prefetch_budget` bytes per read (0 disables prefetching).
+
+    If a `HistoryStore` is given, it records the values stored in the cache. If an
+    `AlertEngine` is given, its rules are evaluated on them.
+
+    Deferred writes are executed by a `WriteScheduler`, persisted in `write_journal` if
+    given.
+    """
+
+    def __init__(
+        self,
+        conn: ViessmannConnection,
+        policies: Dict[str, CachePolicy] = None,
+        failure_backoff: float = 10,
+        max_failure_backoff: float = 3600,
+        refresh_bus_share: float = 0.5,
+        refresh_max_stretch: float = 10,
+        prefetch_budget: int = 0,
+        prefetch_window: float = 10,
+        history=None,
+        alerts=None,
+        write_journal: str = None,
+    ):
         self.conn = conn
         self.values = dict()
+        self.policies = policies or dict()
+        self.failures: Dict[str, ReadFailure] = dict()
+        self.failure_backoff = failure_backoff
+        self.max_failure_backoff = max_failure_backoff
+        self._pending_loads: Dict[str, _PendingLoad] = dict()
+        self.listeners: List[CacheListener] = []
+        self._pending_writes: Dict[str, _PendingWrite] = dict()
+        # derived parameters to recompute when the value of a parameter is stored
+        self._dependents: Dict[str, List[DerivedParameter]] = dict()
+        for derived in self.param_storage.derived_parameters.values():
+            for input_id in derived.inputs:
+                self._dependents.setdefault(input_id, []).append(derived)
+        self.prefetch_budget = prefetch_budget
+        self.co_access = CoAccessTracker(prefetch_window)
+        self.history = history
+        if history is not None:
+            self.add_listener(history)
+        self.alerts = alerts
+        if alerts is not None:
+            self.add_listener(alerts)
+        self.refresh_planner = RefreshPlanner(
+            self, refresh_bus_share, refresh_max_stretch
+        )
+        self.scheduler = WriteScheduler(self, write_journal)
 
     @property
     def param_storage(self):
         return self.conn.param_storage
 
+    def add_listener(self, listener: CacheListener):
+        self.listeners.append(listener)
+
+    async def get_queue_status(self) -> dict:
+        """Describe the load of the command queue and the bus."""
+        statistics = self.conn.statistics
+        return {
+            "depth": self.conn.commands.qsize(),
+            "max_depth": self.conn.commands.maxsize,
+            "queued_bytes": self.conn.commands.queued_bytes,
+            "estimated_wait": self.conn.estimate_wait(),
+            "wait_budget": self.conn.max_queue_wait,
+            "overloaded": self.conn.is_overloaded(),
+            "utilization": statistics.get_utilization(),
+            "seconds_per_byte": statistics.seconds_per_byte,
+            "sync_interval": statistics.sync_interval,
+            "commands": statistics.get_counts(),
+        }
+
+    async def get_failures(self) -> Dict[str, ReadFailure]:
+        return dict(self.failures)
+
+    async def get_prefetch_status(self) -> dict:
+        """Describe how the requests have been answered and how prefetching helped."""
+        return self.co_access.get_status()
+
+    async def get_history(
+        self, param_id: str, start: datetime, end: datetime, limit: int = None
+    ) -> List[Tuple[datetime, Any]]:
+        """Return the (first `limit`) recorded values of a parameter within the time range."""
+        if self.history is None:
+            raise Exception("History is not enabled")
+        self.conn.get_param(param_id)
+        return self.history.get_history(param_id, start, end, limit)
+
+    async def get_history_buckets(
+        self, param_id: str, start: datetime, end: datetime, step: float
+    ) -> Tuple[Optional[int], list]:
+        """Aggregate the recorded values of a parameter into buckets of `step` seconds.
+
+        Returns the resolution of the rollup used (`None` if aggregated from the raw values)
+        and the `HistoryBucket`s.
+        """
+        if self.history is None:
+            raise Exception("History is not enabled")
+        self.conn.get_param(param_id)
+        return self.history.get_buckets(param_id, start, end, step)
+
+    async def get_history_status(self) -> Dict[str, dict]:
+        """Describe the recorded history of every parameter."""
+        if self.history is None:
+            raise Exception("History is not enabled")
+        return self.history.get_status()
+
+    async def get_alerts(self) -> dict:
+        """Describe the state of every alert rule and the latest state transitions."""
+        if self.alerts is None:
+            raise Exception("Alerts are not enabled")
+        return self.alerts.get_status()
+
+    async def get_refresh_report(self) -> dict:
+        """Describe the planned and the achieved freshness of the refreshed parameters."""
+        return self.refresh_planner.get_report()
+
+    def start_refreshing(self):
+        """Start refreshing the parameters with a `refresh` interval in the background."""
+        asyncio.get_event_loop().create_task(self.refresh_planner.run())
+
+    def start_scheduler(self):
+        """Start writing the scheduled values when they are due."""
+        self.scheduler.start()
+
+    async def schedule_write(
+        self,
+        key: str,
+        param_id: str,
+        value: Any,
+        due: datetime,
+        interval: float = None,
+        replace: bool = True,
+    ) -> ScheduledWrite:
+        """Write a value at `due` (and every `interval` seconds after it, if given).
+
+        A pending write with the same key is replaced, unless `replace` is false.
+        """
+        return await self.scheduler.schedule(
+            ScheduledWrite(key, param_id, value, due, interval), replace
+        )
+
+    async def cancel_scheduled_write(self, key: str) -> Optional[ScheduledWrite]:
+        return await self.scheduler.cancel(key)
+
+    async def run_scheduled_write(self, key: str):
+        """Execute a scheduled write right away instead of when it is due."""
+        await self.scheduler.run_now(key)
+
+    async def get_scheduled_write(self, key: str) -> Optional[ScheduledWrite]:
+        return self.scheduler.jobs.get(key)
+
+    async def get_scheduled_writes(self) -> Dict[str, ScheduledWrite]:
+        return dict(self.scheduler.jobs)
+
+    async def get_scheduled_write_completion(self, key: str) -> Optional[datetime]:
+        """Return when the last write scheduled as `key` was executed (since startup)."""
+        return self.scheduler.completed.get(key)
+
+    def get_cached_reading(self, param_id: str) -> Optional[ParameterReading]:
+        """Return the cached reading of a parameter, regardless of its age."""
+        return self._get_reading(param_id)
+
+    def get_policy(self, param_id: str) -> CachePolicy:
+        # child parameters share the policy of their container
+        container = param_id.split(".")[0]
+        return self.policies.get(
+            param_id, self.policies.get(container, DEFAULT_CACHE_POLICY)
+        )
+
     async def read_param(
         self,
         param: Union[Parameter, str],
         force: bool = False,
-        max_age_seconds: int = -1,
+        max_age_seconds: int = None,
+        allow_stale: bool = False,
     ) -> ParameterReading:
         """Read a parameter value from the heating control device or from the cache.
 
         The normal behaviour is that if a cached value is present, it is returned, otherwise
         the value is read directly from the heating control device. Re-reading the value can
-        be forced by parameters `force` or `max_age_seconds`.
+        be forced by parameters `force` or `max_age_seconds`, the latter defaulting to the
+        parameter's `CachePolicy`. If `allow_stale` is set, a cached value is returned
+        instead of failing when the device is too busy or reading the parameter is backing
+        off after failures.
         """
+        reading, _ = await self.read_param_with_status(
+            param, force, max_age_seconds, allow_stale
+        )
+        return reading
+
+    async def read_param_with_status(
+        self,
+        param: Union[Parameter, str],
+        force: bool = False,
+        max_age_seconds: int = None,
+        allow_stale: bool = False,
+    ) -> Tuple[ParameterReading, CacheStatus]:
+        """Same as `read_param()`, but also tells how the request has been answered."""
         param_id = param if isinstance(param, str) else param.id
+        reading, status = await self._read_param_with_status(
+            param_id, force, max_age_seconds, allow_stale
+        )
+        self.co_access.record_request(param_id, status.value)
+        return reading, status
+
+    async def refresh_param(
+        self, param_id: str, max_age_seconds: int = None
+    ) -> ParameterReading:
+        """Read a parameter to keep its cached value fresh.
+
+        Unlike `read_param()`, this does not count as a request, so nothing is learned or
+        prefetched from it.
+        """
+        reading, _ = await self._read_param_with_status(
+            param_id, False, max_age_seconds, False, prefetch=False
+        )
+        return reading
+
+    async def _read_param_with_status(
+        self,
+        param_id: str,
+        force: bool,
+        max_age_seconds: Optional[int],
+        allow_stale: bool,
+        prefetch: bool = True,
+    ) -> Tuple[ParameterReading, CacheStatus]:
+        if self.param_storage.is_derived(param_id):
+            return await self._read_derived(param_id, max_age_seconds, allow_stale)
+        policy = self.get_policy(param_id)
+        if max_age_seconds is None:
+            max_age_seconds = policy.max_age
         current_reading = self._get_reading(param_id)
-        must_reload = (
-            not current_reading
-            or force
-            or max_age_seconds > 0
-            and current_reading.time
-            < datetime.now() - timedelta(seconds=max_age_seconds)
-        )
-        if not must_reload:
-            return current_reading
+        if current_reading and not force:
+            if max_age_seconds < 0:
+                return current_reading, CacheStatus.HIT
+            age = (datetime.now() - current_reading.time).total_seconds()
+            if age <= max_age_seconds:
+                return current_reading, CacheStatus.HIT
+            if age <= max_age_seconds + policy.stale_while_revalidate:
+                if not self._get_backoff(param_id):
+                    self._refresh_in_background(param_id)
+                return current_reading, CacheStatus.STALE
+        if not force:
+            # the value may have been transferred along with other data meanwhile
+            reading = self.conn.get_shadowed_reading(
+                self.conn.get_param(param_id), max_age_seconds
+            )
+            if reading is not None:
+                self._store(reading)
+                return reading, CacheStatus.HIT
+        failure = self._get_backoff(param_id)
+        if failure and not force:
+            if allow_stale and current_reading:
+                return current_reading, CacheStatus.STALE_IF_BUSY
+            raise ParameterBackoffException(param_id, failure)
         # now reload
+        if prefetch and param_id not in self._pending_loads:
+            self._start_load(param_id)
+            self._prefetch_followers(param_id)
+        try:
+            reading = await self._wait_for_load(param_id)
+        except (QueueOverloadedException, CommandTimeoutException):
+            if allow_stale and current_reading:
+                return current_reading, CacheStatus.STALE_IF_BUSY
+            raise
+        return reading, CacheStatus.BYPASS if force else CacheStatus.MISS
+
+    async def read_params_with_status(
+        self,
+        param_ids: List[str],
+        force: bool = False,
+        allow_stale: bool = False,
+    ) -> List[Union[Tuple[ParameterReading, CacheStatus], Exception]]:
+        """Read multiple parameters as close together in time as possible.
+
+        All parameters which have to be reloaded are queued at once, so that they are
+        transferred in a single bus session. Parameters stored close to each other are
+        read with a single command. For every parameter, either its reading and status or
+        the exception raised when reading it are returned.
+        """
+        start = datetime.now()
+        to_load = [
+            param_id
+            for param_id in self._resolve_inputs(param_ids)
+            if force or not self._is_fresh(param_id)
+        ]
+        # parameters in backoff or already being read are left to `read_param_with_status()`
+        planned = [
+            param_id
+            for param_id in to_load
+            if self._can_batch(param_id)
+            and param_id not in self._pending_loads
+            and (force or not self._get_backoff(param_id))
+        ]
+        results = dict()
+
+        async def load(param_id):
+            try:
+                results[param_id] = await self.read_param_with_status(
+                    param_id, force, allow_stale=allow_stale
+                )
+            except Exception as e:
+                results[param_id] = e
+
+        await asyncio.gather(
+            *(
+                self.conn.read_address(address.to_bytes(2, "big"), size)
+                for address, size in self._plan_reads(planned)
+            ),
+            *(load(param_id) for param_id in to_load if param_id not in planned),
+            return_exceptions=True,
+        )
+        elapsed = (datetime.now() - start).total_seconds()
+        for param_id in planned:
+            reading = self.conn.get_shadowed_reading(
+                self.conn.get_param(param_id), elapsed
+            )
+            if reading is not None:
+                self.failures.pop(param_id, None)
+                self._store(reading)
+                results[param_id] = reading, (
+                    CacheStatus.BYPASS if force else CacheStatus.MISS
+                )
+
+        async def get(param_id):
+            if param_id in results:
+                if isinstance(results[param_id], Exception):
+                    raise results[param_id]
+                return results[param_id]
+            # fresh, derived or not read by the planned commands
+            return await self.read_param_with_status(
+                param_id, force=force and param_id in to_load, allow_stale=allow_stale
+            )
+
+        return await asyncio.gather(
+            *(get(param_id) for param_id in param_ids), return_exceptions=True
+        )
+
+    def _resolve_inputs(self, param_ids: List[str]) -> List[str]:
+        """Replace derived parameters by the parameters they are computed from."""
+        resolved = []
+        for param_id in param_ids:
+            if self.param_storage.is_derived(param_id):
+                derived = self.param_storage.get_parameter(param_id)
+                param_ids_to_add = self._resolve_inputs(derived.inputs)
+            else:
+                param_ids_to_add = [param_id]
+            resolved += [it for it in param_ids_to_add if it not in resolved]
+        return resolved
+
+    def _is_fresh(self, param_id: str) -> bool:
+        max_age = self.get_policy(param_id).max_age
+        reading = self._get_reading(param_id)
+        if reading is not None and (
+            max_age < 0 or (datetime.now() - reading.time).total_seconds() <= max_age
+        ):
+            return True
+        param = self.conn.get_param(param_id)
+        return self.conn.get_shadowed_reading(param, max_age) is not None
+
+    def _can_batch(self, param_id: str) -> bool:
+        # parameters at aligned addresses have to be read on their own
+        _, (address, offset), encoding = self.param_storage.get_storage(param_id)
+        size = encoding.get_size()
+        return (
+            offset == 0
+            and self.param_storage.read_sizes.get(address, size) == size
+            and size <= _BATCH_MAX_SIZE
+        )
+
+    def _plan_reads(self, param_ids: List[str]) -> List[Tuple[int, int]]:
+        """Merge the byte ranges of the parameters into as few reads as reasonable.
+
+        Bytes not belonging to any configured parameter are never read.
+        """
+        configured = sorted(
+            self.param_storage.get_byte_range(param_id)
+            for param_id in self.param_storage.parameters
+        )
+        reads = []
+        for address, size in sorted(
+            self.param_storage.get_byte_range(param_id) for param_id in param_ids
+        ):
+            if reads:
+                last_address, last_size = reads[-1]
+                end = max(last_address + last_size, address + size)
+                gap_start = last_address + last_size
+                if (
+                    address - gap_start <= _BATCH_MAX_GAP
+                    and end - last_address <= _BATCH_MAX_SIZE
+                    and _is_covered(configured, gap_start, address)
+                ):
+                    reads[-1] = last_address, end - last_address
+                    continue
+            reads.append((address, size))
+        return reads
+
+    async def _read_derived(
+        self, param_id: str, max_age_seconds: Optional[int], allow_stale: bool
+    ) -> Tuple[ParameterReading, CacheStatus]:
+        """Compute a derived parameter from its inputs, which are read as usual.
+
+        Forcing reads is not passed on to the inputs, computing never costs extra reads.
+        """
+        param = self.param_storage.get_parameter(param_id)
+        results = await asyncio.gather(
+            *(
+                self.read_param_with_status(
+                    input_id, max_age_seconds=max_age_seconds, allow_stale=allow_stale
+                )
+                for input_id in param.inputs
+            )
+        )
+        reading = param.compute([reading for reading, _ in results])
+        self._store(reading)
+        statuses = {status for _, status in results}
+        for status in [CacheStatus.MISS, CacheStatus.STALE_IF_BUSY, CacheStatus.STALE]:
+            if status in statuses:
+                return reading, status
+        return reading, CacheStatus.HIT
+
+    def _start_load(self, param_id: str) -> _PendingLoad:
+        pending = self._pending_loads.get(param_id)
+        if pending is None:
+            task = asyncio.get_event_loop().create_task(self._load(param_id))
+            pending = self._pending_loads[param_id] = _PendingLoad(task)
+
+            def done(task):
+                if self._pending_loads.get(param_id) is pending:
+                    del self._pending_loads[param_id]
+                if not task.cancelled():
+                    # mark a possible exception as retrieved
+                    task.exception()
+
+            task.add_done_callback(done)
+        return pending
+
+    async def _wait_for_load(self, param_id: str) -> ParameterReading:
+        pending = self._start_load(param_id)
+        pending.waiters += 1
+        try:
+            return await asyncio.shield(pending.task)
+        except asyncio.CancelledError:
+            # if nobody is interested in the value anymore, don't occupy the device with it
+            if pending.waiters == 1 and not pending.background:
+                pending.task.cancel()
+            raise
+        finally:
+            pending.waiters -= 1
+
+    def _refresh_in_background(self, param_id: str):
+        self._start_load(param_id).background = True
+
+    def _prefetch_followers(self, param_id: str):
+        """Start reading the stale parameters likely requested after the given one."""
+        if self.prefetch_budget <= 0 or self.conn.is_overloaded():
+            return
+        budget = self.prefetch_budget
+        for follower, _ in self.co_access.get_likely_next(param_id):
+            if (
+                self.param_storage.is_derived(follower)
+                or follower in self._pending_loads
+                or self._get_backoff(follower)
+                or self._is_fresh(follower)
+            ):
+                continue
+            _, address, encoding = self.param_storage.get_storage(follower)
+            size = get_transfer_size(
+                self.conn.protocol.create_read_command(
+                    address.address, self.param_storage.get_read_size(address, encoding)
+                )
+            )
+            if size > budget:
+                continue
+            budget -= size
+            self._refresh_in_background(follower)
+            self.co_access.record_prefetch(follower, size)
+
+    async def _load(self, param_id: str) -> ParameterReading:
         param_to_load = self.conn.get_param(param_id)
-        self.values[param_id] = await self.conn.read_param(param_to_load)
-        self._invalidate_children(param_to_load)
-        return self.values[param_id]
+        try:
+            reading = await self.conn.read_param(param_to_load)
+        except (QueueOverloadedException, CommandTimeoutException):
+            # the bus is congested, not the parameter's fault
+            raise
+        except Exception as e:
+            self._record_failure(param_id, e)
+            raise
+        self.failures.pop(param_id, None)
+        self._store(reading)
+        self._invalidate_overlapping(param_id)
+        self._store_read_along(param_id)
+        return reading
+
+    def _get_backoff(self, param_id: str) -> Optional[ReadFailure]:
+        """Return the last failure of a parameter if it must not be read again yet."""
+        failure = self.failures.get(param_id)
+        if failure and datetime.now() < failure.retry_at:
+            return failure
+        return None
+
+    def _record_failure(self, param_id: str, error: Exception):
+        previous = self.failures.get(param_id)
+        count = previous.count + 1 if previous else 1
+        backoff = min(self.failure_backoff * 2 ** (count - 1), self.max_failure_backoff)
+        now = datetime.now()
+        self.failures[param_id] = ReadFailure(
+            error,
+            count,
+            previous.since if previous else now,
+            now + timedelta(seconds=backoff),
+        )
+
+    async def read_address(
+        self, address: bytes, size: int, max_age_seconds: float = None
+    ) -> bytes:
+        """Read bytes at a specific address from the heating control device.
+
+        If `max_age_seconds` is given, fresh enough bytes are taken from the memory shadow.
+        """
+        return await self.conn.read_address(address, size, max_age_seconds)
 
     async def set_param(self, param: Union[Parameter, str], value: Any):
-        """Write a value to the heating control device and cache it for later requests."""
+        """Write a value to the heating control device and cache it for later requests.
+
+        Nothing is sent if the value equals a recent cached one. If the parameter's
+        `CachePolicy` defines a debounce window, the write is delayed and only the last value
+        set within the window is sent, completing all of the calls at once.
+        """
         param_to_set = self.conn.get_param(
             param if isinstance(param, str) else param.id
         )
-        await self.conn.set_param(param_to_set, value)
+        if param_to_set.is_read_only():
+            raise Exception("Readonly parameter cannot be set!")
+        debounce = self.get_policy(param_to_set.id).debounce
+        if debounce <= 0:
+            if not self._is_unchanged(param_to_set, value):
+                await self._write(param_to_set, value)
+            return
+        self.conn.validate_value(param_to_set, value)
+        pending = self._pending_writes.get(param_to_set.id)
+        if pending is None:
+            if self._is_unchanged(param_to_set, value):
+                return
+            pending = _PendingWrite(value, asyncio.get_event_loop().create_future())
+            self._pending_writes[param_to_set.id] = pending
+            asyncio.get_event_loop().create_task(
+                self._write_debounced(param_to_set, debounce)
+            )
+        else:
+            pending.value = value
+        await asyncio.shield(pending.future)
+
+    async def set_children(
+        self, container: Union[Parameter, str], values: Dict[int, Any]
+    ) -> List[int]:
+        """Write some children of a container, e.g. days of a control program.
+
+        Only the children differing from the container's current value are sent, each with
+        a separate command. The container is read once for comparing, unless its cached
+        value is recent. If all children are given and writing the whole container takes
+        fewer bytes on the bus (e.g. because most children changed), it is written with a
+        single command instead. Returns the indices of the changed children.
+        """
+        container = self.conn.get_param(
+            container if isinstance(container, str) else container.id
+        )
+        if container.is_read_only():
+            raise Exception("Readonly parameter cannot be set!")
+        children = {index: container.get_child_param(index) for index in sorted(values)}
+        for index, child in children.items():
+            self.conn.validate_value(child, values[index])
+        try:
+            # a single read is much cheaper than writing unchanged children
+            current, _ = await self._read_param_with_status(
+                container.id, False, _UNCHANGED_WINDOW, False, prefetch=False
+            )
+            changed = [
+                index for index in children if values[index] != current.value[index]
+            ]
+        except QueueOverloadedException:
+            raise
+        except Exception:
+            # the current value is unknown, write all of the given children
+            changed = list(children)
+        if not changed:
+            return changed
+        children_size = sum(self._get_write_size(children[index]) for index in changed)
+        # cached values of the other children may be outdated, they are never written back
+        if (
+            len(values) == container.child_count
+            and self._get_write_size(container) < children_size
+        ):
+            await self._write(
+                container, [values[index] for index in range(container.child_count)]
+            )
+        else:
+            for index in changed:
+                await self._write(children[index], values[index])
+        return changed
+
+    def _get_write_size(self, param: Parameter) -> int:
+        _, (address, _), encoding = self.param_storage.get_storage(param)
+        command = self.conn.protocol.create_write_command(
+            address, bytes(encoding.get_size())
+        )
+        return get_transfer_size(command)
+
+    async def _write_debounced(self, param: Parameter, debounce: float):
+        await asyncio.sleep(debounce)
+        pending = self._pending_writes.pop(param.id)
+        try:
+            if not self._is_unchanged(param, pending.value):
+                await self._write(param, pending.value)
+        except Exception as e:
+            pending.future.set_exception(e)
+            # mark the exception as retrieved, the callers may be gone
+            pending.future.exception()
+        else:
+            pending.future.set_result(None)
+
+    def _is_unchanged(self, param: Parameter, value: Any) -> bool:
+        """Whether the value equals the recent cached value of the parameter.
+
+        The cached value counts if it is not older than the parameter's `max_age`, or
+        `_UNCHANGED_WINDOW` seconds if it is cached forever.
+        """
+        reading = self._get_reading(param.id)
+        if reading is None:
+            return False
+        max_age = self.get_policy(param.id).max_age
+        if max_age < 0:
+            max_age = _UNCHANGED_WINDOW
+        if (datetime.now() - reading.time).total_seconds() > max_age:
+            return False
+        return value == reading.value
+
+    async def _write(self, param: Parameter, value: Any):
+        await self.conn.set_param(param, value)
         # if set_param() completed without an error, assume the value has been written
         # to the device
-        self.values[param_to_set.id] = ParameterReading.create_now(param_to_set, value)
-        self._invalidate_children(param_to_set)
-        # invalidate parent if child param was set
-        if "." in param_to_set.id:
-            container = param_to_set.id.split(".")[0]
-            if container in self.values:
-                del self.values[container]
+        self._store(ParameterReading.create_now(param, value))
+        self._invalidate_overlapping(param.id)
+
+    def _store(self, reading: ParameterReading):
+        self.values[reading.parameter.id] = reading
+        for listener in self.listeners:
+            listener.value_stored(reading)
+        self._update_derived(reading)
+
+    def _update_derived(self, reading: ParameterReading):
+        """Recompute the derived parameters using the stored value, if all inputs are cached."""
+        for derived in self._dependents.get(reading.parameter.id, []):
+            readings = [self._get_reading(input_id) for input_id in derived.inputs]
+            if None in readings:
+                continue
+            try:
+                self._store(derived.compute(readings))
+            except Exception as e:
+                print(f"Could not compute {derived.id}: {e}")
+
+    def _invalidate(self, param_id: str):
+        self.values.pop(param_id, None)
+        for listener in self.listeners:
+            listener.value_invalidated(param_id)
 
     def _get_reading(self, param_id: str):
         if param_id in self.values:
@@ -75,10 +817,25 @@ class ConnectionCache:
                 )
         return None
 
-    def _invalidate_children(self, param: Parameter):
-        if isinstance(param, AggregatedParameter):
-            for index in range(param.child_count):
-                try:
-                    del self.values[f"{param.id}.{index}"]
-                except KeyError:
-                    pass
+    def _store_read_along(self, param_id: str):
+        """Cache the parameters which have been read together with the given one."""
+        _, (address, _), _ = self.param_storage.get_storage(param_id)
+        for other in self.param_storage.get_parameters_at(address):
+            if other.id != param_id:
+                reading = self.conn.get_shadowed_reading(other)
+                if reading is not None:
+                    self._store(reading)
+
+    def _invalidate_overlapping(self, param_id: str):
+        """Drop the cached values sharing bytes with the given parameter.
+
+        They are decoded from the memory shadow again when needed. This also covers
+        containers and their children.
+        """
+        address, size = self.param_storage.get_byte_range(param_id)
+        for other_id in list(self.values):
+            if other_id == param_id or self.param_storage.is_derived(other_id):
+                continue
+            other_address, other_size = self.param_storage.get_byte_range(other_id)
+            if other_address < address + size and address < other_address + other_size:
+                self._invalidate(other_id)
@@ -0,0 +1,143 @@
+import ast
+import operator
+from typing import Any, Dict, List
+
+from .parameter import Parameter, ParameterReading
+from .unit import Unit
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Not: operator.not_,
+}
+_COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+_FUNCTIONS = {"abs": abs, "min": min, "max": max, "round": round}
+
+
+class InvalidExpressionException(Exception):
+    pass
+
+
+class Expression:
+    """Arithmetic expression over parameter ids, e.g. `temp_flow - temp_return`.
+
+    Only numbers, parameter ids, arithmetic operators, comparisons, `and`/`or`/`not`,
+    conditional expressions (`a if condition else b`) and the functions `abs`, `min`, `max`
+    and `round` are allowed.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        try:
+            self.tree = ast.parse(source, mode="eval").body
+        except SyntaxError as e:
+            raise InvalidExpressionException(f"Invalid expression '{source}': {e}")
+        # ids of the parameters used by the expression
+        self.names = set()
+        self._check(self.tree)
+
+    def evaluate(self, values: Dict[str, Any]) -> Any:
+        return self._evaluate(self.tree, values)
+
+    def _check(self, node: ast.AST):
+        if isinstance(node, ast.Name):
+            self.names.add(node.id)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS:
+                raise InvalidExpressionException(
+                    f"Only the functions {', '.join(_FUNCTIONS)} can be called"
+                )
+            if node.keywords:
+                raise InvalidExpressionException("Keyword arguments are not supported")
+            for arg in node.args:
+                self._check(arg)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            pass
+        elif (
+            isinstance(node, ast.BinOp)
+            and type(node.op) in _BINARY_OPERATORS
+            or isinstance(node, ast.UnaryOp)
+            and type(node.op) in _UNARY_OPERATORS
+            or isinstance(node, ast.Compare)
+            and all(type(op) in _COMPARISONS for op in node.ops)
+            or isinstance(node, (ast.BoolOp, ast.IfExp))
+        ):
+            for child in ast.iter_child_nodes(node):
+                if not isinstance(
+                    child, (ast.operator, ast.unaryop, ast.cmpop, ast.boolop)
+                ):
+                    self._check(child)
+        else:
+            raise InvalidExpressionException(
+                f"Unsupported element '{ast.unparse(node)}' in '{self.source}'"
+            )
+
+    def _evaluate(self, node: ast.AST, values: Dict[str, Any]) -> Any:
+        if isinstance(node, ast.Name):
+            return values[node.id]
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.BinOp):
+            return _BINARY_OPERATORS[type(node.op)](
+                self._evaluate(node.left, values), self._evaluate(node.right, values)
+            )
+        if isinstance(node, ast.UnaryOp):
+            return _UNARY_OPERATORS[type(node.op)](self._evaluate(node.operand, values))
+        if isinstance(node, ast.Compare):
+            left = self._evaluate(node.left, values)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self._evaluate(comparator, values)
+                if not _COMPARISONS[type(op)](left, right):
+                    return False
+                left = right
+            return True
+        if isinstance(node, ast.BoolOp):
+            result = None
+            for value in node.values:
+                result = self._evaluate(value, values)
+                if isinstance(node.op, ast.And) != bool(result):
+                    break
+            return result
+        if isinstance(node, ast.IfExp):
+            if self._evaluate(node.test, values):
+                return self._evaluate(node.body, values)
+            return self._evaluate(node.orelse, values)
+        # only calls are left after checking the expression
+        return _FUNCTIONS[node.func.id](
+            *(self._evaluate(arg, values) for arg in node.args)
+        )
+
+
+class DerivedParameter(Parameter):
+    """Parameter computed from the values of other parameters instead of being read."""
+
+    def __init__(self, name: str, id: str, unit: Unit, expression: Expression):
+        super().__init__(name, id, unit, readonly=True)
+        self.expression = expression
+
+    @property
+    def inputs(self) -> List[str]:
+        return sorted(self.expression.names)
+
+    def compute(self, readings: List[ParameterReading]) -> ParameterReading:
+        """Compute the value from readings of the inputs, it is as old as the oldest one."""
+        value = self.expression.evaluate(
+            {reading.parameter.id: reading.value for reading in readings}
+        )
+        return ParameterReading(self, value, min(reading.time for reading in readings))
@@ -2,15 +2,18 @@ import asyncio
 from datetime import datetime
 from collections import defaultdict
 
+from .command import P300Command, p300_checksum
+
 
 class HeatingDummy:
     """
-    Emulates a serial connection to a heating control device speaking KW.
+    Emulates a serial connection to a heating control device speaking KW or P300.
     Can be used for testing purposes instead of an OptolinkConnection.
     """
 
-    def __init__(self, loop: asyncio.AbstractEventLoop):
+    def __init__(self, loop: asyncio.AbstractEventLoop, protocol: str = "KW"):
         self.loop = loop
+        self.protocol = protocol
         # here the dummy devices writes its data
         self.send_queue = asyncio.Queue()
         # here the data sent to the dummy device gets stored
@@ -19,6 +22,12 @@ class HeatingDummy:
         self.loop.create_task(self.run())
 
     async def run(self):
+        if self.protocol == "P300":
+            await self._run_p300()
+        else:
+            await self._run_kw()
+
+    async def _run_kw(self):
         while True:
             last_sync_byte = datetime.now()
             self._send(b"\x05")
@@ -55,6 +64,51 @@ class HeatingDummy:
             self.storage[addr + index] = value
         self._send(b"\x00")
 
+    async def _run_p300(self):
+        while True:
+            # until a session is started, behave like a KW device
+            self._send(b"\x05")
+            try:
+                (b,) = await self._recv(1, 2)
+                if b == 0x16 and await self._recv(2, 0.1) == b"\x00\x00":
+                    self._send(b"\x06")
+                    await self._p300_session()
+            except asyncio.TimeoutError:
+                pass
+
+    async def _p300_session(self):
+        while True:
+            b = await self.read_queue.get()
+            if b == 0x04:
+                # reset, fall back to sending synchronization bytes
+                return
+            elif b == 0x16:
+                await self._recv(2, 0.1)
+                self._send(b"\x06")
+            elif b == 0x41:
+                (length,) = await self._recv(1, 0.1)
+                telegram = await self._recv(length + 1, 0.1)
+                if p300_checksum(bytes([length]) + telegram[:-1]) != telegram[-1]:
+                    self._send(b"\x15")
+                    continue
+                self._send(b"\x06")
+                self._send(self._handle_p300_telegram(telegram[:-1]))
+                # the response is acknowledged by the host
+                await self._recv(1, 0.5)
+
+    def _handle_p300_telegram(self, telegram: bytearray) -> bytes:
+        _, function, addr1, addr2, size = telegram[:5]
+        addr = int.from_bytes(bytes([addr1, addr2]), byteorder="big")
+        data = b""
+        if function == P300Command.READ:
+            data = bytes(self.storage[addr + i] for i in range(size))
+        elif function == P300Command.WRITE:
+            for index, value in enumerate(telegram[5 : 5 + size]):
+                self.storage[addr + index] = value
+        payload = bytes([P300Command.RESPONSE, function, addr1, addr2, size]) + data
+        response = bytes([len(payload)]) + payload
+        return b"\x41" + response + bytes([p300_checksum(response)])
+
     def _send(self, b: bytes):
         for byte in b:
             self.send_queue.put_nowait(byte)
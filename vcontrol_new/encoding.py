@@ -7,7 +7,8 @@ class Encoding:
     """Representation of the data format of a value on a heating control device
 
     Defines how values are converted back and forth between their python representation
-    and the actual bytes stored in the heating control device.
+    and the actual bytes stored in the heating control device. Deserializing the serialized
+    value has to return the same value, as values are passed between processes this way.
     """
 
     def serialize(self, data: Any) -> bytes:
@@ -35,6 +36,20 @@ class Encoding:
         """
         raise NotImplementedError
 
+    def is_partial(self) -> bool:
+        """
+        Whether the value only occupies some bits of its bytes, so that writing it requires
+        the current bytes (see `merge()`)
+        """
+        return False
+
+    def merge(self, data: bytes, value: Any) -> bytes:
+        """
+        Return the bytes `data` currently stored on the heating control, updated to contain
+        the given value
+        """
+        return self.serialize(value)
+
 
 class FloatEncoding(Encoding):
     def __init__(self, size: int, divisor: int):
@@ -46,7 +61,10 @@ class FloatEncoding(Encoding):
 
     def serialize(self, data: Any) -> bytes:
         self.validate(data)
-        return int(data * self.divisor).to_bytes(length=self.size, byteorder="little")
+        # round, as e.g. 2.3 * 10 results in 22.999999999999996
+        return round(data * self.divisor).to_bytes(
+            length=self.size, byteorder="little", signed=True
+        )
 
     def validate(self, data: Any):
         if not isinstance(data, (float, int)):
@@ -168,6 +186,44 @@ class TimerEncoding(Encoding):
         return 8
 
 
+class BitFieldEncoding(Encoding):
+    """Unsigned integer stored in `bit_count` bits of a little endian value of `size` bytes,
+    starting at bit `bit_offset`. Typically used for flags packed into a single byte.
+    """
+
+    def __init__(self, size: int, bit_offset: int, bit_count: int = 1):
+        assert 0 <= bit_offset and bit_offset + bit_count <= size * 8
+        self.size = size
+        self.bit_offset = bit_offset
+        self.bit_count = bit_count
+        self.mask = (1 << bit_count) - 1
+
+    def deserialize(self, data: bytes) -> int:
+        return (int.from_bytes(data, byteorder="little") >> self.bit_offset) & self.mask
+
+    def serialize(self, data: Any) -> bytes:
+        return self.merge(bytes(self.size), data)
+
+    def merge(self, data: bytes, value: Any) -> bytes:
+        self.validate(value)
+        current = int.from_bytes(data, byteorder="little")
+        current &= ~(self.mask << self.bit_offset)
+        current |= int(value) << self.bit_offset
+        return current.to_bytes(length=self.size, byteorder="little")
+
+    def validate(self, data: Any):
+        if not isinstance(data, (int, float)) or not int(data) == data:
+            raise AssertionError("Wrong argument type, integral number expected!")
+        if not 0 <= data <= self.mask:
+            raise AssertionError(f"Number between 0 and {self.mask} expected!")
+
+    def is_partial(self):
+        return True
+
+    def get_size(self):
+        return self.size
+
+
 class ArrayEncoding(Encoding):
     def __init__(self, member_encoding: Encoding, count: int):
         self.member_encoding = member_encoding
@@ -205,7 +261,7 @@ class OperatingStatusEncoding(Encoding):
 
     def serialize(self, data: Any) -> bytes:
         self.validate(data)
-        return b"\x00" if data is OperatingStatus.OFF else b"\x01"
+        return bytes([data.value])
 
     def validate(self, data: Any):
         assert isinstance(data, OperatingStatus), "OperatingStatus expected"
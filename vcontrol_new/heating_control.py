@@ -1,11 +1,17 @@
 from typing import Dict, List, Tuple, Union
 
+from .derived import DerivedParameter
 from .encoding import Encoding
 from .parameter import AggregatedParameter, Parameter
-from .protocol import KWProtocol, Protocol
+from .protocol import KWProtocol, P300Protocol, Protocol
 from collections import namedtuple
 
-ParamMapping = namedtuple("ParamMapping", ["param", "encoding", "address"])
+# `cache_policy` is not used by the device itself, but configured alongside the mapping
+ParamMapping = namedtuple(
+    "ParamMapping",
+    ["param", "encoding", "address", "cache_policy"],
+    defaults=[None],
+)
 AddressWithOffset = namedtuple("AddressWithOffset", ["address", "offset"])
 
 
@@ -17,14 +23,45 @@ class ParameterStorage:
 
     def __init__(self):
         self.parameters: Dict[str, Tuple[Parameter, bytes, Encoding]] = dict()
+        # number of bytes to read at an address to get all parameters stored there
+        self.read_sizes: Dict[bytes, int] = dict()
+        # parameters computed from others, not stored on the device
+        self.derived_parameters: Dict[str, DerivedParameter] = dict()
 
     def add_parameter(self, parameter: Parameter, address: AddressWithOffset, encoding: Encoding):
         if parameter.id in self.parameters:
             raise Exception("Parameter already exists")
         self.parameters[parameter.id] = parameter, address, encoding
+        self.read_sizes[address.address] = max(
+            self.read_sizes.get(address.address, 0),
+            address.offset + encoding.get_size()
+        )
+
+    def add_derived_parameter(self, parameter: DerivedParameter):
+        if parameter.id in self.parameters or parameter.id in self.derived_parameters:
+            raise Exception("Parameter already exists")
+        for input_id in parameter.inputs:
+            if input_id not in self.parameters and input_id not in self.derived_parameters:
+                raise Exception(f"Unknown parameter {input_id} used by {parameter.id}")
+        self.derived_parameters[parameter.id] = parameter
+
+    def is_derived(self, param: Union[str, Parameter]) -> bool:
+        return (param if isinstance(param, str) else param.id) in self.derived_parameters
+
+    def get_read_size(self, address: AddressWithOffset, encoding: Encoding) -> int:
+        """
+        Return the number of bytes to read for a parameter. Parameters sharing the same
+        (aligned) address are read together.
+        """
+        return max(
+            self.read_sizes.get(address.address, 0),
+            address.offset + encoding.get_size()
+        )
 
     def get_supported_parameters(self) -> List[Parameter]:
-        return [param for param, _, _ in self.parameters.values()]
+        return [param for param, _, _ in self.parameters.values()] + list(
+            self.derived_parameters.values()
+        )
 
     def get_storage(self, param: Union[str, Parameter]):
         param_id = param if isinstance(param, str) else param.id
@@ -35,8 +72,22 @@ class ParameterStorage:
         return self.parameters[param_id]
 
     def get_parameter(self, param_id: str):
+        if param_id in self.derived_parameters:
+            return self.derived_parameters[param_id]
         return self.get_storage(param_id)[0]
 
+    def get_parameters_at(self, address: bytes) -> List[Parameter]:
+        """Return the parameters stored at the given (aligned) address, thus read together"""
+        return [
+            param for param, (param_address, _), _ in self.parameters.values()
+            if param_address == address
+        ]
+
+    def get_byte_range(self, param: Union[str, Parameter]) -> Tuple[int, int]:
+        """Return the address of the first byte of a parameter's value and its size"""
+        _, (address, offset), encoding = self.get_storage(param)
+        return int.from_bytes(address, "big") + offset, encoding.get_size()
+
     def get_child_storage(self, param: Union[str, AggregatedParameter], index: int):
         assert not isinstance(param, str) or not "." in param
         param_id = param if isinstance(param, str) else param.id
@@ -79,16 +130,25 @@ class BaseHeatingControl:
 
 
 class HeatingControl(BaseHeatingControl):
-    def __init__(self, param_mappings: List[ParamMapping], protocol):
+    def __init__(
+        self,
+        param_mappings: List[ParamMapping],
+        protocol,
+        derived_parameters: List[DerivedParameter] = (),
+    ):
         super().__init__()
         self.protocol = protocol
         for param_mapping in param_mappings:
             self.storage.add_parameter(
                 param_mapping.param, param_mapping.address, param_mapping.encoding
             )
+        for param in derived_parameters:
+            self.storage.add_derived_parameter(param)
 
     def get_protocol(self):
         if self.protocol == "KW":
             return KWProtocol()
+        elif self.protocol == "P300":
+            return P300Protocol()
         else:
             raise Exception("Unsupported protocol given!")
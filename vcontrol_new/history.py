@@ -0,0 +1,567 @@
+import math
+import struct
+from array import array
+from collections import namedtuple
+from itertools import islice
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .connection_cache import CacheListener
+from .encoding import BitFieldEncoding, FloatEncoding, IntEncoding, UIntEncoding
+from .heating_control import ParameterStorage
+from .parameter import ParameterReading
+from .unit import OperatingStatusUnit
+
+# (prefix, prefix length, payload bits) for zigzag encoded numbers, tried in order
+_TIME_BUCKETS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 40)]
+_INT_BUCKETS = [(0b10, 2, 4), (0b110, 3, 8), (0b1110, 4, 16), (0b1111, 4, 64)]
+# upper bound of the bits needed to append one sample, see `_HistoryBlock.append()`
+_MAX_SAMPLE_BITS = 4 + 40 + 2 + 5 + 6 + 64
+_FLOAT = struct.Struct("!d")
+# (seconds covered by a bucket, seconds kept if less than the retention) of the rollups
+# kept for every time series. Minute buckets for the whole retention would take far more
+# memory than the compressed samples, older values are aggregated from the samples.
+ROLLUP_RESOLUTIONS = [(60, 6 * 3600), (3600, None), (86400, None)]
+
+# aggregated values of a time range starting at `time`, `time_in_state` maps the states of
+# operating status parameters to the seconds spent in them (empty for other parameters)
+HistoryBucket = namedtuple(
+    "HistoryBucket",
+    ["time", "minimum", "maximum", "average", "count", "time_in_state"],
+)
+
+
+def _zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+def _float_bits(value: float) -> int:
+    return int.from_bytes(_FLOAT.pack(value), "big")
+
+
+def _bits_float(bits: int) -> float:
+    return _FLOAT.unpack(bits.to_bytes(8, "big"))[0]
+
+
+class _BitReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+
+    def read(self, count: int) -> int:
+        value = 0
+        for _ in range(count):
+            byte = self.data[self.position >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.position & 7))) & 1)
+            self.position += 1
+        return value
+
+    def read_prefix(self, max_length: int) -> int:
+        """Count the 1 bits up to the next 0 bit (or up to `max_length`)."""
+        length = 0
+        while length < max_length and self.read(1):
+            length += 1
+        return length
+
+
+class _HistoryBlock:
+    """A fixed number of bytes holding consecutive samples of a time series.
+
+    Timestamps (in milliseconds) are stored as the zigzag encoded difference between
+    successive deltas, which is mostly small for regularly read values. Integral values are
+    stored as zigzag encoded differences to the previous value, other values as the XOR of
+    their IEEE 754 representation with the previous one, storing only the meaningful bits.
+    The first sample is kept in the block's header.
+    """
+
+    __slots__ = [
+        "data",
+        "bits",
+        "count",
+        "integral",
+        "start",
+        "end",
+        "first_value",
+        "last_value",
+        "last_delta",
+        "leading",
+        "trailing",
+    ]
+
+    def __init__(self, size: int, integral: bool, time: int, value):
+        self.data = bytearray(size)
+        self.bits = 0
+        self.count = 1
+        self.integral = integral
+        self.start = self.end = time
+        self.first_value = self.last_value = value
+        self.last_delta = 0
+        # the window of meaningful bits of the last XOR encoded value
+        self.leading = self.trailing = None
+
+    def get_size(self) -> int:
+        return len(self.data)
+
+    def _write(self, value: int, count: int):
+        for shift in range(count - 1, -1, -1):
+            if (value >> shift) & 1:
+                self.data[self.bits >> 3] |= 0x80 >> (self.bits & 7)
+            self.bits += 1
+
+    def _write_bucketed(self, value: int, buckets):
+        if value == 0:
+            self._write(0, 1)
+            return
+        for prefix, prefix_length, payload in buckets:
+            if value < 1 << payload:
+                self._write(prefix, prefix_length)
+                self._write(value, payload)
+                return
+        raise OverflowError(f"{value} does not fit into {buckets[-1][2]} bits")
+
+    def append(self, time: int, value) -> bool:
+        """Append a sample, returns `False` if the block is full."""
+        if self.bits + _MAX_SAMPLE_BITS > len(self.data) * 8:
+            return False
+        delta = time - self.end
+        delta_change = _zigzag(delta - self.last_delta)
+        if delta_change >= 1 << _TIME_BUCKETS[-1][2]:
+            # e.g. the clock jumped by years, start a new block
+            return False
+        self._write_bucketed(delta_change, _TIME_BUCKETS)
+        if self.integral:
+            self._write_bucketed(_zigzag(value - self.last_value), _INT_BUCKETS)
+        else:
+            self._write_xor(_float_bits(value) ^ _float_bits(self.last_value))
+        self.end = time
+        self.last_delta = delta
+        self.last_value = value
+        self.count += 1
+        return True
+
+    def _write_xor(self, xor: int):
+        if xor == 0:
+            self._write(0, 1)
+            return
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if (
+            self.leading is not None
+            and leading >= self.leading
+            and trailing >= self.trailing
+        ):
+            # fits into the window of the previous value
+            self._write(0b10, 2)
+            self._write(xor >> self.trailing, 64 - self.leading - self.trailing)
+            return
+        self._write(0b11, 2)
+        self._write(leading, 5)
+        # 64 meaningful bits are stored as 0, as it never happens otherwise
+        self._write((64 - leading - trailing) & 63, 6)
+        self._write(xor >> trailing, 64 - leading - trailing)
+        self.leading, self.trailing = leading, trailing
+
+    def decode(self) -> Iterator[Tuple[int, Any]]:
+        time, value = self.start, self.first_value
+        yield time, value
+        reader = _BitReader(self.data)
+        delta = 0
+        bits = value if self.integral else _float_bits(value)
+        leading = trailing = None
+        for _ in range(self.count - 1):
+            delta += _unzigzag(self._read_bucketed(reader, _TIME_BUCKETS))
+            time += delta
+            if self.integral:
+                value += _unzigzag(self._read_bucketed(reader, _INT_BUCKETS))
+            else:
+                if reader.read(1):
+                    if reader.read(1):
+                        leading = reader.read(5)
+                        length = reader.read(6) or 64
+                        trailing = 64 - leading - length
+                    bits ^= reader.read(64 - leading - trailing) << trailing
+                value = _bits_float(bits)
+            yield time, value
+
+    @staticmethod
+    def _read_bucketed(reader: _BitReader, buckets) -> int:
+        prefix_length = reader.read_prefix(len(buckets))
+        if prefix_length == 0:
+            return 0
+        return reader.read(buckets[prefix_length - 1][2])
+
+
+class _Aggregation:
+    """Accumulates values and state durations into buckets of `step` seconds."""
+
+    def __init__(self, step: float):
+        self.step = step
+        # bucket index -> [minimum, maximum, sum, count, time in state]
+        self.buckets: Dict[int, list] = dict()
+
+    def _get(self, time: float) -> list:
+        index = math.floor(time / self.step)
+        if index not in self.buckets:
+            self.buckets[index] = [math.inf, -math.inf, 0.0, 0, dict()]
+        return self.buckets[index]
+
+    def add(self, time: float, minimum, maximum, total: float, count: int):
+        bucket = self._get(time)
+        bucket[0] = min(bucket[0], minimum)
+        bucket[1] = max(bucket[1], maximum)
+        bucket[2] += total
+        bucket[3] += count
+
+    def add_state(self, time: float, state, seconds: float):
+        time_in_state = self._get(time)[4]
+        time_in_state[state] = time_in_state.get(state, 0) + seconds
+
+    def add_state_between(self, state, start: float, end: float):
+        """Add the time between `start` and `end` spent in the state."""
+        while start < end:
+            bucket_end = (math.floor(start / self.step) + 1) * self.step
+            self.add_state(start, state, min(end, bucket_end) - start)
+            start = bucket_end
+
+    def get_buckets(self) -> List[HistoryBucket]:
+        return [
+            HistoryBucket(
+                datetime.fromtimestamp(index * self.step),
+                minimum if count else None,
+                maximum if count else None,
+                total / count if count else None,
+                count,
+                time_in_state,
+            )
+            for index, (minimum, maximum, total, count, time_in_state) in sorted(
+                self.buckets.items()
+            )
+        ]
+
+
+class Rollup:
+    """Minimum, maximum, sum and count of the values per `resolution` seconds.
+
+    Buckets are kept in arrays indexed relative to the first bucket, up to `max_buckets`
+    of them. If `track_states` is set, the seconds spent in each state (the value until
+    the next one) are summed up as well.
+    """
+
+    def __init__(self, resolution: int, max_buckets: int, track_states: bool):
+        self.resolution = resolution
+        self.max_buckets = max_buckets
+        self.first: Optional[int] = None
+        self.minimum = array("d")
+        self.maximum = array("d")
+        self.total = array("d")
+        self.count = array("L")
+        self.states: Optional[Dict[Any, array]] = dict() if track_states else None
+
+    def _arrays(self) -> List[array]:
+        arrays = [self.minimum, self.maximum, self.total, self.count]
+        return (
+            arrays + list(self.states.values()) if self.states is not None else arrays
+        )
+
+    def _get_offset(self, time: float) -> Optional[int]:
+        """Return the offset of the bucket containing the time, adding buckets if needed."""
+        index = math.floor(time / self.resolution)
+        if self.first is None:
+            self.first = index
+        if index < self.first:
+            # already dropped
+            return None
+        missing = index - self.first - len(self.count) + 1
+        if missing >= self.max_buckets:
+            # e.g. the clock jumped forward, none of the buckets would be kept
+            for it in self._arrays():
+                del it[:]
+            self.first = index
+            missing = 1
+        if missing > 0:
+            for it in self._arrays():
+                it.extend([0] * missing)
+        excess = len(self.count) - self.max_buckets
+        if excess > 0:
+            for it in self._arrays():
+                del it[:excess]
+            self.first += excess
+        return index - self.first
+
+    def covers(self, time: float) -> bool:
+        """Whether the values since the given time have been added to the buckets kept."""
+        return self.first is None or self.first * self.resolution <= time
+
+    def drop_before(self, time: float):
+        """Drop the buckets ending before the given time."""
+        if self.first is None:
+            return
+        excess = min(math.floor(time / self.resolution) - self.first, len(self.count))
+        if excess > 0:
+            for it in self._arrays():
+                del it[:excess]
+            self.first += excess
+
+    def add(self, time: float, value: float):
+        offset = self._get_offset(time)
+        if offset is None:
+            return
+        if self.count[offset] == 0:
+            self.minimum[offset] = self.maximum[offset] = value
+        else:
+            self.minimum[offset] = min(self.minimum[offset], value)
+            self.maximum[offset] = max(self.maximum[offset], value)
+        self.total[offset] += value
+        self.count[offset] += 1
+
+    def add_state(self, state, start: float, end: float):
+        """Add the time between `start` and `end` spent in the state."""
+        # buckets this far before the end would be dropped anyway
+        first_kept = math.floor(end / self.resolution) - self.max_buckets + 1
+        start = max(start, first_kept * self.resolution)
+        while start < end:
+            bucket_end = (math.floor(start / self.resolution) + 1) * self.resolution
+            offset = self._get_offset(start)
+            if offset is not None:
+                if state not in self.states:
+                    self.states[state] = array("d", bytes(8 * len(self.count)))
+                self.states[state][offset] += min(end, bucket_end) - start
+            start = bucket_end
+
+    def aggregate(self, aggregation: _Aggregation, start: float, end: float):
+        """Add the buckets starting within the time range to the aggregation."""
+        if self.first is None:
+            return
+        first = max(math.floor(start / self.resolution) - self.first, 0)
+        last = min(math.floor(end / self.resolution) - self.first, len(self.count) - 1)
+        for offset in range(first, last + 1):
+            time = (self.first + offset) * self.resolution
+            if self.count[offset]:
+                aggregation.add(
+                    time,
+                    self.minimum[offset],
+                    self.maximum[offset],
+                    self.total[offset],
+                    self.count[offset],
+                )
+            for state, seconds in (self.states or {}).items():
+                if seconds[offset]:
+                    aggregation.add_state(time, state, seconds[offset])
+
+
+class TimeSeries:
+    """Compressed history of the values of a single parameter.
+
+    Values are stored as integers multiplied by `scale` (e.g. the divisor of a
+    `FloatEncoding`) if given, as floats otherwise. Samples are kept in blocks of
+    `block_size` bytes, which are only decoded if they overlap a requested time range.
+
+    Additionally, a `Rollup` per resolution of `ROLLUP_RESOLUTIONS` is updated with every
+    sample, covering `retention` seconds at most.
+    """
+
+    def __init__(
+        self,
+        scale: Optional[int],
+        block_size: int,
+        value_type: type,
+        retention: float,
+        track_states: bool = False,
+    ):
+        self.scale = scale
+        self.block_size = block_size
+        self.value_type = value_type
+        self.track_states = track_states
+        self.blocks: List[_HistoryBlock] = []
+        self.rollups = [
+            Rollup(
+                resolution,
+                math.ceil(min(retention, horizon or retention) / resolution) + 1,
+                track_states,
+            )
+            for resolution, horizon in ROLLUP_RESOLUTIONS
+        ]
+        self.last: Optional[Tuple[float, Any]] = None
+
+    def append(self, time: datetime, value: Any):
+        time_ms = round(time.timestamp() * 1000)
+        stored = round(value * self.scale) if self.scale is not None else float(value)
+        if self.blocks:
+            last = self.blocks[-1]
+            if time_ms < last.end or (
+                time_ms == last.end and stored == last.last_value
+            ):
+                # already stored. Derived values are recomputed with the time of their
+                # oldest input, so a new value may have the time of the previous one.
+                return
+        if not self.blocks or not self.blocks[-1].append(time_ms, stored):
+            self.blocks.append(
+                _HistoryBlock(self.block_size, self.scale is not None, time_ms, stored)
+            )
+        time_s = time_ms / 1000
+        for rollup in self.rollups:
+            rollup.add(time_s, float(value))
+            if self.track_states and self.last is not None:
+                rollup.add_state(self.last[1], self.last[0], time_s)
+        self.last = time_s, value
+
+    def drop_before(self, time: datetime):
+        """Drop the blocks and rollup buckets holding only samples older than the time."""
+        time_ms = time.timestamp() * 1000
+        while self.blocks and self.blocks[0].end < time_ms:
+            self.blocks.pop(0)
+        for rollup in self.rollups:
+            rollup.drop_before(time_ms / 1000)
+
+    def scan(self, start: datetime, end: datetime) -> Iterator[Tuple[datetime, Any]]:
+        """Yield the samples within the time range, oldest first."""
+        start_ms, end_ms = start.timestamp() * 1000, end.timestamp() * 1000
+        for block in self.blocks:
+            if block.end < start_ms:
+                continue
+            if block.start > end_ms:
+                break
+            for time_ms, stored in block.decode():
+                if start_ms <= time_ms <= end_ms:
+                    yield datetime.fromtimestamp(time_ms / 1000), self._to_value(stored)
+
+    def aggregate(
+        self, start: datetime, end: datetime, step: float
+    ) -> Tuple[Optional[int], List[HistoryBucket]]:
+        """Aggregate the values within the time range into buckets of `step` seconds.
+
+        The coarsest rollup with a resolution of at most `step` still covering the start of
+        the time range is used, the raw samples only if there is none. Returns the
+        resolution used (`None` for raw samples) and the buckets containing values.
+        """
+        aggregation = _Aggregation(step)
+        start_s, end_s = start.timestamp(), end.timestamp()
+        if self.blocks:
+            # there are no values before the oldest sample
+            start_s = max(start_s, self.blocks[0].start / 1000)
+        usable = [
+            it for it in self.rollups if it.resolution <= step and it.covers(start_s)
+        ]
+        if usable:
+            rollup = usable[-1]
+            rollup.aggregate(aggregation, start_s, end_s)
+            return rollup.resolution, aggregation.get_buckets()
+        last = None
+        for time, value in self.scan(start, end):
+            time_s = time.timestamp()
+            aggregation.add(time_s, value, value, value, 1)
+            if self.track_states and last is not None:
+                aggregation.add_state_between(last[1], last[0], time_s)
+            last = time_s, value
+        return None, aggregation.get_buckets()
+
+    def _to_value(self, stored):
+        if self.scale is not None and self.value_type is float:
+            stored /= self.scale
+        return self.value_type(stored)
+
+    def get_status(self) -> dict:
+        return {
+            "samples": sum(block.count for block in self.blocks),
+            "blocks": len(self.blocks),
+            "bytes": sum(block.get_size() for block in self.blocks),
+            "start": (
+                datetime.fromtimestamp(self.blocks[0].start / 1000)
+                if self.blocks
+                else None
+            ),
+            "end": (
+                datetime.fromtimestamp(self.blocks[-1].end / 1000)
+                if self.blocks
+                else None
+            ),
+        }
+
+
+class HistoryStore(CacheListener):
+    """Keeps the history of the numeric values stored in a `ConnectionCache`.
+
+    Values of parameters using a `FloatEncoding` are stored as integers scaled by its
+    divisor, values of integer encodings as integers and other (e.g. derived) values as
+    floats. Samples older than `retention` seconds are dropped block by block.
+    """
+
+    def __init__(
+        self,
+        param_storage: ParameterStorage,
+        retention: float = 7 * 24 * 3600,
+        block_size: int = 1024,
+    ):
+        self.param_storage = param_storage
+        self.retention = timedelta(seconds=retention)
+        self.block_size = block_size
+        self.series: Dict[str, TimeSeries] = dict()
+
+    def value_stored(self, reading: ParameterReading):
+        value = reading.value
+        if not isinstance(value, (int, float)):
+            return
+        param_id = reading.parameter.id
+        series = self.series.get(param_id)
+        if series is None:
+            series = self.series[param_id] = self._create_series(param_id, value)
+        series.append(reading.time, value)
+        self._drop_expired(series)
+
+    def _drop_expired(self, series: TimeSeries):
+        series.drop_before(datetime.now() - self.retention)
+
+    def _create_series(self, param_id: str, value: Any) -> TimeSeries:
+        scale = None
+        if not self.param_storage.is_derived(param_id):
+            _, _, encoding = self.param_storage.get_storage(param_id)
+            if isinstance(encoding, FloatEncoding):
+                scale = encoding.divisor
+            elif isinstance(encoding, (IntEncoding, UIntEncoding, BitFieldEncoding)):
+                scale = 1
+        if isinstance(value, bool):
+            value_type = bool
+        elif scale == 1:
+            value_type = int
+        else:
+            value_type = float
+        track_states = isinstance(
+            self.param_storage.get_parameter(param_id).unit, OperatingStatusUnit
+        )
+        return TimeSeries(
+            scale,
+            self.block_size,
+            value_type,
+            self.retention.total_seconds(),
+            track_states,
+        )
+
+    def get_history(
+        self, param_id: str, start: datetime, end: datetime, limit: int = None
+    ) -> List[Tuple[datetime, Any]]:
+        series = self.series.get(param_id)
+        if series is None:
+            return []
+        # parameters not read anymore are only expired here
+        self._drop_expired(series)
+        return list(islice(series.scan(start, end), limit))
+
+    def get_buckets(
+        self, param_id: str, start: datetime, end: datetime, step: float
+    ) -> Tuple[Optional[int], List[HistoryBucket]]:
+        series = self.series.get(param_id)
+        if series is None:
+            return None, []
+        self._drop_expired(series)
+        return series.aggregate(start, end, step)
+
+    def get_status(self) -> Dict[str, dict]:
+        for series in self.series.values():
+            self._drop_expired(series)
+        return {
+            param_id: series.get_status() for param_id, series in self.series.items()
+        }
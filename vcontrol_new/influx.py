@@ -0,0 +1,150 @@
+import asyncio
+from collections import deque
+from typing import Dict, List, Optional
+
+from util.http_client import HttpClient
+
+from .connection_cache import CacheListener
+from .parameter import ParameterReading
+
+# failed flushes are retried with a doubling interval, up to this many seconds
+_MAX_RETRY_INTERVAL = 300
+
+
+def _escape(text: str, special: str) -> str:
+    for char in "\\" + special:
+        text = text.replace(char, "\\" + char)
+    return text
+
+
+def encode_value(value) -> Optional[str]:
+    """Encode a value as a field value of the InfluxDB line protocol."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value) if value == value and abs(value) != float("inf") else None
+    return None
+
+
+class InfluxExporter(CacheListener):
+    """Pushes the values stored in a `ConnectionCache` to InfluxDB.
+
+    Every numeric reading is encoded as a line of the line protocol and buffered. The
+    buffer is written to `url` (e.g. `http://localhost:8086/api/v2/write?org=home&bucket=
+    heating`) in batches of up to `batch_size` lines, as soon as a batch is complete or at
+    least every `flush_interval` seconds, reusing a kept alive connection.
+
+    A batch failing to be written is retried, meanwhile new lines are buffered. If more
+    than `max_buffer` lines are waiting, the oldest ones are dropped.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        token: str = None,
+        measurement: str = "vcontrol",
+        tags: Dict[str, str] = None,
+        batch_size: int = 500,
+        flush_interval: float = 10,
+        max_buffer: int = 10000,
+        timeout: float = 10,
+    ):
+        self.client = HttpClient(url, max_connections=1, timeout=timeout)
+        self.headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if token:
+            self.headers["Authorization"] = f"Token {token}"
+        self.prefix = _escape(measurement, ", ") + "".join(
+            f",{_escape(str(key), ',= ')}={_escape(str(value), ',= ')}"
+            for key, value in sorted((tags or {}).items())
+        )
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = deque(maxlen=max_buffer)
+        # the batch being written, kept until it has been accepted
+        self.batch: List[str] = []
+        self.written = 0
+        self.dropped = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self._batch_ready = asyncio.Event()
+        self._task = None
+
+    def value_stored(self, reading: ParameterReading):
+        field = encode_value(reading.value)
+        if field is None:
+            return
+        # nanoseconds, the default precision of InfluxDB
+        time = round(reading.time.timestamp() * 1000) * 1000000
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(
+            f"{self.prefix},param={_escape(reading.parameter.id, ',= ')} "
+            f"value={field} {time}"
+        )
+        if len(self.buffer) >= self.batch_size:
+            self._batch_ready.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    async def run(self):
+        """Flush the buffered lines until cancelled."""
+        retry_interval = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            try:
+                while await self.flush():
+                    pass
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                retry_interval = min(
+                    retry_interval * 2, max(_MAX_RETRY_INTERVAL, self.flush_interval)
+                )
+                print(
+                    f"Writing to InfluxDB failed ({e}), retrying in {retry_interval:.1f}s"
+                )
+                # complete batches keep arriving while InfluxDB is unavailable, they
+                # must not trigger the retry early
+                await asyncio.sleep(retry_interval)
+            else:
+                retry_interval = self.flush_interval
+
+    async def flush(self) -> bool:
+        """Write one batch, returns whether another complete batch is waiting."""
+        if not self.batch:
+            count = min(len(self.buffer), self.batch_size)
+            self.batch = [self.buffer.popleft() for _ in range(count)]
+        if not self.batch:
+            return False
+        status, body = await self.client.request(
+            "POST",
+            body="\n".join(self.batch).encode(),
+            headers=self.headers,
+        )
+        if status == 400:
+            # rejected by the server, retrying wouldn't help
+            self.dropped += len(self.batch)
+            self.batch = []
+            raise Exception(f"Invalid batch: {body.decode(errors='replace')}")
+        if status >= 300:
+            raise Exception(f"HTTP {status}: {body.decode(errors='replace')}")
+        self.written += len(self.batch)
+        self.batch = []
+        return len(self.buffer) >= self.batch_size
+
+    def get_status(self) -> dict:
+        return {
+            "buffered": len(self.buffer) + len(self.batch),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,71 @@
+from collections import namedtuple
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+# a contiguous range of device memory with the time it has been read (or written)
+ShadowRange = namedtuple("ShadowRange", ["start", "data", "time"])
+
+
+class MemoryShadow:
+    """Sparse copy of the heating control device's memory.
+
+    Every range of bytes read from or written to the device is remembered together with the
+    time of the transfer. Newer data replaces the overlapping parts of older ranges, so
+    values can be served from the shadow as long as all of their bytes are fresh enough.
+    """
+
+    def __init__(self):
+        # non-overlapping ranges, sorted by their start address
+        self.ranges: List[ShadowRange] = []
+
+    def update(self, address: int, data: bytes, time: datetime = None):
+        """Remember the data at the given address."""
+        self.invalidate(address, len(data))
+        self.ranges.append(ShadowRange(address, bytes(data), time or datetime.now()))
+        self.ranges.sort(key=lambda it: it.start)
+
+    def invalidate(self, address: int, size: int):
+        """Forget the bytes in the given range, keeping the parts of ranges outside of it."""
+        end = address + size
+        remaining = []
+        for it in self.ranges:
+            it_end = it.start + len(it.data)
+            if it_end <= address or it.start >= end:
+                remaining.append(it)
+                continue
+            if it.start < address:
+                remaining.append(
+                    ShadowRange(it.start, it.data[: address - it.start], it.time)
+                )
+            if it_end > end:
+                remaining.append(ShadowRange(end, it.data[end - it.start :], it.time))
+        self.ranges = remaining
+
+    def get(
+        self, address: int, size: int, max_age_seconds: float = -1
+    ) -> Optional[Tuple[bytes, datetime]]:
+        """Return the bytes in the given range and the time of their oldest part.
+
+        `None` is returned if any byte is missing or older than `max_age_seconds` (if
+        not negative).
+        """
+        end = address + size
+        oldest = None
+        data = b""
+        position = address
+        for it in self.ranges:
+            it_end = it.start + len(it.data)
+            if it_end <= position:
+                continue
+            if it.start > position or position >= end:
+                break
+            if max_age_seconds >= 0 and (
+                (datetime.now() - it.time).total_seconds() > max_age_seconds
+            ):
+                return None
+            data += it.data[position - it.start : end - it.start]
+            oldest = it.time if oldest is None else min(oldest, it.time)
+            position = min(it_end, end)
+        if position < end:
+            return None
+        return data, oldest
@@ -0,0 +1,97 @@
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+# counts are halved when a parameter has been requested this often, so the statistics
+# follow changing request patterns
+_MAX_COUNT = 100
+
+
+class CoAccessTracker:
+    """Learns which parameters are requested shortly after each other.
+
+    For every parameter, it counts how often each other parameter has been requested
+    within `window` seconds afterwards, giving the probability that a request is followed
+    by one for the other parameter. Requests are counted when they have been answered. It
+    also keeps track of the prefetched parameters and whether they have been requested
+    before getting outdated.
+    """
+
+    def __init__(self, window: float = 10, min_probability: float = 0.5):
+        self.window = timedelta(seconds=window)
+        self.min_probability = min_probability
+        # requests of the last `window` seconds, oldest first
+        self.recent = deque()
+        self.counts: Dict[str, float] = dict()
+        self.followers: Dict[str, Dict[str, float]] = dict()
+        # time of the prefetches not requested yet
+        self.prefetched: Dict[str, datetime] = dict()
+        self.issued = 0
+        self.issued_bytes = 0
+        # prefetched values requested within the window
+        self.used = 0
+        # prefetched values not requested within the window
+        self.wasted = 0
+        self.requests = 0
+        # how the requests have been answered, by `CacheStatus` value
+        self.statuses: Dict[str, int] = dict()
+
+    def record_request(self, param_id: str, status: str):
+        """Record an answered request and how it has been answered."""
+        now = datetime.now()
+        while self.recent and now - self.recent[0][0] > self.window:
+            self.recent.popleft()
+        self._expire_prefetched(now)
+        self.requests += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if self.prefetched.pop(param_id, None) is not None:
+            self.used += 1
+        for previous in {it for _, it in self.recent if it != param_id}:
+            followers = self.followers.setdefault(previous, dict())
+            followers[param_id] = followers.get(param_id, 0) + 1
+        count = self.counts.get(param_id, 0) + 1
+        if count > _MAX_COUNT:
+            count /= 2
+            followers = self.followers.get(param_id, dict())
+            for follower in followers:
+                followers[follower] /= 2
+        self.counts[param_id] = count
+        self.recent.append((now, param_id))
+
+    def record_prefetch(self, param_id: str, byte_count: int):
+        self.prefetched[param_id] = datetime.now()
+        self.issued += 1
+        self.issued_bytes += byte_count
+
+    def get_likely_next(self, param_id: str) -> List[Tuple[str, float]]:
+        """Return the parameters likely requested next with their probabilities."""
+        count = self.counts.get(param_id)
+        if not count:
+            return []
+        candidates = [
+            (follower, min(follower_count / count, 1))
+            for follower, follower_count in self.followers.get(param_id, {}).items()
+        ]
+        return sorted(
+            (it for it in candidates if it[1] >= self.min_probability),
+            key=lambda it: it[1],
+            reverse=True,
+        )
+
+    def get_status(self) -> dict:
+        self._expire_prefetched(datetime.now())
+        return {
+            "requests": self.requests,
+            "issued": self.issued,
+            "issued_bytes": self.issued_bytes,
+            "used": self.used,
+            "wasted": self.wasted,
+            "pending": len(self.prefetched),
+            "statuses": dict(self.statuses),
+        }
+
+    def _expire_prefetched(self, now: datetime):
+        for param_id, time in list(self.prefetched.items()):
+            if now - time > self.window:
+                del self.prefetched[param_id]
+                self.wasted += 1
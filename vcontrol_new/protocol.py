@@ -1,11 +1,25 @@
 import asyncio
 from .optolink import OptolinkConnection
-from .command import Command, KWReadCommand, KWWriteCommand
+from .command import (
+    Command,
+    CommandFailedException,
+    CommandTimeoutException,
+    KWReadCommand,
+    KWWriteCommand,
+    P300ReadCommand,
+    P300WriteCommand,
+    QueuedCommand,
+)
+from .command_queue import get_transfer_size
+from .statistics import BusStatistics
 
 
 class Protocol:
     """Represents a protocol used for the communication to a heating control device."""
 
+    def __init__(self, sync_interval: float = 2.0):
+        self.statistics = BusStatistics(sync_interval)
+
     def get_name(self) -> str:
         """Get the name of the protocol"""
         raise NotImplementedError
@@ -22,8 +36,27 @@ class Protocol:
         """Start serving commands as they arrive in a queue using a provided connection."""
         raise NotImplementedError
 
+    def _should_skip(self, queued: QueuedCommand) -> bool:
+        """Check whether a queued command is still worth to be sent to the device."""
+        if queued.future.done():
+            # the waiting side has been cancelled
+            self.statistics.skipped_cancelled += 1
+            return True
+        if asyncio.get_event_loop().time() >= queued.deadline:
+            queued.future.set_exception(
+                CommandTimeoutException("Command expired while waiting in the queue")
+            )
+            self.statistics.skipped_expired += 1
+            return True
+        return False
+
 
 class KWProtocol(Protocol):
+    def __init__(self, answer_timeout: float = 2):
+        super().__init__()
+        # time the device may take to answer a single command before we resynchronize
+        self.answer_timeout = answer_timeout
+
     def get_name(self) -> str:
         return "KW"
 
@@ -34,39 +67,156 @@ class KWProtocol(Protocol):
         return KWWriteCommand(address, data)
 
     async def run(self, connection: OptolinkConnection, command_queue: asyncio.Queue):
+        loop = asyncio.get_event_loop()
         connection.flush()
+        last_sync = None
         while True:
             # poll start bytes (0x05) and discard them
             byte = await connection.read()
-            if byte[0] != 0x05:
+            if len(byte) == 0 or byte[0] != 0x05:
                 # we are not in synchronization phase and received a byte other than
                 # the synchronization byte -> just wait for the next byte
                 continue
+            if last_sync is not None:
+                self.statistics.record_sync_interval(loop.time() - last_sync)
+            last_sync = loop.time()
             # when there is at least one command waiting in the queue, start the communication
             if not command_queue.empty():
                 connection.write(b"\x01")
-                # TODO: start measuring utilization here
+                self.statistics.usage.start_using()
                 try:
                     while True:
-                        cmd, fut = await asyncio.wait_for(
+                        queued = await asyncio.wait_for(
                             command_queue.get(), timeout=0.5
                         )
+                        if self._should_skip(queued):
+                            continue
+                        cmd, fut = queued.command, queued.future
+                        started = loop.time()
                         connection.write(cmd.get_command_bytes())
-                        val = await connection.read(cmd.get_expected_bytes_count())
-                        if all(it == 0x05 for it in val):
-                            fut.set_exception(Exception("Command failed"))
-                            # we must synchronize again
+                        val = await connection.read(
+                            cmd.get_expected_bytes_count(), self.answer_timeout
+                        )
+                        try:
+                            if len(val) > 0 and all(it == 0x05 for it in val):
+                                raise CommandFailedException(
+                                    "Device fell back to synchronization"
+                                )
+                            cmd.validate_result(val)
+                        except CommandFailedException as e:
+                            self.statistics.failed += 1
+                            if not fut.done():
+                                fut.set_exception(e)
+                            # discard the rest of a garbled answer, we must synchronize again
+                            connection.flush()
                             break
+                        self.statistics.record_transfer(
+                            get_transfer_size(cmd), loop.time() - started
+                        )
+                        # the waiting side may have given up on the command in the meantime
+                        if fut.done():
+                            self.statistics.abandoned += 1
                         else:
-                            if fut.done():
-                                # It shouldn't be possible to end up here at all. Still I received some InvalidStateError
-                                # once in a while which suggested that the future was already .done()
-                                print(fut.result())
-                                raise Exception("Future was already done")
+                            self.statistics.completed += 1
                             fut.set_result(cmd.handle_result(val))
                 except asyncio.TimeoutError:
                     continue
                 finally:
-                    pass
-                    # TODO: stop measuring utilization here
+                    self.statistics.usage.stop_using()
+                    # the interval to the next sync byte includes this session
+                    last_sync = None
             # no more commands to handle, wait for next synchronization
+
+
+class P300Protocol(Protocol):
+    """The P300 (VS2) protocol, supported by most newer Vitotronic controls.
+
+    In contrast to KW, a session is established once and kept open, and every command is
+    sent as a telegram with a checksum which is explicitly acknowledged by the device.
+    """
+
+    def __init__(self, answer_timeout: float = 2, idle_timeout: float = 30):
+        # no waiting for synchronization bytes within an established session
+        super().__init__(sync_interval=0)
+        self.answer_timeout = answer_timeout
+        # the session is re-established before sending a command after being idle this long
+        self.idle_timeout = idle_timeout
+
+    def get_name(self) -> str:
+        return "P300"
+
+    def create_read_command(self, address: bytes, size: int) -> Command:
+        return P300ReadCommand(address, size)
+
+    def create_write_command(self, address: bytes, data: bytes) -> Command:
+        return P300WriteCommand(address, data)
+
+    async def _initialize(self, connection: OptolinkConnection) -> bool:
+        """Reset the device's communication and start a new P300 session."""
+        connection.flush()
+        connection.write(b"\x04")
+        # wait for the device to fall back to sending synchronization bytes
+        while True:
+            byte = await connection.read(1, 2 * self.answer_timeout)
+            if len(byte) == 0:
+                return False
+            if byte[0] == 0x05:
+                break
+        connection.write(b"\x16\x00\x00")
+        return await connection.read(1, self.answer_timeout) == b"\x06"
+
+    async def _transfer(self, connection: OptolinkConnection, cmd: Command) -> bytes:
+        """Send a telegram and read the acknowledgement and the response telegram."""
+        connection.write(cmd.get_command_bytes())
+        ack = await connection.read(1, self.answer_timeout)
+        if ack != b"\x06":
+            # NACK (0x15) or no answer at all, return what we got for validation
+            return ack
+        header = await connection.read(2, self.answer_timeout)
+        if len(header) != 2 or header[0] != 0x41:
+            return ack + header
+        rest = await connection.read(header[1] + 1, self.answer_timeout)
+        return ack + header + rest
+
+    async def run(self, connection: OptolinkConnection, command_queue: asyncio.Queue):
+        loop = asyncio.get_event_loop()
+        last_used = None
+        while True:
+            queued = await command_queue.get()
+            if self._should_skip(queued):
+                continue
+            cmd, fut = queued.command, queued.future
+            if last_used is None or loop.time() - last_used > self.idle_timeout:
+                if not await self._initialize(connection):
+                    self.statistics.failed += 1
+                    if not fut.done():
+                        fut.set_exception(
+                            CommandFailedException("Could not start a P300 session")
+                        )
+                    continue
+            self.statistics.usage.start_using()
+            try:
+                started = loop.time()
+                val = await self._transfer(connection, cmd)
+                try:
+                    cmd.validate_result(val)
+                except CommandFailedException as e:
+                    self.statistics.failed += 1
+                    if not fut.done():
+                        fut.set_exception(e)
+                    # the session has to be established again
+                    last_used = None
+                    continue
+                # acknowledge the response telegram
+                connection.write(b"\x06")
+                last_used = loop.time()
+                self.statistics.record_transfer(
+                    get_transfer_size(cmd), last_used - started
+                )
+                if fut.done():
+                    self.statistics.abandoned += 1
+                else:
+                    self.statistics.completed += 1
+                    fut.set_result(cmd.handle_result(val))
+            finally:
+                self.statistics.usage.stop_using()
@@ -0,0 +1,287 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from .command_queue import QueueOverloadedException, get_transfer_size
+
+# weight of a new measurement in the moving averages of intervals and changes
+_SMOOTHING = 0.2
+# adaptive intervals are chosen to expect this many value changes per interval
+_CHANGES_PER_INTERVAL = 0.5
+# adaptive intervals are only adjusted if they differ by more than this fraction
+_ADJUSTMENT_THRESHOLD = 0.1
+
+
+class RefreshSchedule:
+    """Planning and bookkeeping of the background refresh of a single parameter."""
+
+    def __init__(
+        self,
+        param_id: str,
+        target: float,
+        priority: int,
+        command,
+        min_interval: float = None,
+        max_interval: float = None,
+    ):
+        self.param_id = param_id
+        # the configured refresh interval, adapted between the bounds if both are given
+        self.target = target
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.priority = priority
+        # the read command refreshing the value, used to estimate its cost
+        self.command = command
+        # the interval actually planned, longer than the target if the bus is too busy
+        self.interval = target
+        # moving average of the time between two successive readings
+        self.achieved: Optional[float] = None
+        self.refreshes = 0
+        # refreshes which arrived later than planned
+        self.misses = 0
+        self.errors = 0
+        self.last_time: Optional[datetime] = None
+        # no refresh is attempted before this time, e.g. after a failure
+        self.not_before: Optional[datetime] = None
+        self.last_value = None
+        # moving averages of the value changes per reading and the seconds between them
+        self.changes: Optional[float] = None
+        self.elapsed: Optional[float] = None
+        # how often the adaptive interval has been shortened or lengthened
+        self.adjustments = {"faster": 0, "slower": 0}
+
+    def get_transfer_size(self) -> int:
+        return get_transfer_size(self.command)
+
+    def is_adaptive(self) -> bool:
+        return self.min_interval is not None and self.max_interval is not None
+
+    def get_change_rate(self) -> Optional[float]:
+        """Estimated value changes per second."""
+        if not self.elapsed:
+            return None
+        return self.changes / self.elapsed
+
+    def adapt(self, changed: bool, elapsed: float) -> bool:
+        """Update the change rate, returns whether the target interval has been adjusted."""
+        if self.changes is None:
+            self.changes, self.elapsed = float(changed), elapsed
+        else:
+            self.changes += _SMOOTHING * (changed - self.changes)
+            self.elapsed += _SMOOTHING * (elapsed - self.elapsed)
+        rate = self.get_change_rate()
+        target = _CHANGES_PER_INTERVAL / rate if rate else self.max_interval
+        # react to changes immediately, but only lengthen the interval step by step
+        target = min(target, self.target * 2)
+        target = min(max(target, self.min_interval), self.max_interval)
+        if abs(target - self.target) <= _ADJUSTMENT_THRESHOLD * self.target:
+            return False
+        self.adjustments["faster" if target < self.target else "slower"] += 1
+        self.target = target
+        return True
+
+
+class RefreshPlanner:
+    """Keeps parameters fresh by reading them in the background.
+
+    Parameters with a `refresh` interval in their `CachePolicy` are read before their
+    cached value gets older than that. Using the measured bus statistics, the planner
+    checks whether all of them fit into `bus_share` of the bus capacity, leaving the rest to
+    requests. If they don't, the intervals of the parameters with the lowest priority are
+    stretched (up to `max_stretch` times) first. Reads are queued earliest deadline first,
+    early enough to arrive in time given the estimated wait.
+
+    If a parameter has `min_refresh` and `max_refresh` intervals, its interval is adapted
+    between them to how often the value changed in successive readings: volatile values
+    are read more often, stable ones less often.
+    """
+
+    def __init__(
+        self,
+        cache,
+        bus_share: float = 0.5,
+        max_stretch: float = 10,
+        replan_interval: float = 60,
+    ):
+        self.cache = cache
+        self.bus_share = bus_share
+        self.max_stretch = max_stretch
+        self.replan_interval = replan_interval
+        self.schedules: Dict[str, RefreshSchedule] = dict()
+        self.feasible = True
+        # fraction of the bus capacity needed by the planned refreshes
+        self.load = 0.0
+        self._in_flight = set()
+        conn = cache.conn
+        storage = cache.param_storage
+        for param_id, policy in cache.policies.items():
+            if (policy.min_refresh is None) != (policy.max_refresh is None):
+                raise Exception(
+                    f"Both min_refresh and max_refresh have to be given for {param_id}"
+                )
+            target = (
+                policy.refresh if policy.refresh is not None else policy.max_refresh
+            )
+            if target is None or storage.is_derived(param_id):
+                continue
+            _, address, encoding = storage.get_storage(param_id)
+            size = storage.get_read_size(address, encoding)
+            self.schedules[param_id] = RefreshSchedule(
+                param_id,
+                target,
+                policy.priority,
+                conn.protocol.create_read_command(address.address, size),
+                policy.min_refresh,
+                policy.max_refresh,
+            )
+
+    def _get_cost(self, schedule: RefreshSchedule) -> float:
+        """Fraction of the bus capacity needed to refresh a parameter every `interval`.
+
+        Every refresh is counted as a bus session of its own, including e.g. the wait for
+        the synchronization of the KW protocol.
+        """
+        statistics = self.cache.conn.statistics
+        seconds = (
+            statistics.get_session_overhead()
+            + schedule.get_transfer_size() * statistics.seconds_per_byte
+        )
+        return seconds / schedule.interval
+
+    def plan(self) -> bool:
+        """Compute the refresh intervals from the current bus statistics.
+
+        Returns whether all parameters can be refreshed at their target interval.
+        """
+        for schedule in self.schedules.values():
+            schedule.interval = schedule.target
+        self.load = sum(map(self._get_cost, self.schedules.values()))
+        self.feasible = self.load <= self.bus_share
+        for priority in sorted({it.priority for it in self.schedules.values()}):
+            if self.load <= self.bus_share:
+                break
+            group = [it for it in self.schedules.values() if it.priority == priority]
+            group_load = sum(map(self._get_cost, group))
+            others = self.load - group_load
+            if others < self.bus_share:
+                stretch = min(group_load / (self.bus_share - others), self.max_stretch)
+            else:
+                stretch = self.max_stretch
+            for schedule in group:
+                schedule.interval = schedule.target * stretch
+            self.load = others + group_load / stretch
+        return self.feasible
+
+    def get_report(self) -> dict:
+        """Describe the planned and the achieved freshness of every parameter."""
+        now = datetime.now()
+        parameters = dict()
+        for param_id, schedule in self.schedules.items():
+            reading = self.cache.get_cached_reading(param_id)
+            parameters[param_id] = {
+                "target": schedule.target,
+                "planned": schedule.interval,
+                "adaptive": schedule.is_adaptive(),
+                "change_rate": schedule.get_change_rate(),
+                "adjustments": dict(schedule.adjustments),
+                "priority": schedule.priority,
+                "achieved": schedule.achieved,
+                "age": (now - reading.time).total_seconds() if reading else None,
+                "refreshes": schedule.refreshes,
+                "misses": schedule.misses,
+                "errors": schedule.errors,
+            }
+        return {
+            "feasible": self.feasible,
+            "load": self.load,
+            "bus_share": self.bus_share,
+            "parameters": parameters,
+        }
+
+    async def run(self):
+        """Refresh the parameters until cancelled."""
+        if not self.schedules:
+            return
+        loop = asyncio.get_event_loop()
+        self.plan()
+        next_plan = loop.time() + self.replan_interval
+        while True:
+            if loop.time() >= next_plan:
+                self.plan()
+                next_plan = loop.time() + self.replan_interval
+            now = datetime.now()
+            # values may also be refreshed by requests, so check again at least every second
+            next_start = now + timedelta(seconds=1)
+            due = []
+            for schedule in self.schedules.values():
+                if schedule.param_id in self._in_flight:
+                    continue
+                start = self._get_start(schedule, now)
+                if start <= now:
+                    due.append((start, schedule.param_id))
+                else:
+                    next_start = min(next_start, start)
+            # commands are sent in the order they are queued
+            for _, param_id in sorted(due):
+                self._in_flight.add(param_id)
+                loop.create_task(self._refresh(self.schedules[param_id]))
+            await asyncio.sleep((next_start - now).total_seconds())
+
+    def _get_start(self, schedule: RefreshSchedule, now: datetime) -> datetime:
+        """Time to queue the refresh, so its answer arrives before the value gets too old."""
+        reading = self.cache.get_cached_reading(schedule.param_id)
+        if reading is None:
+            start = now
+        else:
+            lead = self.cache.conn.estimate_wait(schedule.command)
+            start = reading.time + timedelta(seconds=schedule.interval - lead)
+        if schedule.not_before is not None:
+            start = max(start, schedule.not_before)
+        return start
+
+    async def _refresh(self, schedule: RefreshSchedule):
+        lead = self.cache.conn.estimate_wait(schedule.command)
+        try:
+            reading = await self.cache.refresh_param(
+                schedule.param_id, max(schedule.interval - lead, 0)
+            )
+        except Exception as e:
+            schedule.errors += 1
+            if isinstance(e, QueueOverloadedException):
+                retry_after = e.retry_after
+            else:
+                retry_after = getattr(e, "failure", None)
+                retry_after = (
+                    (retry_after.retry_at - datetime.now()).total_seconds()
+                    if retry_after
+                    else schedule.interval
+                )
+            schedule.not_before = datetime.now() + timedelta(
+                seconds=max(retry_after, 1)
+            )
+            return
+        finally:
+            self._in_flight.discard(schedule.param_id)
+        schedule.not_before = None
+        self._record(schedule, reading)
+
+    def _record(self, schedule: RefreshSchedule, reading):
+        time = reading.time
+        if schedule.last_time is not None and time > schedule.last_time:
+            interval = (time - schedule.last_time).total_seconds()
+            if schedule.is_adaptive() and schedule.adapt(
+                reading.value != schedule.last_value, interval
+            ):
+                self.plan()
+            if schedule.achieved is None:
+                schedule.achieved = interval
+            else:
+                schedule.achieved += _SMOOTHING * (interval - schedule.achieved)
+            # a refresh may be late by up to a synchronization interval
+            sync_interval = self.cache.conn.statistics.sync_interval
+            if interval > schedule.interval + sync_interval:
+                schedule.misses += 1
+        if schedule.last_time is None or time > schedule.last_time:
+            schedule.refreshes += 1
+            schedule.last_time = time
+            schedule.last_value = reading.value
@@ -0,0 +1,269 @@
+import asyncio
+import heapq
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+# jobs due within this many seconds of each other are written in the same bus session
+_BATCH_WINDOW = 1
+# a failed write is retried after this many seconds
+_RETRY_DELAY = 60
+# the journal is rewritten once it has this many times more records than pending jobs
+_COMPACTION_RATIO = 4
+
+# Write of `value` to the parameter `param_id` at `due`, repeated every `interval` seconds
+# if given. `key` identifies the job, e.g. to cancel it, `created` is the time the value was
+# scheduled.
+ScheduledWrite = namedtuple(
+    "ScheduledWrite",
+    ["key", "param_id", "value", "due", "interval", "created"],
+    defaults=[None, None],
+)
+
+
+class WriteScheduler:
+    """Writes parameter values at a later time, e.g. to undo temporary changes.
+
+    Pending jobs are kept in a heap ordered by their due time. All jobs due within a second
+    are written together: they are queued at once to be transferred in a single bus
+    session, children of the same container (like the days of a control program) are
+    merged into a single `ConnectionCache.set_children()` call.
+
+    If a `journal` path is given, every change of the pending jobs is appended to it, with
+    the values encoded like on the device. The jobs are reloaded from it on startup, so
+    that temporary changes are undone after a restart as well; jobs which became due
+    meanwhile are written right away. The journal is written by a separate thread, so that
+    waiting for the disk doesn't block the bus.
+    """
+
+    def __init__(self, cache, journal: str = None):
+        self.cache = cache
+        self.journal = journal
+        self.jobs: Dict[str, ScheduledWrite] = dict()
+        # time the last job with each key was written
+        self.completed: Dict[str, datetime] = dict()
+        # (due timestamp, sequence number, job), entries of replaced jobs are skipped
+        self._heap = []
+        self._sequence = 0
+        self._records = 0
+        self._changed = asyncio.Event()
+        self._task = None
+        if journal is not None:
+            # a single thread, so that the records are written in order
+            self._journal_thread = ThreadPoolExecutor(1)
+            self._load_journal()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    async def schedule(
+        self, job: ScheduledWrite, replace: bool = True
+    ) -> ScheduledWrite:
+        """Add a job, replacing a pending one with the same key unless `replace` is false.
+
+        Returns once the job has been journaled.
+        """
+        if not replace and job.key in self.jobs:
+            raise Exception(f"A write is already scheduled as {job.key}")
+        param = self.cache.param_storage.get_parameter(job.param_id)
+        self.cache.conn.validate_value(param, job.value)
+        if job.created is None:
+            job = job._replace(created=datetime.now())
+        self._add(job)
+        await self._append_record(self._encode(job))
+        return job
+
+    async def cancel(self, key: str) -> Optional[ScheduledWrite]:
+        """Remove a pending job without writing it, returns it if there was one."""
+        job = self.jobs.pop(key, None)
+        if job is not None:
+            await self._append_record({"remove": key})
+        return job
+
+    async def run_now(self, key: str):
+        """Write a pending job right away, it is only removed if the write succeeds."""
+        job = self.jobs.get(key)
+        if job is None:
+            raise Exception(f"No write is scheduled as {key}")
+        await self.cache.set_param(job.param_id, job.value)
+        await self._complete(job)
+
+    async def run(self):
+        """Write the jobs when they are due, until cancelled."""
+        loop = asyncio.get_event_loop()
+        while True:
+            self._changed.clear()
+            timer = None
+            if self._heap:
+                delay = max(self._heap[0][0] - datetime.now().timestamp(), 0)
+                timer = loop.call_later(delay, self._changed.set)
+            try:
+                await self._changed.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            due = self._pop_due(datetime.now() + timedelta(seconds=_BATCH_WINDOW))
+            if due:
+                loop.create_task(self._write(due))
+
+    def _add(self, job: ScheduledWrite):
+        self.jobs[job.key] = job
+        self._sequence += 1
+        heapq.heappush(self._heap, (job.due.timestamp(), self._sequence, job))
+        self._changed.set()
+
+    def _pop_due(self, until: datetime) -> List[ScheduledWrite]:
+        due = []
+        while self._heap and self._heap[0][0] <= until.timestamp():
+            _, _, job = heapq.heappop(self._heap)
+            # skip cancelled and replaced jobs
+            if self.jobs.get(job.key) is job:
+                due.append(job)
+        return due
+
+    async def _write(self, jobs: List[ScheduledWrite]):
+        # if several jobs write the same parameter, the value of the last one due wins
+        by_param: Dict[str, List[ScheduledWrite]] = dict()
+        for job in jobs:
+            by_param.setdefault(job.param_id, []).append(job)
+        containers: Dict[str, Dict[int, List[ScheduledWrite]]] = dict()
+        writes = []
+        for param_id, param_jobs in by_param.items():
+            if "." in param_id:
+                container, index = param_id.split(".")
+                containers.setdefault(container, dict())[int(index)] = param_jobs
+            else:
+                value = param_jobs[-1].value
+                writes.append(
+                    self._write_jobs(param_jobs, self.cache.set_param(param_id, value))
+                )
+        for container, children in containers.items():
+            values = {index: it[-1].value for index, it in children.items()}
+            writes.append(
+                self._write_jobs(
+                    [job for it in children.values() for job in it],
+                    self.cache.set_children(container, values),
+                )
+            )
+        await asyncio.gather(*writes)
+
+    async def _write_jobs(self, jobs: List[ScheduledWrite], write):
+        try:
+            await write
+        except Exception as e:
+            for job in jobs:
+                print(f"Scheduled write {job.key} failed ({e}), retrying later")
+                if self.jobs.get(job.key) is job:
+                    # not journaled, the job is due anyway after a restart
+                    self._add(
+                        job._replace(
+                            due=datetime.now() + timedelta(seconds=_RETRY_DELAY)
+                        )
+                    )
+            return
+        for job in jobs:
+            await self._complete(job)
+
+    async def _complete(self, job: ScheduledWrite):
+        self.completed[job.key] = datetime.now()
+        if self.jobs.get(job.key) is not job:
+            # cancelled or replaced meanwhile
+            return
+        if job.interval:
+            now = datetime.now()
+            due = job.due
+            while due <= now:
+                due += timedelta(seconds=job.interval)
+            await self.schedule(job._replace(due=due))
+        else:
+            await self.cancel(job.key)
+
+    def _encode(self, job: ScheduledWrite) -> dict:
+        _, _, encoding = self.cache.param_storage.get_storage(job.param_id)
+        return {
+            "key": job.key,
+            "param": job.param_id,
+            "value": encoding.serialize(job.value).hex(),
+            "due": job.due.isoformat(),
+            "interval": job.interval,
+            "created": job.created.isoformat(),
+        }
+
+    def _decode(self, record: dict) -> ScheduledWrite:
+        _, _, encoding = self.cache.param_storage.get_storage(record["param"])
+        return ScheduledWrite(
+            record["key"],
+            record["param"],
+            encoding.deserialize(bytes.fromhex(record["value"])),
+            datetime.fromisoformat(record["due"]),
+            record["interval"],
+            datetime.fromisoformat(record["created"]),
+        )
+
+    def _load_journal(self):
+        if not os.path.exists(self.journal):
+            return
+        jobs: Dict[str, dict] = dict()
+        with open(self.journal) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a record may be incomplete if the process died while appending it
+                    continue
+                if "remove" in record:
+                    jobs.pop(record["remove"], None)
+                else:
+                    jobs[record["key"]] = record
+        for record in jobs.values():
+            try:
+                self._add(self._decode(record))
+            except Exception as e:
+                print(f"Dropping scheduled write {record.get('key')}: {e}")
+        # still starting up, nothing else waits for the event loop
+        self._replace_journal(self._get_pending_records())
+        self._records = len(self.jobs)
+
+    async def _append_record(self, record: dict):
+        if self.journal is None:
+            return
+        loop = asyncio.get_event_loop()
+        if self._records >= _COMPACTION_RATIO * max(len(self.jobs), 1):
+            # the jobs already contain the change recorded
+            self._records = len(self.jobs)
+            await loop.run_in_executor(
+                self._journal_thread,
+                self._replace_journal,
+                self._get_pending_records(),
+            )
+            return
+        self._records += 1
+        await loop.run_in_executor(
+            self._journal_thread, self._append_journal, _format_record(record)
+        )
+
+    def _get_pending_records(self) -> str:
+        return "".join(_format_record(self._encode(job)) for job in self.jobs.values())
+
+    def _append_journal(self, records: str):
+        with open(self.journal, "a") as file:
+            file.write(records)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _replace_journal(self, records: str):
+        """Rewrite the journal with only the given records."""
+        temporary = self.journal + ".tmp"
+        with open(temporary, "w") as file:
+            file.write(records)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.journal)
+
+
+def _format_record(record: dict) -> str:
+    return json.dumps(record, separators=(",", ":")) + "\n"
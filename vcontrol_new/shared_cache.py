@@ -0,0 +1,107 @@
+import struct
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from .connection_cache import CacheListener
+from .heating_control import ParameterStorage
+from .parameter import ParameterReading
+
+# Every slot starts with a sequence number and the timestamp of the reading (0 if there is
+# none), followed by the value encoded using the parameter's `Encoding`.
+_SLOT_HEADER = struct.Struct("=Qd")
+_SEQUENCE = struct.Struct("=Q")
+_TIMESTAMP = struct.Struct("=d")
+# how often a reader retries while the slot is being written, before giving up
+_READ_ATTEMPTS = 10
+
+
+def _compute_layout(param_storage: ParameterStorage) -> Tuple[Dict[str, int], int]:
+    offsets = dict()
+    size = 0
+    for param_id, (_, _, encoding) in param_storage.parameters.items():
+        offsets[param_id] = size
+        size += _SLOT_HEADER.size + encoding.get_size()
+    return offsets, size
+
+
+class SharedReadingCache(CacheListener):
+    """Cached readings published in memory shared by several processes.
+
+    The memory holds a fixed slot for each parameter of the `ParameterStorage`, containing
+    the raw value bytes and the time of the reading. Only the process owning the device
+    connection writes to it (by being registered as listener of its `ConnectionCache`),
+    other processes can serve cache hits without asking that process.
+
+    Writers increment the slot's sequence number before and after updating it, so readers
+    can detect (and retry) reading a slot while it is being written.
+    """
+
+    def __init__(self, param_storage: ParameterStorage, buffer):
+        self.param_storage = param_storage
+        self.offsets, size = _compute_layout(param_storage)
+        if len(buffer) < size:
+            raise Exception("Shared memory is too small for the parameter storage")
+        self.buffer = memoryview(buffer)
+
+    @staticmethod
+    def get_size(param_storage: ParameterStorage) -> int:
+        """Return the number of bytes of shared memory needed for the parameters."""
+        return _compute_layout(param_storage)[1]
+
+    def value_stored(self, reading: ParameterReading):
+        param_id = reading.parameter.id
+        if param_id not in self.offsets:
+            # a child parameter, its container's slot is outdated now
+            self.value_invalidated(param_id)
+            return
+        _, _, encoding = self.param_storage.get_storage(param_id)
+        self._write(
+            param_id, reading.time.timestamp(), encoding.serialize(reading.value)
+        )
+
+    def value_invalidated(self, param_id: str):
+        container = param_id.split(".")[0]
+        if container in self.offsets:
+            self._write(container, 0, None)
+
+    def get_reading(self, param_id: str) -> Optional[ParameterReading]:
+        """Return the shared reading of a parameter, if there is a consistent one."""
+        container, _, index = param_id.partition(".")
+        if container not in self.offsets:
+            return None
+        offset = self.offsets[container]
+        param, _, encoding = self.param_storage.get_storage(container)
+        data_start = offset + _SLOT_HEADER.size
+        data_end = data_start + encoding.get_size()
+        for _ in range(_READ_ATTEMPTS):
+            sequence, timestamp = _SLOT_HEADER.unpack_from(self.buffer, offset)
+            if sequence % 2 == 1:
+                # being written right now
+                continue
+            data = bytes(self.buffer[data_start:data_end])
+            if _SEQUENCE.unpack_from(self.buffer, offset)[0] == sequence:
+                break
+        else:
+            return None
+        if timestamp == 0:
+            return None
+        reading = ParameterReading(
+            param, encoding.deserialize(data), datetime.fromtimestamp(timestamp)
+        )
+        if index:
+            return ParameterReading(
+                param.get_child_param(int(index)),
+                reading.value[int(index)],
+                reading.time,
+            )
+        return reading
+
+    def _write(self, param_id: str, timestamp: float, data: Optional[bytes]):
+        offset = self.offsets[param_id]
+        sequence = _SEQUENCE.unpack_from(self.buffer, offset)[0]
+        _SEQUENCE.pack_into(self.buffer, offset, sequence + 1)
+        if data is not None:
+            data_start = offset + _SLOT_HEADER.size
+            self.buffer[data_start : data_start + len(data)] = data
+        _TIMESTAMP.pack_into(self.buffer, offset + _SEQUENCE.size, timestamp)
+        _SEQUENCE.pack_into(self.buffer, offset, sequence + 2)
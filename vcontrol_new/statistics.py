@@ -0,0 +1,66 @@
+from util.resource_usage import ResourceUsage
+
+# weight of a new measurement in the moving averages below
+_SMOOTHING = 0.2
+
+
+class BusStatistics:
+    """Counts how the commands taken from the command queue have been handled.
+
+    Commands are skipped without touching the bus if nobody waits for their result anymore,
+    either because the waiting future has been cancelled (e.g. an HTTP client disconnected)
+    or because the command's deadline has already passed.
+
+    Additionally, the time needed per transferred byte and the time between two
+    synchronization phases are measured, which allows estimating how long a queued
+    command will wait for its answer.
+    """
+
+    def __init__(self, sync_interval: float = 2.0):
+        self.completed = 0
+        self.failed = 0
+        self.skipped_cancelled = 0
+        self.skipped_expired = 0
+        # commands which were sent, but whose caller gave up before the answer arrived
+        self.abandoned = 0
+        # initial guesses: 4800 baud 8E2 transfer 400 bytes/s, plus the device's latency
+        self.seconds_per_byte = 2 / 400
+        self.sync_interval = sync_interval
+        self.usage = ResourceUsage()
+        self.usage.start()
+
+    def record_transfer(self, byte_count: int, seconds: float):
+        """Record the duration of a single command, from sending it until the complete answer."""
+        self.seconds_per_byte += _SMOOTHING * (
+            seconds / byte_count - self.seconds_per_byte
+        )
+
+    def record_sync_interval(self, seconds: float):
+        """Record the time between two synchronization bytes while the bus was idle."""
+        self.sync_interval += _SMOOTHING * (seconds - self.sync_interval)
+
+    def get_session_overhead(self) -> float:
+        """Estimate the bus time a session takes in addition to its transfers."""
+        # a session can only start with a synchronization byte, so a separate session
+        # occupies about one synchronization interval
+        return self.sync_interval
+
+    def estimate_transfer_time(self, byte_count: int) -> float:
+        """Estimate the seconds it takes until `byte_count` queued bytes are transferred."""
+        # on average, a command waits for half a synchronization interval
+        return self.sync_interval / 2 + byte_count * self.seconds_per_byte
+
+    def get_utilization(self) -> float:
+        """Fraction of the last 5 minutes the bus has been busy with commands."""
+        if not self.usage.started():
+            return 0.0
+        return self.usage.get_used_fraction_5min()
+
+    def get_counts(self):
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "skipped_cancelled": self.skipped_cancelled,
+            "skipped_expired": self.skipped_expired,
+            "abandoned": self.abandoned,
+        }